@@ -0,0 +1 @@
+"""压测与基准测试工具（不随宿主程序部署）"""
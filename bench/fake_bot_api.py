@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+本地假 Telegram Bot API 服务（压测用，不访问外网）
+
+实现 getMe / getUpdates / sendMessage / forwardMessage / copyMessage /
+createForumTopic / editMessageText，其它方法一律返回 ok。
+支持注入固定延迟、随机抖动和 429 限流。
+
+单独运行：
+    python -m bench.fake_bot_api --port 8081 --latency 0.05 --rate-limit 0.01
+宿主程序通过 TG_API_BASE_URL=http://127.0.0.1:8081/bot 连接。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+# 会产生新消息、需要注入延迟/限流的方法
+SEND_METHODS = {"sendMessage", "forwardMessage", "copyMessage", "createForumTopic", "editMessageText"}
+# 原样保留为字符串的参数（其它参数按 JSON 解析）
+TEXT_PARAMS = {"text", "name", "caption"}
+
+
+class FakeBotAPI:
+    """假 Bot API 状态：每个 Token 一个更新队列，每个会话一个消息ID计数器"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: float = 0.0, retry_after: int = 1):
+        self.latency = latency          # 每次发送类请求的基础延迟（秒）
+        self.jitter = jitter            # 额外随机延迟上限（秒）
+        self.rate_limit = rate_limit    # 返回 429 的概率（0-1）
+        self.retry_after = retry_after  # 429 响应中的 retry_after（秒）
+        self.updates: Dict[str, List[dict]] = defaultdict(list)
+        self.update_events: Dict[str, asyncio.Event] = defaultdict(asyncio.Event)
+        self.update_ids: Dict[str, int] = defaultdict(int)
+        self.message_ids: Dict[tuple, int] = defaultdict(int)
+        self.topic_ids: Dict[int, int] = defaultdict(int)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.rate_limited: Dict[str, int] = defaultdict(int)
+        self.on_send: Optional[Callable] = None  # fn(token, method, params, result)
+        self.server = None
+        self.connections = set()
+
+    # ---------- 驱动端接口 ----------
+    def next_message_id(self, token: str, chat_id: int) -> int:
+        key = (token, int(chat_id))
+        self.message_ids[key] += 1
+        return self.message_ids[key]
+
+    def push_update(self, token: str, update: dict) -> int:
+        """注入一条 Update（自动分配 update_id）"""
+        self.update_ids[token] += 1
+        update = dict(update, update_id=self.update_ids[token])
+        self.updates[token].append(update)
+        self.update_events[token].set()
+        return update["update_id"]
+
+    # ---------- Bot API 方法 ----------
+    def _message(self, token: str, chat_id, **fields) -> dict:
+        chat_id = int(chat_id)
+        return {
+            "message_id": self.next_message_id(token, chat_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            **fields,
+        }
+
+    async def _get_updates(self, token: str, params: dict):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        queue = self.updates[token]
+        if offset:
+            queue[:] = [u for u in queue if u["update_id"] >= offset]
+        if not queue and timeout:
+            event = self.update_events[token]
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return queue[:limit]
+
+    async def call(self, token: str, method: str, params: dict):
+        """执行一次 API 调用，返回 (HTTP 状态码, 响应 JSON)"""
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(token, params)}
+
+        if method in SEND_METHODS:
+            delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+            if delay:
+                await asyncio.sleep(delay)
+            if self.rate_limit and random.random() < self.rate_limit:
+                self.rate_limited[method] += 1
+                return 429, {
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+
+        bot_id = int(token.split(":", 1)[0])
+        if method == "getMe":
+            result = {
+                "id": bot_id, "is_bot": True, "first_name": f"Bench {bot_id}",
+                "username": f"bench{bot_id}_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }
+        elif method == "sendMessage":
+            result = self._message(token, params["chat_id"], text=params.get("text", ""))
+            if params.get("message_thread_id"):
+                result.update(message_thread_id=int(params["message_thread_id"]), is_topic_message=True)
+        elif method in ("forwardMessage", "copyMessage"):
+            message = self._message(token, params["chat_id"])
+            result = {"message_id": message["message_id"]} if method == "copyMessage" else message
+        elif method == "createForumTopic":
+            chat_id = int(params["chat_id"])
+            self.topic_ids[chat_id] += 1
+            result = {"message_thread_id": self.topic_ids[chat_id], "name": params.get("name", ""), "icon_color": 7322096}
+        elif method == "editMessageText":
+            result = {
+                "message_id": int(params["message_id"]), "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""), "edit_date": int(time.time()),
+            }
+        else:
+            result = True
+
+        if method in SEND_METHODS and self.on_send is not None:
+            self.on_send(token, method, params, result)
+        return 200, {"ok": True, "result": result}
+
+    # ---------- HTTP ----------
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+
+                path = request_line.decode("latin-1").split()[1]
+                path, _, query = path.partition("?")
+                params = {}
+                for key, value in parse_qsl(query) + parse_qsl(body.decode("utf-8")):
+                    if key in TEXT_PARAMS:
+                        params[key] = value
+                    else:
+                        try:
+                            params[key] = json.loads(value)
+                        except ValueError:
+                            params[key] = value
+
+                # /bot<token>/<method>
+                _, _, rest = path.partition("/bot")
+                token, _, method = rest.partition("/")
+                try:
+                    status, response = await self.call(token, method, params)
+                except Exception as e:
+                    status, response = 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+
+                payload = json.dumps(response).encode("utf-8")
+                reason = {200: "OK", 400: "Bad Request", 429: "Too Many Requests"}.get(status, "OK")
+                writer.write(
+                    f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """启动服务，返回可用作 TG_API_BASE_URL 的地址"""
+        self.server = await asyncio.start_server(self._handle, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/bot"
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for task in list(self.connections):
+                task.cancel()
+            await self.server.wait_closed()
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="本地假 Telegram Bot API 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="发送类请求基础延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="额外随机延迟上限（秒）")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="返回 429 的概率")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit)
+    base_url = await api.start(args.host, args.port)
+    print(f"TG_API_BASE_URL={base_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+宿主程序压测：N 个子 Bot × M 个用户，对接本地假 Bot API
+
+在同一进程内启动假 Bot API 和子 Bot（使用临时数据库），按固定速率注入
+用户消息，统计从注入 Update 到假 API 收到对应转发请求的耗时。
+
+场景：
+    direct      直连模式，用户私聊 -> 主人
+    forum       话题模式，用户私聊 -> 话题群（首条消息创建话题）
+    edit-heavy  直连模式，一半为编辑已转发的消息
+
+示例：
+    python -m bench.loadtest --scenario direct --bots 5 --users 50 --rate 100 --duration 30
+    python -m bench.loadtest --scenario forum --latency 0.05 --rate-limit 0.02 --json result.json
+    python -m bench.loadtest --smoke            # CI 冒烟：短时运行，未通过检查时以非零状态退出
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_bot_api import FakeBotAPI
+
+SCENARIOS = {
+    "direct": {"mode": "direct", "edit_ratio": 0.0},
+    "forum": {"mode": "forum", "edit_ratio": 0.0},
+    "edit-heavy": {"mode": "direct", "edit_ratio": 0.5},
+}
+# 计入“数据库写入”的操作名前缀
+DB_WRITE_PREFIXES = ("set_", "add_", "update_", "delete_", "remove_", "save_", "enqueue_", "reschedule_", "move_", "replay_")
+MARKER = re.compile(r"#lt(\d+)")
+OWNER_BASE = 100000
+USER_BASE = 1000000
+FORUM_GROUP_ID = -1001000000000
+# --smoke 使用的参数（小规模、短时，适合 CI）
+SMOKE_ARGS = {"bots": 2, "users": 5, "rate": 20.0, "duration": 5.0, "drain": 10.0, "max_p99": 1.0}
+# 转发分支：tg_handle_message_seconds 中应只计处理耗时（不含提示消息的自动删除等待）
+FORWARD_PATHS = ("direct_forward", "forum_forward")
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class LoadTest:
+    def __init__(self, args, hb):
+        self.args = args
+        self.hb = hb
+        self.scenario = SCENARIOS[args.scenario]
+        self.api = FakeBotAPI(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit)
+        self.api.on_send = self.on_send
+        self.pending = {}                     # 序号 -> (类型, 注入时间, token, 用户ID, 用户消息ID)
+        self.latencies = defaultdict(list)    # 类型 -> [秒]
+        self.forwarded = defaultdict(list)    # (token, user_id) -> 已转发的用户消息ID（用于编辑）
+        self.db_ops = defaultdict(int)
+        self.seq = 0
+
+    # ---------- 假 API 回调 ----------
+    def on_send(self, token, method, params, result):
+        # 注入的文本带有 #lt<序号> 标记，转发/编辑后的文本中仍然保留
+        match = MARKER.search(params.get("text", "") or "")
+        if not match or int(match.group(1)) not in self.pending:
+            return
+        seq = int(match.group(1))
+        kind, started, token, user_id, message_id = self.pending.pop(seq)
+        self.latencies[kind].append(time.perf_counter() - started)
+        if kind == "new":
+            self.forwarded[(token, user_id)].append(message_id)
+
+    def on_db_op(self, op, seconds, ok):
+        self.hb.observe_db_op(op, seconds, ok)
+        if op.startswith(DB_WRITE_PREFIXES):
+            self.db_ops[op] += 1
+
+    # ---------- 准备 ----------
+    async def setup(self):
+        hb, db = self.hb, self.hb.db
+        base_url = await self.api.start()
+        hb.TG_API_BASE_URL = base_url
+        db.set_op_observer(self.on_db_op)
+
+        self.bots = []
+        for i in range(self.args.bots):
+            token = f"{900000 + i}:BENCH"
+            bot_username = f"bench{900000 + i}_bot"
+            owner_id = OWNER_BASE + i
+            db.add_bot(bot_username, token, owner_id, welcome_msg="")
+            if self.scenario["mode"] == "forum":
+                db.update_bot_mode(bot_username, "forum")
+                db.update_bot_forum_id(bot_username, FORUM_GROUP_ID - i)
+            users = [USER_BASE + i * self.args.users + j for j in range(self.args.users)]
+            for user_id in users:
+                db.add_verified_user(bot_username, user_id, f"User {user_id}", "")
+            self.bots.append((token, bot_username, owner_id, users))
+        hb.load_bots()
+
+        for token, bot_username, owner_id, _ in self.bots:
+            app = hb.build_sub_app(token, owner_id, bot_username)
+            hb.running_apps[bot_username] = app
+            await app.initialize()
+            await app.start()
+            await app.updater.start_polling(poll_interval=0.0, timeout=1)
+        self.retry_task = asyncio.create_task(hb.outbound_retry_loop())
+
+    async def teardown(self):
+        self.retry_task.cancel()
+        for _, bot_username, _, _ in self.bots:
+            app = self.hb.running_apps.pop(bot_username)
+            await app.updater.stop()
+            await app.stop()
+            await app.shutdown()
+        await self.api.stop()
+
+    # ---------- 注入 ----------
+    def inject(self):
+        token, _, _, users = random.choice(self.bots)
+        user_id = random.choice(users)
+        self.seq += 1
+        seq = self.seq
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"u{user_id}"}
+        chat = {"id": user_id, "type": "private", "first_name": f"User{user_id}"}
+        previous = self.forwarded.get((token, user_id))
+        now = int(time.time())
+
+        if previous and random.random() < self.scenario["edit_ratio"]:
+            message_id = random.choice(previous)
+            self.pending[seq] = ("edit", time.perf_counter(), token, user_id, message_id)
+            self.api.push_update(token, {"edited_message": {
+                "message_id": message_id, "date": now, "edit_date": now,
+                "chat": chat, "from": user, "text": f"edited #lt{seq}",
+            }})
+            return
+
+        message_id = self.api.next_message_id(token, user_id)
+        self.pending[seq] = ("new", time.perf_counter(), token, user_id, message_id)
+        self.api.push_update(token, {"message": {
+            "message_id": message_id, "date": now, "chat": chat, "from": user, "text": f"hello #lt{seq}",
+        }})
+
+    async def run(self) -> dict:
+        await self.setup()
+        interval = 1.0 / self.args.rate
+        started = time.perf_counter()
+        deadline = started + self.args.duration
+        next_at = started
+        try:
+            while time.perf_counter() < deadline:
+                self.inject()
+                next_at += interval
+                await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            # 等待剩余消息完成
+            drain_deadline = time.perf_counter() + self.args.drain
+            while self.pending and time.perf_counter() < drain_deadline:
+                await asyncio.sleep(0.05)
+            # 停止前统计：Application.stop() 会继续处理队列里剩余的 Update
+            result = self.report(time.perf_counter() - started)
+        finally:
+            await self.teardown()
+        return result
+
+    def report(self, elapsed: float) -> dict:
+        all_latencies = [v for values in self.latencies.values() for v in values]
+        db_writes = sum(self.db_ops.values())
+        return {
+            "scenario": self.args.scenario,
+            "bots": self.args.bots,
+            "users_per_bot": self.args.users,
+            "target_rate": self.args.rate,
+            "duration": self.args.duration,
+            "api": {"latency": self.args.latency, "jitter": self.args.jitter, "rate_limit": self.args.rate_limit},
+            "injected": self.seq,
+            "completed": len(all_latencies),
+            "unfinished": len(self.pending),
+            "elapsed": round(elapsed, 3),
+            "throughput": round(len(all_latencies) / elapsed, 2),
+            "latency": {
+                kind: {
+                    "count": len(values),
+                    "p50": round(percentile(values, 0.50), 4),
+                    "p99": round(percentile(values, 0.99), 4),
+                    "max": round(max(values), 4),
+                }
+                for kind, values in (("all", all_latencies), *self.latencies.items()) if values
+            },
+            "handler": {
+                path: {
+                    "count": self.hb.HANDLE_MESSAGE_SECONDS.count(path),
+                    "p95": self.hb.HANDLE_MESSAGE_SECONDS.quantile(0.95, path),
+                }
+                for (path,) in sorted(self.hb.HANDLE_MESSAGE_SECONDS.values)
+            },
+            "db_writes": db_writes,
+            "db_writes_per_sec": round(db_writes / elapsed, 2),
+            "db_write_ops": dict(self.db_ops),
+            "api_calls": dict(self.api.calls),
+            "api_rate_limited": dict(self.api.rate_limited),
+            "outbound_queue": self.hb.db.get_outbound_queue_size(),
+        }
+
+
+def print_report(result: dict):
+    print(f"\n📊 场景 {result['scenario']}: {result['bots']} Bot × {result['users_per_bot']} 用户, "
+          f"目标 {result['target_rate']}/s, {result['duration']}s")
+    print(f"  注入 {result['injected']} · 完成 {result['completed']} · 未完成 {result['unfinished']} "
+          f"· 吞吐 {result['throughput']}/s")
+    for kind, stats in result["latency"].items():
+        print(f"  延迟[{kind}] n={stats['count']} p50={stats['p50'] * 1000:.1f}ms "
+              f"p99={stats['p99'] * 1000:.1f}ms max={stats['max'] * 1000:.1f}ms")
+    for path, stats in result["handler"].items():
+        print(f"  处理耗时[{path}] n={stats['count']} p95≤{stats['p95'] * 1000:.0f}ms")
+    print(f"  数据库写入 {result['db_writes']} 次（{result['db_writes_per_sec']}/s）")
+    if result["api_rate_limited"]:
+        print(f"  429 注入: {result['api_rate_limited']} · 重发队列剩余 {result['outbound_queue']}")
+
+
+def check_result(result: dict, args) -> list:
+    """返回未通过的检查项（空列表表示通过）"""
+    failures = []
+    if result["unfinished"]:
+        failures.append(f"{result['unfinished']} 条消息未完成")
+    overall = result["latency"].get("all")
+    if args.max_p99 and overall and overall["p99"] > args.max_p99:
+        failures.append(f"转发延迟 p99={overall['p99']}s 超过 {args.max_p99}s")
+    # 假 API 零延迟时转发处理应在亚秒级完成
+    if args.latency == 0 and args.jitter == 0:
+        for path in FORWARD_PATHS:
+            stats = result["handler"].get(path)
+            if stats and stats["p95"] > args.max_handler_p95:
+                failures.append(f"处理耗时[{path}] p95≤{stats['p95']}s 超过 {args.max_handler_p95}s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="宿主程序压测（本地假 Bot API）")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="direct")
+    parser.add_argument("--bots", type=int, default=3, help="子 Bot 数量")
+    parser.add_argument("--users", type=int, default=20, help="每个 Bot 的用户数")
+    parser.add_argument("--rate", type=float, default=20.0, help="注入速率（条/秒，所有 Bot 合计）")
+    parser.add_argument("--duration", type=float, default=10.0, help="注入时长（秒）")
+    parser.add_argument("--drain", type=float, default=30.0, help="注入结束后最多等待的时间（秒）")
+    parser.add_argument("--latency", type=float, default=0.0, help="假 API 发送类请求基础延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="假 API 额外随机延迟上限（秒）")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="假 API 返回 429 的概率")
+    parser.add_argument("--max-handler-p95", type=float, default=1.0,
+                        help="假 API 零延迟时转发处理耗时 p95 上限（秒）")
+    parser.add_argument("--max-p99", type=float, default=0.0, help="转发延迟 p99 上限（秒，0 为不检查）")
+    parser.add_argument("--smoke", action="store_true", help="CI 冒烟模式：使用小规模参数，默认 p99 上限 1 秒")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="结果写入 JSON 文件")
+    parser.add_argument("--verbose", action="store_true", help="输出宿主程序日志")
+    args = parser.parse_args()
+    if args.smoke:
+        # 冒烟参数只覆盖命令行未指定的项
+        for key, value in SMOKE_ARGS.items():
+            if getattr(args, key) == parser.get_default(key):
+                setattr(args, key, value)
+
+    random.seed(args.seed)
+    # 使用临时数据库，关闭指标端点和宿主通知；必须在导入宿主模块之前设置
+    data_dir = tempfile.mkdtemp(prefix="tg_bench_")
+    os.environ["TG_BOT_DATA_DIR"] = data_dir
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["ADMIN_CHANNEL"] = ""
+    os.environ.setdefault("OUTBOUND_POLL_INTERVAL", "0.5")
+    os.environ.setdefault("OUTBOUND_RETRY_BASE", "0.5")
+
+    import host_bot as hb
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    hb.db.open_database()
+
+    result = asyncio.run(LoadTest(args, hb).run())
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"  结果已写入 {args.json}")
+
+    failures = check_result(result, args)
+    for failure in failures:
+        print(f"  ❌ {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+database.py 存储层基准测试
+
+生成合成数据集（默认映射 1000 万行，按创建日期写入 mm_<类型>_<日期> 分桶表；verified_users 100 万行），
+分别在单线程和多线程竞争（外加一个持续写入的线程）下测量：
+    set_mapping / get_mapping / is_verified / get_database_stats / prune_expired_mappings / cleanup_old_mappings / drop_bucket
+
+结果写成 JSON，可以与之前某次提交的结果比较；当延迟回退超过阈值，
+或热点查询的执行计划从索引查找变成全表扫描时给出警告。
+
+示例：
+    python -m bench.storage_bench --json results/head.json
+    python -m bench.storage_bench --scale 0.01 --baseline results/main.json --fail-on-regression
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAP_TYPES = ("direct", "user_forward", "forward_user", "owner_user", "topic")
+DATASET_MARKER = "bench_dataset.json"
+BATCH = 50000
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")  # 归并语句形状用
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(latencies, elapsed: float) -> dict:
+    return {
+        "calls": len(latencies),
+        "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 4),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+        "max_ms": round(max(latencies) * 1000, 4) if latencies else 0.0,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def schema_fingerprint(db_file: str):
+    """表结构和索引定义的哈希（用于判断两次结果是否基于同一 schema）"""
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY type, name"
+    ).fetchall()
+    conn.close()
+    text = "\n".join(f"{t} {n} {sql}" for t, n, sql in rows)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], [f"{t} {n}" for t, n, _ in rows]
+
+
+# ================== 数据集 ==================
+def dataset_spec(args) -> dict:
+    return {
+        "mappings": int(args.mappings * args.scale),
+        "verified": int(args.verified * args.scale),
+        "bots": args.bots,
+        "days": args.days,
+        "seed": args.seed,
+    }
+
+
+def generate_dataset(db, spec: dict):
+    """批量写入合成数据（关闭同步，单个大事务分批提交）"""
+    rng = random.Random(spec["seed"])
+    bots = [f"bench{i}_bot" for i in range(spec["bots"])]
+    now = datetime.utcnow()
+    conn = sqlite3.connect(db.DB_FILE)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = MEMORY")
+
+    print(f"🧪 生成 verified_users: {spec['verified']:,} 行")
+    started = time.perf_counter()
+    per_bot = max(1, spec["verified"] // len(bots))
+    rows = []
+    for i in range(spec["verified"]):
+        rows.append((bots[i // per_bot % len(bots)], 10_000_000 + i, f"User {i}", f"u{i}"))
+        if len(rows) >= BATCH:
+            conn.executemany(
+                "INSERT OR IGNORE INTO verified_users (bot_username, user_id, user_name, user_username) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            rows.clear()
+    if rows:
+        conn.executemany(
+            "INSERT OR IGNORE INTO verified_users (bot_username, user_id, user_name, user_username) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+    conn.commit()
+
+    # 与线上一致：有保留期限的类型按 UTC 日期写入分桶表（MAP_TYPES[i % 4] 都是分桶类型）
+    print(f"🧪 生成映射分桶: {spec['mappings']:,} 行")
+    span = spec["days"] * 86400
+    buckets = defaultdict(list)  # 分桶表名 -> 待写入行
+    created_buckets = set()
+
+    def flush(name):
+        conn.executemany(
+            f"INSERT INTO {name} (bot_username, map_type, key, value, user_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            buckets.pop(name),
+        )
+
+    for i in range(spec["mappings"]):
+        created = now - timedelta(seconds=rng.randrange(span))
+        ts = created.strftime("%Y-%m-%d %H:%M:%S")
+        map_type = MAP_TYPES[i % 4]
+        day = created.strftime("%Y%m%d")
+        name = db._bucket_name(map_type, day)
+        if name not in created_buckets:
+            db._create_bucket_table(conn.cursor(), name)
+            conn.execute("INSERT OR IGNORE INTO mapping_buckets (name, map_type, day) VALUES (?, ?, ?)", (name, map_type, day))
+            created_buckets.add(name)
+        rows = buckets[name]
+        rows.append((bots[i % len(bots)], map_type, f"k{i}", str(i), 10_000_000 + rng.randrange(max(1, spec["verified"])), ts, ts))
+        if len(rows) >= BATCH:
+            flush(name)
+        if i % (BATCH * 20) == BATCH * 20 - 1:
+            conn.commit()
+            print(f"   … {i + 1:,}")
+    for name in list(buckets):
+        flush(name)
+    db._load_bucket_registry(conn.cursor())
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"✅ 数据集生成完成，用时 {time.perf_counter() - started:.1f}s")
+
+
+def prepare_dataset(db, spec: dict, data_dir: str, regenerate: bool):
+    """复用上次生成的数据集（规格一致、一天内生成且未被破坏性操作修改），否则重新生成"""
+    marker = os.path.join(data_dir, DATASET_MARKER)
+    if not regenerate and os.path.exists(marker) and os.path.exists(db.DB_FILE):
+        with open(marker, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("spec") == spec and time.time() - saved.get("generated_at", 0) < 86400:
+            print(f"♻️ 复用已有数据集: {db.DB_FILE}")
+            db.open_database()
+            return
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(db.DB_FILE + suffix):
+            os.remove(db.DB_FILE + suffix)
+    db.open_database()
+    generate_dataset(db, spec)
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump({"spec": spec, "generated_at": time.time()}, f)
+
+
+# ================== SQL 捕获与执行计划 ==================
+class SQLCapture:
+    """给 database.get_connection 创建的连接挂上 trace 回调，记录实际执行的语句"""
+
+    def __init__(self, db):
+        self.db = db
+        self.original = db.get_connection
+        self.active = None
+        self.statements = defaultdict(dict)  # 操作 -> {语句形状: 一条实际语句}
+
+    def record(self, op: str, sql: str):
+        shape = LITERAL.sub("?", " ".join(sql.split()))
+        self.statements[op].setdefault(shape, sql)
+
+    def install(self):
+        def get_connection():
+            conn = self.original()
+            if self.active is not None:
+                op = self.active
+                conn.set_trace_callback(lambda sql: self.record(op, sql))
+            return conn
+        self.db.get_connection = get_connection
+
+    def plans(self, op: str) -> list:
+        """对记录的语句逐条 EXPLAIN QUERY PLAN"""
+        conn = sqlite3.connect(self.db.DB_FILE)
+        result = []
+        for _, sql in sorted(self.statements.get(op, {}).items()):
+            head = sql.lstrip().split(None, 1)[0].upper()
+            if head not in ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE"):
+                continue
+            try:
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            except sqlite3.Error:
+                continue
+            result.append({"sql": " ".join(sql.split())[:200], "plan": [row[-1] for row in rows]})
+        conn.close()
+        return result
+
+
+def full_scans(plans: list) -> list:
+    """执行计划中对大表的全表扫描（包括覆盖索引扫描，耗时同样随行数线性增长）"""
+    found = []
+    for item in plans:
+        for step in item["plan"]:
+            table = step.split()[1] if step.startswith("SCAN ") else ""
+            if table in ("message_mappings", "verified_users") or table.startswith("mm_"):
+                found.append(step)
+    return found
+
+
+# ================== 操作 ==================
+def build_ops(db, spec: dict, rng: random.Random) -> dict:
+    """每个操作一个无参可调用对象；命中与未命中各占一半"""
+    bots = [f"bench{i}_bot" for i in range(spec["bots"])]
+    mappings = max(1, spec["mappings"])
+    verified = max(1, spec["verified"])
+    per_bot = max(1, verified // len(bots))
+    counter = iter(range(10 ** 12))
+
+    def set_mapping():
+        n = next(counter)
+        db.set_mapping(rng.choice(bots), "user_forward", f"bench_new_{threading.get_ident()}_{n}", str(n), 1)
+
+    def get_mapping():
+        if rng.random() < 0.5:
+            i = rng.randrange(mappings)
+            db.get_mapping(bots[i % len(bots)], MAP_TYPES[i % 4], f"k{i}")
+        else:
+            db.get_mapping(rng.choice(bots), "direct", f"missing{rng.randrange(10 ** 9)}")
+
+    def is_verified():
+        i = rng.randrange(verified * 2)
+        db.is_verified(bots[i // per_bot % len(bots)], 10_000_000 + i)
+
+    return {
+        "set_mapping": set_mapping,
+        "get_mapping": get_mapping,
+        "is_verified": is_verified,
+        "get_database_stats": db.get_database_stats,
+    }
+
+
+def run_single(fn, calls: int) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(calls):
+        t = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def run_contention(fn, calls: int, threads: int, writer) -> dict:
+    """threads 个线程并发执行 fn，同时一个写线程持续 set_mapping"""
+    stop = threading.Event()
+    writer_calls = [0]
+
+    def write_loop():
+        while not stop.is_set():
+            writer()
+            writer_calls[0] += 1
+
+    def worker(n):
+        latencies = []
+        for _ in range(n):
+            t = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - t)
+        return latencies
+
+    background = threading.Thread(target=write_loop, daemon=True)
+    background.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        parts = list(pool.map(worker, [max(1, calls // threads)] * threads))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    background.join()
+    result = summarize([v for part in parts for v in part], elapsed)
+    result["threads"] = threads
+    result["background_writes"] = writer_calls[0]
+    return result
+
+
+# ================== 比较 ==================
+def compare(result: dict, baseline: dict, threshold: float) -> list:
+    """与基线比较，返回警告列表"""
+    warnings = []
+    if result["meta"]["dataset"] != baseline["meta"].get("dataset"):
+        warnings.append("⚠️ 数据集规格与基线不同，比较结果仅供参考")
+    schema_changed = result["meta"]["schema_fingerprint"] != baseline["meta"].get("schema_fingerprint")
+    if schema_changed:
+        warnings.append(
+            f"ℹ️ schema 已变化: {baseline['meta'].get('schema_fingerprint')} -> {result['meta']['schema_fingerprint']}"
+        )
+    for op, modes in result["ops"].items():
+        base_modes = baseline.get("ops", {}).get(op, {})
+        for mode in ("single", "contention"):
+            new, old = modes.get(mode), base_modes.get(mode)
+            if not new or not old:
+                continue
+            for metric in ("p50_ms", "p99_ms"):
+                if old[metric] > 0 and new[metric] > old[metric] * (1 + threshold):
+                    warnings.append(
+                        f"🐢 {op}[{mode}] {metric} 回退: {old[metric]:.3f} -> {new[metric]:.3f} ms "
+                        f"(+{(new[metric] / old[metric] - 1) * 100:.0f}%)"
+                        + ("，可能与 schema/索引变化有关" if schema_changed else "")
+                    )
+        new_scans = set(modes.get("full_scans", [])) - set(base_modes.get("full_scans", []))
+        for step in sorted(new_scans):
+            warnings.append(f"🚨 {op} 出现新的全表扫描: {step}")
+    return warnings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="database.py 存储层基准测试")
+    parser.add_argument("--mappings", type=int, default=10_000_000, help="映射行数（按日期写入分桶表）")
+    parser.add_argument("--verified", type=int, default=1_000_000, help="verified_users 行数")
+    parser.add_argument("--bots", type=int, default=100, help="数据集中的 Bot 数量")
+    parser.add_argument("--days", type=int, default=6, help="映射创建时间分布的天数")
+    parser.add_argument("--scale", type=float, default=1.0, help="数据集缩放比例（CI 可用 0.01）")
+    parser.add_argument("--calls", type=int, default=2000, help="每个操作的调用次数")
+    parser.add_argument("--threads", type=int, default=4, help="竞争测试的并发线程数")
+    parser.add_argument("--cleanup-days", type=int, default=5, help="drop_bucket / prune_expired_mappings / cleanup_old_mappings 的保留天数")
+    parser.add_argument("--prune-chunk", type=int, default=500, help="prune_expired_mappings 每批行数")
+    parser.add_argument("--prune-batches", type=int, default=20, help="prune_expired_mappings 测量的批次数")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "tg_storage_bench"))
+    parser.add_argument("--regenerate", action="store_true", help="强制重新生成数据集")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前的 JSON 结果比较")
+    parser.add_argument("--threshold", type=float, default=0.25, help="判定回退的比例（默认 25%%）")
+    parser.add_argument("--fail-on-regression", action="store_true", help="有回退时以非零状态退出")
+    args = parser.parse_args()
+
+    # 必须在导入 database 之前指定数据目录
+    os.makedirs(args.data_dir, exist_ok=True)
+    os.environ["TG_BOT_DATA_DIR"] = args.data_dir
+    import logging
+    logging.disable(logging.WARNING)
+    import database as db
+
+    spec = dataset_spec(args)
+    prepare_dataset(db, spec, args.data_dir, args.regenerate)
+    fingerprint, schema_objects = schema_fingerprint(db.DB_FILE)
+
+    capture = SQLCapture(db)
+    capture.install()
+    rng = random.Random(args.seed)
+    ops = build_ops(db, spec, rng)
+    results = {}
+
+    for name, fn in ops.items():
+        calls = max(1, args.calls // 50) if name == "get_database_stats" else args.calls
+        print(f"⏱  {name} ×{calls}")
+        capture.active = name
+        single = run_single(fn, calls)
+        capture.active = None
+        contention = run_contention(fn, calls, args.threads, ops["set_mapping"])
+        plans = capture.plans(name)
+        results[name] = {"single": single, "contention": contention, "plans": plans, "full_scans": full_scans(plans)}
+
+    # 整桶过期：与维护任务的顺序一致，先对超过保留期的分桶直接 DROP TABLE，再逐行清理剩余的过期映射
+    expired = db.list_expired_buckets(dict.fromkeys(MAP_TYPES, args.cleanup_days * 24))
+    print(f"⏱  drop_bucket ×{len(expired)}")
+    capture.active = "drop_bucket"
+    latencies, dropped = [], 0
+    started = time.perf_counter()
+    for name, _, _ in expired:
+        t = time.perf_counter()
+        dropped += db.drop_bucket(name)
+        latencies.append(time.perf_counter() - t)
+    capture.active = None
+    plans = capture.plans("drop_bucket")
+    results["drop_bucket"] = {
+        "single": dict(summarize(latencies, time.perf_counter() - started), deleted_rows=dropped),
+        "plans": plans,
+        "full_scans": full_scans(plans),
+    }
+
+    # 后台维护的分批清理：每批持有 db_lock 的时间决定了清理期间消息处理最多被阻塞多久
+    print(f"⏱  prune_expired_mappings(days={args.cleanup_days}, limit={args.prune_chunk}) ×{args.prune_batches}")
+    capture.active = "prune_expired_mappings"
+    latencies, pruned = [], 0
+    started = time.perf_counter()
+    for _ in range(args.prune_batches):
+        t = time.perf_counter()
+        pruned += len(db.prune_expired_mappings(dict.fromkeys(MAP_TYPES, args.cleanup_days * 24), args.prune_chunk))
+        latencies.append(time.perf_counter() - t)
+    capture.active = None
+    plans = capture.plans("prune_expired_mappings")
+    results["prune_expired_mappings"] = {
+        "single": dict(summarize(latencies, time.perf_counter() - started), deleted_rows=pruned),
+        "plans": plans,
+        "full_scans": full_scans(plans),
+    }
+
+    # cleanup 会删除数据，放在最后并让下次运行重新生成数据集
+    print(f"⏱  cleanup_old_mappings(days={args.cleanup_days})")
+    capture.active = "cleanup_old_mappings"
+    started = time.perf_counter()
+    deleted = db.cleanup_old_mappings(args.cleanup_days)
+    elapsed = time.perf_counter() - started
+    capture.active = None
+    plans = capture.plans("cleanup_old_mappings")
+    results["cleanup_old_mappings"] = {
+        "single": {"calls": 1, "deleted_rows": deleted, "p50_ms": round(elapsed * 1000, 2), "p99_ms": round(elapsed * 1000, 2)},
+        "plans": plans,
+        "full_scans": full_scans(plans),
+    }
+
+    os.remove(os.path.join(args.data_dir, DATASET_MARKER))
+
+    result = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "dataset": spec,
+            "schema_fingerprint": fingerprint,
+            "schema_objects": schema_objects,
+            "db_size_mb": round(os.path.getsize(db.DB_FILE) / 1024 / 1024, 1),
+        },
+        "ops": results,
+    }
+
+    print(f"\n📊 存储基准（{spec['mappings']:,} 映射 / {spec['verified']:,} 验证用户，schema {fingerprint}）")
+    for name, data in results.items():
+        for mode in ("single", "contention"):
+            stats = data.get(mode)
+            if not stats:
+                continue
+            extra = f" ops/s={stats['ops_per_sec']}" if "ops_per_sec" in stats else f" 删除 {stats['deleted_rows']:,} 行"
+            print(f"  {name:<22} {mode:<10} p50={stats['p50_ms']:.3f}ms p99={stats['p99_ms']:.3f}ms{extra}")
+        for step in data["full_scans"]:
+            print(f"  ⚠️ {name} 全表扫描: {step}")
+
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已写入 {args.json}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        warnings = compare(result, baseline, args.threshold)
+        print(f"\n🔍 与基线 {baseline['meta'].get('commit')} 比较：")
+        for line in warnings or ["✅ 无明显回退"]:
+            print(f"  {line}")
+        if args.fail_on_regression and any(w.startswith(("🐢", "🚨")) for w in warnings):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,19 @@
 数据库模块 - SQLite 持久化存储
 支持：Bot配置、用户验证、消息映射
 """
+import calendar
+import gzip
+import hashlib
 import sqlite3
 import json
 import logging
 import os
+import re
+import time
 from datetime import datetime
+from functools import wraps
 from typing import Dict, List, Optional, Tuple
-from threading import Lock
+from threading import Lock, local
 logger = logging.getLogger(__name__)
 
 # 数据库文件路径（使用绝对路径，确保不同运行方式下都访问同一文件）
@@ -20,110 +26,253 @@ DB_FILE = os.path.join(DB_DIR, 'bot_data.db')
 
 # 线程锁，防止并发写入冲突
 db_lock = Lock()
-def get_connection():
-    """获取数据库连接"""
+
+# 计数器表 db_counters 维护的行数：表名 -> (范围表达式, 计数项表达式)
+# 由触发器在同一事务内增减，统计查询不再扫描大表；{row} 为 NEW / OLD 或表名本身
+COUNTED_TABLES = {
+    'bots': ("''", "'bots'"),
+    'verified_users': ("{row}.bot_username", "'verified_users'"),
+    'blacklist': ("{row}.bot_username", "'blacklist'"),
+    'message_mappings': ("{row}.bot_username", "'mappings:' || {row}.map_type"),
+}
+
+# 按天分表存储的映射类型（有保留期限的类型）；topic 永久保留，仍写 message_mappings
+# 分桶表名 mm_<类型>_<UTC日期>，整桶过期后直接 DROP TABLE，不再逐行删除
+BUCKETED_MAP_TYPES = ('direct', 'user_forward', 'forward_user', 'owner_user')
+_bucket_days: Dict[str, List[str]] = {}  # 映射类型 -> 现存分桶日期（升序），与 mapping_buckets 表同步
+
+# 增量备份（export_backup / restore_backup）跟踪的大表：表名 -> 修改时间列（None 表示只追加）
+# 按 id / 修改时间高水位导出新增和修改的行；映射分桶表按 updated_at 同样处理
+TRACKED_TABLES = {
+    'verified_users': 'verified_at',
+    'blacklist': 'blocked_at',
+    'message_mappings': 'updated_at',
+    'admin_events': None,
+}
+# 删除由触发器记录到 backup_tombstones（按 id；分桶表的 id 可能复用，增量文件里删除先于写入回放）
+# 映射分桶表的逐行删除（delete_mapping、按 Bot 的保留期清理）同样记录，整桶 DROP 不记录
+TOMBSTONE_TABLES = ('verified_users', 'blacklist', 'message_mappings')
+# 行数少的表每次整表导出；待验证记录（验证码）是临时数据，不备份
+SMALL_TABLES = ('bots', 'global_settings', 'retention_policies', 'bot_health', 'mapping_buckets',
+                'outbound_queue', 'dead_letters')
+TOMBSTONE_RETENTION_DAYS = 30  # 删除记录保留天数；距上次导出更久时下次导出自动改为全量
+DELTA_OVERLAP_SECONDS = 2      # 修改时间高水位取导出开始前若干秒（时间戳只精确到秒；重复回放无副作用）
+BUCKET_TABLE_RE = re.compile(r'mm_(?:direct|user_forward|forward_user|owner_user)_\d{8}')
+
+# 宿主程序内存状态（bots_data / msg_map）的来源表：任何增删改都由触发器更新 state_generation，
+# 状态快照记录写入时的 (value, stamp)，启动时一致才直接使用；映射分桶表同样挂触发器
+STATE_TABLES = ('bots', 'message_mappings')
+
+# 数据库操作耗时观察者：fn(操作名, 耗时秒数, 是否成功)，由宿主程序注册（用于指标统计）
+_op_observer = None
+_op_state = local()  # 当前线程正在计时的操作（active）及其是否失败（failed）
+
+
+def set_op_observer(fn):
+    """注册数据库操作耗时观察者（传 None 取消）"""
+    global _op_observer
+    _op_observer = fn
+
+
+def _report_error():
+    """在被计时函数的 except 分支中调用：函数自己吞掉异常返回默认值时，本次操作仍按失败统计"""
+    _op_state.failed = True
+
+
+def timed_op(func):
+    """记录数据库操作耗时（未注册观察者时几乎没有开销）；嵌套调用只统计最外层"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        observer = _op_observer
+        if observer is None or getattr(_op_state, 'active', False):
+            return func(*args, **kwargs)
+        _op_state.active = True
+        _op_state.failed = False
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = not _op_state.failed
+            return result
+        finally:
+            _op_state.active = False
+            try:
+                observer(func.__name__, time.perf_counter() - start, ok)
+            except Exception:
+                pass
+    return wrapper
+
+
+# ================== 数据库生命周期 ==================
+# open_database() 打开并迁移数据库；导入本模块不再访问磁盘，
+# 未显式打开时第一次 get_connection() 自动打开（命令行工具、测试无需额外调用）
+_opened = False
+_open_lock = Lock()  # 不用 db_lock：懒打开可能发生在持有 db_lock 的写操作里
+
+
+def _connect():
     conn = sqlite3.connect(DB_FILE, check_same_thread=False)
     conn.row_factory = sqlite3.Row  # 支持字典访问
     return conn
-def init_database():
-    """初始化数据库表结构"""
-    with db_lock:
-        # 打印数据库文件路径（用于诊断）
-        logger.info(f"📂 数据库文件路径: {DB_FILE}")
-        logger.info(f"📂 数据库文件是否存在: {os.path.exists(DB_FILE)}")
-        
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # 1. Bot配置表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bots (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bot_username TEXT UNIQUE NOT NULL,
-                token TEXT NOT NULL,
-                owner INTEGER NOT NULL,
-                welcome_msg TEXT DEFAULT '',
-                mode TEXT DEFAULT 'direct',
-                forum_group_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 1.1 添加新字段（兼容旧数据库）
+
+
+def get_connection():
+    """获取数据库连接（首次调用时打开并迁移数据库）"""
+    if not _opened:
+        open_database()
+    return _connect()
+
+
+@timed_op
+def open_database(db_file: str = None) -> int:
+    """打开数据库：设置持久化 PRAGMA、执行未应用的迁移、加载分桶登记
+
+    Args:
+        db_file: 数据库文件路径（默认 DB_FILE）
+    Returns:
+        本次应用的迁移数
+    """
+    global DB_FILE, _opened
+    with _open_lock:
+        if db_file:
+            DB_FILE = os.path.abspath(db_file)
+        logger.info(f"📂 数据库文件路径: {DB_FILE}（{'已存在' if os.path.exists(DB_FILE) else '新建'}）")
+        conn = _connect()
         try:
-            cursor.execute('ALTER TABLE bots ADD COLUMN mode TEXT DEFAULT "direct"')
-        except sqlite3.OperationalError:
-            pass  # 字段已存在
-        
+            # 删除分桶表后空闲页可以用 incremental_vacuum 逐步归还（新库立即生效，旧库执行一次 vacuum_database 后生效）
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            # WAL：读事务（含快照 create_snapshot）与写入互不阻塞；该设置持久保存在数据库文件中
+            conn.execute('PRAGMA journal_mode = WAL')
+            applied = migrate_database(conn)
+            cursor = conn.cursor()
+            _load_bucket_registry(cursor)
+            conn.commit()
+        finally:
+            conn.close()
+        _opened = True
+        return applied
+
+
+def migrate_database(conn) -> int:
+    """按版本号依次执行 MIGRATIONS 中尚未应用的迁移（每个迁移一个事务），返回应用的个数"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    current = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    applied = 0
+    # sqlite3 模块不会在 DDL 前自动开启事务（CREATE TABLE/INDEX 会各自提交），改为手动 BEGIN，
+    # 迁移失败时整体回滚，不会留下只执行了一半的结构变更
+    isolation_level, conn.isolation_level = conn.isolation_level, None
+    try:
+        for version, name, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            started = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                migrate(conn.cursor())
+                conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                logger.error(f"❌ 数据库迁移 {version}（{name}）失败")
+                raise
+            applied += 1
+            logger.info(f"✅ 数据库迁移 {version}: {name}（{time.perf_counter() - started:.2f}s）")
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+
+def close_database():
+    """关闭数据库：更新查询统计、把 WAL 合并回主文件（进程退出前调用）"""
+    global _opened
+    with _open_lock:
+        if not _opened:
+            return
         try:
-            cursor.execute('ALTER TABLE bots ADD COLUMN forum_group_id INTEGER')
-        except sqlite3.OperationalError:
-            pass  # 字段已存在
-        
-        # 2. 已验证用户表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS verified_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bot_username TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                user_name TEXT DEFAULT '',
-                user_username TEXT DEFAULT '',
-                verified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(bot_username, user_id)
-            )
-        ''')
-        
-        # 3. 消息映射表（重新设计，支持完整映射）
-        # 先检查表是否存在以及结构
-        cursor.execute('''
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name='message_mappings'
-        ''')
-        table_exists = cursor.fetchone() is not None
+            with db_lock:
+                conn = _connect()
+                conn.execute('PRAGMA optimize')
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+                conn.close()
+            logger.info("✅ 数据库已关闭")
+        except Exception as e:
+            logger.error(f"❌ 关闭数据库失败: {e}")
+        _opened = False
+
+
+def init_database():
+    """兼容旧调用：等同于 open_database()"""
+    return open_database()
+
+
+def _migrate_initial_schema(cursor):
+    """迁移 1：初始表结构（语句均可重复执行，旧库升级时按现有结构补齐）"""
+    # 1. Bot配置表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT UNIQUE NOT NULL,
+            token TEXT NOT NULL,
+            owner INTEGER NOT NULL,
+            welcome_msg TEXT DEFAULT '',
+            mode TEXT DEFAULT 'direct',
+            forum_group_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # 1.1 添加新字段（兼容旧数据库）
+    try:
+        cursor.execute('ALTER TABLE bots ADD COLUMN mode TEXT DEFAULT "direct"')
+    except sqlite3.OperationalError:
+        pass  # 字段已存在
+    
+    try:
+        cursor.execute('ALTER TABLE bots ADD COLUMN forum_group_id INTEGER')
+    except sqlite3.OperationalError:
+        pass  # 字段已存在
+    
+    # 2. 已验证用户表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS verified_users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT DEFAULT '',
+            user_username TEXT DEFAULT '',
+            verified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(bot_username, user_id)
+        )
+    ''')
+    
+    # 3. 消息映射表（重新设计，支持完整映射）
+    # 先检查表是否存在以及结构
+    cursor.execute('''
+        SELECT name FROM sqlite_master 
+        WHERE type='table' AND name='message_mappings'
+    ''')
+    table_exists = cursor.fetchone() is not None
+    
+    if table_exists:
+        # 检查是否有 map_type 列
+        cursor.execute('PRAGMA table_info(message_mappings)')
+        columns = [row[1] for row in cursor.fetchall()]
         
-        if table_exists:
-            # 检查是否有 map_type 列
-            cursor.execute('PRAGMA table_info(message_mappings)')
-            columns = [row[1] for row in cursor.fetchall()]
+        if 'map_type' not in columns:
+            # 旧表结构，需要迁移
+            logger.info("🔄 检测到旧的 message_mappings 表，正在迁移...")
             
-            if 'map_type' not in columns:
-                # 旧表结构，需要迁移
-                logger.info("🔄 检测到旧的 message_mappings 表，正在迁移...")
-                
-                # 备份旧数据
-                cursor.execute('ALTER TABLE message_mappings RENAME TO message_mappings_old')
-                
-                # 创建新表
-                cursor.execute('''
-                    CREATE TABLE message_mappings (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        bot_username TEXT NOT NULL,
-                        map_type TEXT NOT NULL CHECK(map_type IN ('direct', 'topic', 'user_forward', 'forward_user', 'owner_user')),
-                        key TEXT NOT NULL,
-                        value TEXT NOT NULL,
-                        user_id INTEGER,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                
-                # 尝试迁移旧数据（如果有的话）
-                try:
-                    cursor.execute('''
-                        INSERT INTO message_mappings (bot_username, map_type, key, value, user_id, created_at)
-                        SELECT bot_username, 'direct', key, value, user_id, created_at
-                        FROM message_mappings_old
-                    ''')
-                    logger.info("✅ 旧数据已迁移到新表")
-                except Exception as e:
-                    logger.warning(f"⚠️ 迁移旧数据失败（可能旧表为空）: {e}")
-                
-                # 删除旧表
-                cursor.execute('DROP TABLE IF EXISTS message_mappings_old')
-                logger.info("✅ message_mappings 表结构升级完成")
-        else:
-            # 表不存在，直接创建新表
+            # 备份旧数据
+            cursor.execute('ALTER TABLE message_mappings RENAME TO message_mappings_old')
+            
+            # 创建新表
             cursor.execute('''
                 CREATE TABLE message_mappings (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -136,53 +285,384 @@ def init_database():
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-        
-        # 4. 黑名单表
+            
+            # 尝试迁移旧数据（如果有的话）
+            try:
+                cursor.execute('''
+                    INSERT INTO message_mappings (bot_username, map_type, key, value, user_id, created_at)
+                    SELECT bot_username, 'direct', key, value, user_id, created_at
+                    FROM message_mappings_old
+                ''')
+                logger.info("✅ 旧数据已迁移到新表")
+            except Exception as e:
+                logger.warning(f"⚠️ 迁移旧数据失败（可能旧表为空）: {e}")
+            
+            # 删除旧表
+            cursor.execute('DROP TABLE IF EXISTS message_mappings_old')
+            logger.info("✅ message_mappings 表结构升级完成")
+    else:
+        # 表不存在，直接创建新表
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS blacklist (
+            CREATE TABLE message_mappings (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 bot_username TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                reason TEXT DEFAULT '',
-                blocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(bot_username, user_id)
-            )
-        ''')
-        
-        # 5. 全局设置表（管理员设置）
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS global_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT,
+                map_type TEXT NOT NULL CHECK(map_type IN ('direct', 'topic', 'user_forward', 'forward_user', 'owner_user')),
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                user_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
-        # 6. 创建索引加速查询（独立语句）
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_verified_users_bot 
-            ON verified_users(bot_username, user_id)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_message_mappings_lookup 
-            ON message_mappings(bot_username, map_type, key)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_message_mappings_cleanup 
-            ON message_mappings(created_at)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_blacklist_bot 
-            ON blacklist(bot_username, user_id)
+    
+    # 4. 黑名单表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blacklist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            reason TEXT DEFAULT '',
+            blocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(bot_username, user_id)
+        )
+    ''')
+    
+    # 5. 全局设置表（管理员设置）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS global_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # 5.1 Bot 健康检查结果表（后台定时检测 Token 有效性）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_health (
+            bot_username TEXT PRIMARY KEY,
+            status TEXT NOT NULL CHECK(status IN ('ok', 'invalid', 'error')),
+            error TEXT DEFAULT '',
+            latency_ms INTEGER,
+            checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 5.2 管理事件审计表（只追加，不修改）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            bot_username TEXT,
+            critical INTEGER DEFAULT 0,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 5.3 待重发队列（投递失败的消息，按退避时间重试）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbound_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT NOT NULL,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT DEFAULT '',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 5.4 死信表（多次重试仍失败的消息，等待人工重发或丢弃）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT NOT NULL,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT DEFAULT '',
+            created_at TIMESTAMP,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 5.5 映射保留策略（按映射类型；bot_username 为空表示全局，覆盖程序默认值）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            bot_username TEXT NOT NULL DEFAULT '',
+            map_type TEXT NOT NULL,
+            hours INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (bot_username, map_type)
+        )
+    ''')
+
+    # 5.6 映射分桶登记表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mapping_buckets (
+            name TEXT PRIMARY KEY,
+            map_type TEXT NOT NULL,
+            day TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 6. 创建索引加速查询（独立语句）
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_verified_users_bot 
+        ON verified_users(bot_username, user_id)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_mappings_lookup 
+        ON message_mappings(bot_username, map_type, key)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_mappings_cleanup 
+        ON message_mappings(created_at)
+    ''')
+    
+    # 按类型清理过期映射（永久保留的 topic 旧数据不会拖慢其它类型的清理）
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_mappings_expiry 
+        ON message_mappings(map_type, created_at)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_blacklist_bot 
+        ON blacklist(bot_username, user_id)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_admin_events_bot 
+        ON admin_events(bot_username, id)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbound_queue_due 
+        ON outbound_queue(next_attempt_at)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_dead_letters_bot 
+        ON dead_letters(bot_username, id)
+    ''')
+
+    # 7. 行数计数器（触发器增量维护，首次创建时按现有数据回填）
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='db_counters'")
+    counters_exist = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS db_counters (
+            scope TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, name)
+        )
+    ''')
+    _create_counter_triggers(cursor)
+    if not counters_exist:
+        _backfill_counters(cursor)
+        logger.info("✅ 统计计数器已按现有数据回填")
+
+    # 8. 增量备份：删除记录（触发器写入）和按修改时间导出用的索引
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backup_tombstones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for table in TOMBSTONE_TABLES:
+        _create_tombstone_trigger(cursor, table)
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_{table}_changed ON {table}({TRACKED_TABLES[table]})'
+        )
+
+
+def _create_tombstone_trigger(cursor, table: str):
+    """删除行时记录到 backup_tombstones（增量备份回放删除）"""
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_tombstone AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO backup_tombstones (table_name, row_id) VALUES ('{table}', OLD.id);
+        END
+    ''')
+
+
+def _migrate_pending_verifications(cursor):
+    """迁移 2：待验证记录表（原先在每次读写时 CREATE TABLE IF NOT EXISTS）"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_verifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            captcha_answer TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(bot_username, user_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_verifications_created 
+        ON pending_verifications(created_at)
+    ''')
+
+
+def _migrate_state_generation(cursor):
+    """迁移 3：内存状态代数（状态快照校验用）"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS state_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL DEFAULT 0,
+            stamp INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO state_generation (id, value, stamp) VALUES (1, 0, random())')
+    buckets = [row[0] for row in cursor.execute('SELECT name FROM mapping_buckets')]
+    _create_generation_triggers(cursor, STATE_TABLES + tuple(buckets))
+
+
+def _migrate_bucket_tombstones(cursor):
+    """迁移 4：已有映射分桶表补建删除记录触发器（新分桶由 _create_bucket_table 创建）"""
+    for (name,) in cursor.execute('SELECT name FROM mapping_buckets').fetchall():
+        _create_tombstone_trigger(cursor, name)
+
+
+# 迁移列表：(版本号, 说明, 迁移函数)，已发布的迁移不再修改，新的结构变更追加到末尾
+MIGRATIONS = [
+    (1, '初始表结构', _migrate_initial_schema),
+    (2, '待验证记录表', _migrate_pending_verifications),
+    (3, '内存状态代数', _migrate_state_generation),
+    (4, '分桶删除记录', _migrate_bucket_tombstones),
+]
+
+
+def _create_counter_triggers(cursor, tables: Dict[str, Tuple[str, str]] = None):
+    """为 COUNTED_TABLES（或指定的表）创建插入/删除触发器"""
+    for table, (scope, name) in (tables or COUNTED_TABLES).items():
+        for event, row, delta in (('INSERT', 'NEW', '+ 1'), ('DELETE', 'OLD', '- 1')):
+            scope_expr, name_expr = scope.format(row=row), name.format(row=row)
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_count_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT OR IGNORE INTO db_counters (scope, name, value) VALUES ({scope_expr}, {name_expr}, 0);
+                    UPDATE db_counters SET value = value {delta}
+                    WHERE scope = {scope_expr} AND name = {name_expr};
+                END
+            ''')
+
+
+def _create_generation_triggers(cursor, tables):
+    """为内存状态来源表创建增删改触发器：代数 +1，stamp 取新随机数
+    （整库文件被还原后代数可能回到旧值，stamp 仍然不同）"""
+    for table in tables:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_gen_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE state_generation SET value = value + 1, stamp = random() WHERE id = 1;
+                END
+            ''')
+
+
+def _bump_state_generation(cursor):
+    """DROP TABLE 不触发触发器，整桶删除时手动更新代数"""
+    cursor.execute('UPDATE state_generation SET value = value + 1, stamp = random() WHERE id = 1')
+
+
+@timed_op
+def get_state_generation() -> Optional[Tuple[int, int]]:
+    """读取内存状态代数 (value, stamp)，失败返回 None"""
+    try:
+        conn = get_connection()
+        row = conn.execute('SELECT value, stamp FROM state_generation WHERE id = 1').fetchone()
+        conn.close()
+        return (row['value'], row['stamp']) if row else None
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 读取状态代数失败: {e}")
+        return None
+
+
+def _backfill_counters(cursor):
+    """按表内现有数据重建计数器（全表扫描，只在初始化/手动校准时执行）"""
+    cursor.execute('DELETE FROM db_counters')
+    tables = dict(COUNTED_TABLES)
+    for map_type, days in _bucket_days.items():
+        for day in days:
+            tables[_bucket_name(map_type, day)] = COUNTED_TABLES['message_mappings']
+    for table, (scope, name) in tables.items():
+        scope_expr, name_expr = scope.format(row=table), name.format(row=table)
+        cursor.execute(f'''
+            INSERT INTO db_counters (scope, name, value)
+            SELECT {scope_expr}, {name_expr}, COUNT(*) FROM {table}
+            WHERE 1 GROUP BY 1, 2
+            ON CONFLICT(scope, name) DO UPDATE SET value = value + excluded.value
         ''')
-        
-        conn.commit()
+
+
+@timed_op
+def rebuild_counters() -> bool:
+    """重新校准统计计数器（计数与实际不符时手动执行）"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            _backfill_counters(conn.cursor())
+            conn.commit()
+            conn.close()
+            logger.info("✅ 统计计数器已重建")
+            return True
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 重建统计计数器失败: {e}")
+        return False
+
+
+@timed_op
+def get_counters(bot_username: str = None) -> Dict[str, Dict[str, int]]:
+    """
+    读取统计计数器（只查 db_counters 小表）
+
+    Returns:
+        {范围: {计数项: 数值}}，范围为 Bot 用户名（全局计数项范围为空字符串）；
+        计数项：bots / verified_users / blacklist / mappings:<映射类型>
+    """
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        if bot_username is None:
+            cursor.execute('SELECT scope, name, value FROM db_counters WHERE value != 0')
+        else:
+            cursor.execute('''
+                SELECT scope, name, value FROM db_counters
+                WHERE scope = ? AND value != 0
+            ''', (bot_username,))
+        rows = cursor.fetchall()
         conn.close()
-        logger.info(f"✅ 数据库初始化完成: {DB_FILE}")
+
+        counters = {}
+        for row in rows:
+            counters.setdefault(row['scope'], {})[row['name']] = row['value']
+        return counters
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 读取统计计数器失败: {e}")
+        return {}
+
+
+def _get_counter(scope: str, name: str) -> int:
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT value FROM db_counters WHERE scope = ? AND name = ?', (scope, name))
+    row = cursor.fetchone()
+    conn.close()
+    return row['value'] if row else 0
 # ================== Bot 配置管理 ==================
+@timed_op
 def add_bot(bot_username: str, token: str, owner: int, welcome_msg: str = '') -> bool:
     """添加新机器人"""
     try:
@@ -202,10 +682,12 @@ def add_bot(bot_username: str, token: str, owner: int, welcome_msg: str = '') ->
         logger.warning(f"⚠️ Bot 已存在: {bot_username}")
         return False
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 添加 Bot 失败: {e}")
         import traceback
         traceback.print_exc()
         return False
+@timed_op
 def get_bot(bot_username: str) -> Optional[Dict]:
     """获取单个机器人信息"""
     try:
@@ -225,8 +707,10 @@ def get_bot(bot_username: str) -> Optional[Dict]:
             }
         return None
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询 Bot 失败: {e}")
         return None
+@timed_op
 def get_all_bots() -> Dict[str, Dict]:
     """获取所有机器人（返回字典格式）"""
     try:
@@ -237,23 +721,17 @@ def get_all_bots() -> Dict[str, Dict]:
         rows = cursor.fetchall()
         conn.close()
         
-        bots = {}
-        for row in rows:
-            bots[row['bot_username']] = {
-                'token': row['token'],
-                'owner': row['owner'],
-                'welcome_msg': row['welcome_msg'] or '',
-                'mode': row['mode'] if row['mode'] else 'direct',
-                'forum_group_id': row['forum_group_id']
-            }
+        bots = {row['bot_username']: _bot_config(row) for row in rows}
         
         logger.info(f"📊 从数据库读取了 {len(bots)} 个 Bot")
         return bots
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询所有 Bot 失败: {e}")
         import traceback
         traceback.print_exc()
         return {}
+@timed_op
 def update_bot_welcome(bot_username: str, welcome_msg: str) -> bool:
     """更新欢迎消息"""
     try:
@@ -274,10 +752,12 @@ def update_bot_welcome(bot_username: str, welcome_msg: str) -> bool:
                 return True
             return False
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 更新欢迎消息失败: {e}")
         return False
 
 
+@timed_op
 def update_bot_mode(bot_username: str, mode: str) -> bool:
     """更新机器人模式（direct/forum）"""
     try:
@@ -298,10 +778,12 @@ def update_bot_mode(bot_username: str, mode: str) -> bool:
                 return True
             return False
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 更新模式失败: {e}")
         return False
 
 
+@timed_op
 def update_bot_forum_id(bot_username: str, forum_group_id: int) -> bool:
     """更新话题群ID"""
     try:
@@ -322,8 +804,10 @@ def update_bot_forum_id(bot_username: str, forum_group_id: int) -> bool:
                 return True
             return False
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 更新话题群ID失败: {e}")
         return False
+@timed_op
 def delete_bot(bot_username: str) -> bool:
     """删除机器人及其关联数据"""
     try:
@@ -334,9 +818,20 @@ def delete_bot(bot_username: str) -> bool:
             # 删除关联的已验证用户
             cursor.execute('DELETE FROM verified_users WHERE bot_username = ?', (bot_username,))
             
-            # 删除关联的消息映射
-            cursor.execute('DELETE FROM message_mappings WHERE bot_username = ?', (bot_username,))
-            
+            # 删除关联的消息映射（含各分桶）
+            for table in _all_mapping_tables():
+                cursor.execute(f'DELETE FROM {table} WHERE bot_username = ?', (bot_username,))
+
+            # 删除健康检查记录
+            cursor.execute('DELETE FROM bot_health WHERE bot_username = ?', (bot_username,))
+
+            # 删除待重发消息和死信
+            cursor.execute('DELETE FROM outbound_queue WHERE bot_username = ?', (bot_username,))
+            cursor.execute('DELETE FROM dead_letters WHERE bot_username = ?', (bot_username,))
+
+            # 删除按 Bot 设置的保留策略
+            cursor.execute('DELETE FROM retention_policies WHERE bot_username = ?', (bot_username,))
+
             # 删除 Bot
             cursor.execute('DELETE FROM bots WHERE bot_username = ?', (bot_username,))
             
@@ -349,8 +844,10 @@ def delete_bot(bot_username: str) -> bool:
                 return True
             return False
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 删除 Bot 失败: {e}")
         return False
+@timed_op
 def get_bots_by_owner(owner: int) -> List[Dict]:
     """获取某个用户的所有机器人"""
     try:
@@ -370,9 +867,65 @@ def get_bots_by_owner(owner: int) -> List[Dict]:
         
         return bots
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询用户 Bot 失败: {e}")
         return []
+# ================== Bot 健康检查 ==================
+@timed_op
+def save_bot_health(results: List[Dict]) -> bool:
+    """
+    批量保存健康检查结果（单个事务）
+
+    Args:
+        results: [{'bot_username', 'status', 'error', 'latency_ms'}, ...]
+                 status 取值: 'ok' 正常 / 'invalid' Token 失效 / 'error' 检测异常（网络等）
+    """
+    if not results:
+        return True
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR REPLACE INTO bot_health
+                (bot_username, status, error, latency_ms, checked_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', [
+                (r['bot_username'], r['status'], r.get('error', ''), r.get('latency_ms'))
+                for r in results
+            ])
+            conn.commit()
+            conn.close()
+            return True
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 保存健康检查结果失败: {e}")
+        return False
+@timed_op
+def get_all_bot_health() -> Dict[str, Dict]:
+    """获取所有 Bot 最近一次健康检查结果 {bot_username: {...}}"""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM bot_health')
+        rows = cursor.fetchall()
+        conn.close()
+
+        return {
+            row['bot_username']: {
+                'status': row['status'],
+                'error': row['error'] or '',
+                'latency_ms': row['latency_ms'],
+                'checked_at': row['checked_at']
+            }
+            for row in rows
+        }
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 查询健康检查结果失败: {e}")
+        return {}
 # ================== 用户验证管理 ==================
+@timed_op
 def is_verified(bot_username: str, user_id: int) -> bool:
     """检查用户是否已验证"""
     try:
@@ -386,26 +939,35 @@ def is_verified(bot_username: str, user_id: int) -> bool:
         conn.close()
         return exists
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 检查验证状态失败: {e}")
         return False
+@timed_op
 def add_verified_user(bot_username: str, user_id: int, user_name: str = '', user_username: str = '') -> bool:
     """添加已验证用户"""
     try:
         with db_lock:
             conn = get_connection()
             cursor = conn.cursor()
+            # 用 UPSERT 而不是 INSERT OR REPLACE：REPLACE 删除旧行时不触发删除触发器，计数会偏大
             cursor.execute('''
-                INSERT OR REPLACE INTO verified_users 
+                INSERT INTO verified_users 
                 (bot_username, user_id, user_name, user_username, verified_at)
                 VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(bot_username, user_id) DO UPDATE SET
+                    user_name = excluded.user_name,
+                    user_username = excluded.user_username,
+                    verified_at = excluded.verified_at
             ''', (bot_username, user_id, user_name, user_username))
             conn.commit()
             conn.close()
             logger.info(f"✅ 添加验证用户: {bot_username} - {user_id}")
             return True
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 添加验证用户失败: {e}")
         return False
+@timed_op
 def remove_verified_user(bot_username: str, user_id: int) -> bool:
     """移除验证用户"""
     try:
@@ -425,8 +987,10 @@ def remove_verified_user(bot_username: str, user_id: int) -> bool:
                 return True
             return False
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 移除验证用户失败: {e}")
         return False
+@timed_op
 def get_verified_users(bot_username: str) -> List[Dict]:
     """获取某个 Bot 的所有已验证用户"""
     try:
@@ -452,27 +1016,23 @@ def get_verified_users(bot_username: str) -> List[Dict]:
         
         return users
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询验证用户失败: {e}")
         return []
+@timed_op
 def get_verified_count(bot_username: str) -> int:
-    """获取已验证用户数量"""
+    """获取已验证用户数量（读计数器）"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM verified_users 
-            WHERE bot_username = ?
-        ''', (bot_username,))
-        count = cursor.fetchone()['count']
-        conn.close()
-        return count
+        return _get_counter(bot_username, 'verified_users')
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 统计验证用户失败: {e}")
         return 0
 
 
 # ================== 黑名单管理 ==================
 
+@timed_op
 def is_blacklisted(bot_username: str, user_id: int) -> bool:
     """检查用户是否在黑名单中"""
     try:
@@ -486,10 +1046,12 @@ def is_blacklisted(bot_username: str, user_id: int) -> bool:
         conn.close()
         return exists
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 检查黑名单状态失败: {e}")
         return False
 
 
+@timed_op
 def add_to_blacklist(bot_username: str, user_id: int, reason: str = '') -> bool:
     """添加用户到黑名单"""
     try:
@@ -497,19 +1059,24 @@ def add_to_blacklist(bot_username: str, user_id: int, reason: str = '') -> bool:
             conn = get_connection()
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT OR REPLACE INTO blacklist 
+                INSERT INTO blacklist 
                 (bot_username, user_id, reason, blocked_at)
                 VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(bot_username, user_id) DO UPDATE SET
+                    reason = excluded.reason,
+                    blocked_at = excluded.blocked_at
             ''', (bot_username, user_id, reason))
             conn.commit()
             conn.close()
             logger.info(f"✅ 添加黑名单用户: {bot_username} - {user_id}")
             return True
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 添加黑名单用户失败: {e}")
         return False
 
 
+@timed_op
 def remove_from_blacklist(bot_username: str, user_id: int) -> bool:
     """从黑名单移除用户"""
     try:
@@ -529,10 +1096,12 @@ def remove_from_blacklist(bot_username: str, user_id: int) -> bool:
                 return True
             return False
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 移除黑名单用户失败: {e}")
         return False
 
 
+@timed_op
 def get_blacklist(bot_username: str) -> List[int]:
     """获取某个 Bot 的黑名单用户ID列表"""
     try:
@@ -548,73 +1117,263 @@ def get_blacklist(bot_username: str) -> List[int]:
         
         return [row['user_id'] for row in rows]
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询黑名单失败: {e}")
         return []
 
 
+@timed_op
 def get_blacklist_count(bot_username: str) -> int:
-    """获取黑名单用户数量"""
+    """获取黑名单用户数量（读计数器）"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM blacklist 
-            WHERE bot_username = ?
-        ''', (bot_username,))
-        count = cursor.fetchone()['count']
-        conn.close()
-        return count
+        return _get_counter(bot_username, 'blacklist')
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 统计黑名单用户失败: {e}")
         return 0
 
 
-# ================== 消息映射管理（新版：支持完整映射结构）==================
+# ================== 映射分桶（按天分表）==================
 
-def set_mapping(bot_username: str, map_type: str, key: str, value: str, user_id: int = None) -> bool:
-    """
-    设置消息映射
-    
-    Args:
-        bot_username: Bot用户名
-        map_type: 映射类型 ('direct', 'topic', 'user_forward', 'forward_user', 'owner_user')
-        key: 映射键
-        value: 映射值（对于 topic 类型，这里是 topic_id 的字符串形式）
-        user_id: 关联的用户ID（可选，用于清理）
-    
-    映射类型说明：
-    - direct: 主人的被转发消息ID -> 用户ID (直连模式)
-    - topic: 用户ID -> 话题ID (话题模式)
-    - user_forward: 用户消息ID -> 转发后的消息ID
-    - forward_user: 转发消息ID -> 用户消息ID
-    - owner_user: 主人消息ID -> 发送给用户的消息ID
-    """
+def _bucket_name(map_type: str, day: str) -> str:
+    return f"mm_{map_type}_{day}"
+
+
+def _load_bucket_registry(cursor):
+    """从 mapping_buckets 加载分桶列表（表已不存在的登记项一并清理）"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'mm\\_%' ESCAPE '\\'")
+    existing = {row[0] for row in cursor.fetchall()}
+    cursor.execute('SELECT name, map_type, day FROM mapping_buckets ORDER BY day')
+    _bucket_days.clear()
+    for name, map_type, day in cursor.fetchall():
+        if name in existing:
+            _bucket_days.setdefault(map_type, []).append(day)
+        else:
+            cursor.execute('DELETE FROM mapping_buckets WHERE name = ?', (name,))
+
+
+def _create_bucket_table(cursor, name: str):
+    """创建分桶表及其计数触发器（已存在则跳过）"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY,
+            bot_username TEXT NOT NULL,
+            map_type TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            user_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(bot_username, map_type, key)
+        )
+    ''')
+    _create_counter_triggers(cursor, {name: COUNTED_TABLES['message_mappings']})
+    _create_generation_triggers(cursor, (name,))
+    _create_tombstone_trigger(cursor, name)
+
+
+def _ensure_bucket(cursor, map_type: str) -> str:
+    """返回当天的分桶表名，不存在则创建（调用方持有 db_lock）"""
+    day = time.strftime('%Y%m%d', time.gmtime())
+    name = _bucket_name(map_type, day)
+    days = _bucket_days.setdefault(map_type, [])
+    if days and days[-1] == day:
+        return name
+    _create_bucket_table(cursor, name)
+    cursor.execute(
+        'INSERT OR IGNORE INTO mapping_buckets (name, map_type, day) VALUES (?, ?, ?)', (name, map_type, day)
+    )
+    if day not in days:
+        days.append(day)
+        days.sort()
+    logger.info(f"🗂 创建映射分桶: {name}")
+    return name
+
+
+def _mapping_tables(map_type: str) -> List[str]:
+    """某类型映射所在的表，从新到旧：各分桶，最后是 message_mappings（旧数据 / 不分桶的类型）"""
+    if map_type not in BUCKETED_MAP_TYPES:
+        return ['message_mappings']
+    days = list(_bucket_days.get(map_type, ()))
+    return [_bucket_name(map_type, day) for day in reversed(days)] + ['message_mappings']
+
+
+def _select_mapping_rows(cursor, table: str, sql: str, params: tuple) -> list:
+    """查询一张映射表（{table} 为表名占位）；不持有 db_lock 读取时分桶可能刚被 drop_bucket 删除，按空表处理"""
     try:
-        with db_lock:
-            conn = get_connection()
-            cursor = conn.cursor()
-            
-            # 先删除旧记录（确保唯一性）
-            cursor.execute('''
-                DELETE FROM message_mappings 
-                WHERE bot_username = ? AND map_type = ? AND key = ?
-            ''', (bot_username, map_type, key))
+        return cursor.execute(sql.format(table=table), params).fetchall()
+    except sqlite3.OperationalError as e:
+        if table != 'message_mappings' and 'no such table' in str(e):
+            return []
+        raise
+
+
+def _all_mapping_tables() -> List[str]:
+    return ['message_mappings'] + [
+        _bucket_name(map_type, day) for map_type, days in list(_bucket_days.items()) for day in list(days)
+    ]
+
+
+@timed_op
+def list_expired_buckets(retention: Dict[str, Optional[int]]) -> List[Tuple[str, str, str]]:
+    """
+    可以整桶删除的分桶：分桶结束时间早于该类型所有生效策略（全局和按 Bot）中最长的保留期
+
+    Returns:
+        [(表名, 映射类型, 日期)]
+    """
+    policies = get_retention_policies()
+    effective = {**retention, **policies.get('', {})}
+    expired = []
+    now = time.time()
+    for map_type in BUCKETED_MAP_TYPES:
+        hours = [effective.get(map_type)] + [
+            items[map_type] for bot, items in policies.items() if bot and map_type in items
+        ]
+        if any(not h for h in hours):
+            continue  # 有永久保留的策略，只能按行清理
+        cutoff = now - max(hours) * 3600
+        for day in list(_bucket_days.get(map_type, ())):
+            day_end = calendar.timegm(time.strptime(day, '%Y%m%d')) + 86400
+            if day_end <= cutoff:
+                expired.append((_bucket_name(map_type, day), map_type, day))
+    return expired
+
+
+@timed_op
+def get_bucket_rows(name: str, after_id: int = 0, limit: int = 1000) -> List[Tuple[int, str, str, str, str]]:
+    """按 id 分页读取分桶中的行（删除分桶前同步内存映射用）"""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT id, bot_username, map_type, key, value FROM {name}
+            WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after_id, limit))
+        rows = [tuple(row) for row in cursor.fetchall()]
+        conn.close()
+        return rows
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 读取分桶 {name} 失败: {e}")
+        return []
+
+
+@timed_op
+def drop_bucket(name: str) -> int:
+    """整桶删除（DROP TABLE 不触发删除触发器，先按 Bot 扣减计数器），返回删除的行数"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT map_type, day FROM mapping_buckets WHERE name = ?', (name,))
+            registered = cursor.fetchone()
+            if registered is None:
+                conn.close()
+                return 0
+            map_type, day = registered['map_type'], registered['day']
+            cursor.execute(f'SELECT bot_username, COUNT(*) AS n FROM {name} GROUP BY bot_username')
+            counts = cursor.fetchall()
+            cursor.executemany(
+                'UPDATE db_counters SET value = value - ? WHERE scope = ? AND name = ?',
+                [(row['n'], row['bot_username'], f'mappings:{map_type}') for row in counts]
+            )
+            cursor.execute(f'DROP TABLE IF EXISTS {name}')
+            cursor.execute('DELETE FROM mapping_buckets WHERE name = ?', (name,))
+            _bump_state_generation(cursor)
+            conn.commit()
+            conn.close()
+            if day in _bucket_days.get(map_type, []):
+                _bucket_days[map_type].remove(day)
+            deleted = sum(row['n'] for row in counts)
+            logger.info(f"🗑 删除过期映射分桶 {name}（{deleted} 行）")
+            return deleted
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 删除映射分桶 {name} 失败: {e}")
+        return 0
+
+
+@timed_op
+def incremental_vacuum(pages: int = 1000) -> int:
+    """归还最多 pages 个空闲页给文件系统（auto_vacuum=INCREMENTAL 时有效），返回归还的页数"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+            after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            conn.commit()
+            conn.close()
+            return before - after
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 增量回收空间失败: {e}")
+        return 0
+
+
+# ================== 消息映射管理（新版：支持完整映射结构）==================
+
+@timed_op
+def set_mapping(bot_username: str, map_type: str, key: str, value: str, user_id: int = None) -> bool:
+    """
+    设置消息映射
+    
+    Args:
+        bot_username: Bot用户名
+        map_type: 映射类型 ('direct', 'topic', 'user_forward', 'forward_user', 'owner_user')
+        key: 映射键
+        value: 映射值（对于 topic 类型，这里是 topic_id 的字符串形式）
+        user_id: 关联的用户ID（可选，用于清理）
+    
+    映射类型说明：
+    - direct: 主人的被转发消息ID -> 用户ID (直连模式)
+    - topic: 用户ID -> 话题ID (话题模式)
+    - user_forward: 用户消息ID -> 转发后的消息ID
+    - forward_user: 转发消息ID -> 用户消息ID
+    - owner_user: 主人消息ID -> 发送给用户的消息ID
+    """
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
             
-            # 插入新记录
-            cursor.execute('''
-                INSERT INTO message_mappings 
-                (bot_username, map_type, key, value, user_id, updated_at)
-                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (bot_username, map_type, key, value, user_id))
+            if map_type in BUCKETED_MAP_TYPES:
+                # 写入当天分桶；旧分桶里的同名键由查询时“新桶优先”覆盖，不逐个删除
+                bucket = _ensure_bucket(cursor, map_type)
+                cursor.execute(f'''
+                    INSERT INTO {bucket} 
+                    (bot_username, map_type, key, value, user_id, updated_at)
+                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(bot_username, map_type, key) DO UPDATE SET
+                        value = excluded.value,
+                        user_id = excluded.user_id,
+                        updated_at = excluded.updated_at
+                ''', (bot_username, map_type, key, value, user_id))
+            else:
+                # 先删除旧记录（确保唯一性）
+                cursor.execute('''
+                    DELETE FROM message_mappings 
+                    WHERE bot_username = ? AND map_type = ? AND key = ?
+                ''', (bot_username, map_type, key))
+                
+                # 插入新记录
+                cursor.execute('''
+                    INSERT INTO message_mappings 
+                    (bot_username, map_type, key, value, user_id, updated_at)
+                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ''', (bot_username, map_type, key, value, user_id))
             
             conn.commit()
             conn.close()
             return True
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 设置映射失败: {e}")
         return False
 
 
+@timed_op
 def get_mapping(bot_username: str, map_type: str, key: str) -> Optional[str]:
     """
     获取消息映射值
@@ -631,21 +1390,27 @@ def get_mapping(bot_username: str, map_type: str, key: str) -> Optional[str]:
         conn = get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT value FROM message_mappings 
-            WHERE bot_username = ? AND map_type = ? AND key = ?
-            ORDER BY updated_at DESC LIMIT 1
-        ''', (bot_username, map_type, key))
-        
-        row = cursor.fetchone()
+        # 从最新的分桶往旧查，命中即返回
+        row = None
+        for table in _mapping_tables(map_type):
+            rows = _select_mapping_rows(cursor, table, '''
+                SELECT value FROM {table} 
+                WHERE bot_username = ? AND map_type = ? AND key = ?
+                ORDER BY updated_at DESC LIMIT 1
+            ''', (bot_username, map_type, key))
+            if rows:
+                row = rows[0]
+                break
         conn.close()
         
         return row['value'] if row else None
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询映射失败: {e}")
         return None
 
 
+@timed_op
 def get_all_mappings(bot_username: str, map_type: str) -> Dict[str, str]:
     """
     获取某个Bot某种类型的所有映射
@@ -661,23 +1426,25 @@ def get_all_mappings(bot_username: str, map_type: str) -> Dict[str, str]:
         conn = get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT key, value FROM message_mappings 
-            WHERE bot_username = ? AND map_type = ?
-            ORDER BY updated_at DESC
-        ''', (bot_username, map_type))
-        
-        rows = cursor.fetchall()
+        # 从旧到新合并，新分桶中的同名键覆盖旧值
+        mappings = {}
+        for table in reversed(_mapping_tables(map_type)):
+            rows = _select_mapping_rows(cursor, table, '''
+                SELECT key, value FROM {table} 
+                WHERE bot_username = ? AND map_type = ?
+                ORDER BY updated_at
+            ''', (bot_username, map_type))
+            mappings.update((row['key'], row['value']) for row in rows)
         conn.close()
         
-        # 转换为字典
-        mappings = {row['key']: row['value'] for row in rows}
         return mappings
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询所有映射失败: {e}")
         return {}
 
 
+@timed_op
 def delete_mapping(bot_username: str, map_type: str, key: str) -> bool:
     """删除指定映射"""
     try:
@@ -685,21 +1452,25 @@ def delete_mapping(bot_username: str, map_type: str, key: str) -> bool:
             conn = get_connection()
             cursor = conn.cursor()
             
-            cursor.execute('''
-                DELETE FROM message_mappings 
-                WHERE bot_username = ? AND map_type = ? AND key = ?
-            ''', (bot_username, map_type, key))
+            affected = 0
+            for table in _mapping_tables(map_type):
+                cursor.execute(f'''
+                    DELETE FROM {table} 
+                    WHERE bot_username = ? AND map_type = ? AND key = ?
+                ''', (bot_username, map_type, key))
+                affected += cursor.rowcount
             
             conn.commit()
-            affected = cursor.rowcount
             conn.close()
             
             return affected > 0
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 删除映射失败: {e}")
         return False
 
 
+@timed_op
 def clear_bot_mappings(bot_username: str) -> int:
     """清空某个Bot的所有映射"""
     try:
@@ -707,12 +1478,14 @@ def clear_bot_mappings(bot_username: str) -> int:
             conn = get_connection()
             cursor = conn.cursor()
             
-            cursor.execute('''
-                DELETE FROM message_mappings 
-                WHERE bot_username = ?
-            ''', (bot_username,))
+            deleted = 0
+            for table in _all_mapping_tables():
+                cursor.execute(f'''
+                    DELETE FROM {table} 
+                    WHERE bot_username = ?
+                ''', (bot_username,))
+                deleted += cursor.rowcount
             
-            deleted = cursor.rowcount
             conn.commit()
             conn.close()
             
@@ -720,12 +1493,14 @@ def clear_bot_mappings(bot_username: str) -> int:
                 logger.info(f"🧹 清空 {bot_username} 的 {deleted} 条映射")
             return deleted
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 清空映射失败: {e}")
         return 0
 
 
+@timed_op
 def cleanup_old_mappings(days: int = 7) -> int:
-    """清理旧的消息映射（防止数据库过大）"""
+    """清理旧的消息映射（防止数据库过大；只处理 message_mappings 主表，分桶由 drop_bucket 整桶删除）"""
     try:
         with db_lock:
             conn = get_connection()
@@ -742,9 +1517,226 @@ def cleanup_old_mappings(days: int = 7) -> int:
                 logger.info(f"🧹 清理 {deleted} 条旧消息映射")
             return deleted
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 清理消息映射失败: {e}")
         return 0
+# ================== 映射保留策略 ==================
+
+@timed_op
+def get_retention_policies() -> Dict[str, Dict[str, Optional[int]]]:
+    """
+    读取保留策略覆盖项
+
+    Returns:
+        {bot_username: {map_type: 保留小时数}}，bot_username 为空字符串表示全局；
+        小时数为 None 表示永久保留
+    """
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT bot_username, map_type, hours FROM retention_policies')
+        rows = cursor.fetchall()
+        conn.close()
+
+        policies = {}
+        for row in rows:
+            policies.setdefault(row['bot_username'], {})[row['map_type']] = row['hours']
+        return policies
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 查询保留策略失败: {e}")
+        return {}
+
+
+@timed_op
+def set_retention_policy(map_type: str, hours: Optional[int], bot_username: str = '') -> bool:
+    """设置保留策略（hours 为 None 表示永久保留，bot_username 为空表示全局）"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO retention_policies (bot_username, map_type, hours, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(bot_username, map_type) DO UPDATE SET
+                    hours = excluded.hours,
+                    updated_at = excluded.updated_at
+            ''', (bot_username, map_type, hours))
+            conn.commit()
+            conn.close()
+            logger.info(f"✅ 设置保留策略: {bot_username or '全局'} {map_type} = {hours if hours is not None else '永久'}")
+            return True
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 设置保留策略失败: {e}")
+        return False
+
+
+@timed_op
+def delete_retention_policy(map_type: str, bot_username: str = '') -> bool:
+    """删除保留策略覆盖项（恢复为上一级的默认值）"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM retention_policies
+                WHERE bot_username = ? AND map_type = ?
+            ''', (bot_username, map_type))
+            conn.commit()
+            affected = cursor.rowcount
+            conn.close()
+            return affected > 0
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 删除保留策略失败: {e}")
+        return False
+
+
+def resolve_retention(defaults: Dict[str, Optional[int]], policies: Dict[str, Dict[str, Optional[int]]]) -> List[Tuple]:
+    """
+    合并程序默认值、全局覆盖和按 Bot 覆盖，得到清理规则
+
+    Returns:
+        [(bot_username 或 None, map_type, 保留小时数, 需要排除的 Bot 列表)]，永久保留的类型不产生规则
+    """
+    effective = {**defaults, **policies.get('', {})}
+    rules = []
+    for map_type, hours in effective.items():
+        overridden = [bot for bot, items in policies.items() if bot and map_type in items]
+        if hours:
+            rules.append((None, map_type, hours, overridden))
+    for bot, items in policies.items():
+        if not bot:
+            continue
+        for map_type, hours in items.items():
+            if hours:
+                rules.append((bot, map_type, hours, []))
+    return rules
+
+
+@timed_op
+def prune_expired_mappings(retention: Dict[str, Optional[int]], limit: int = 500) -> List[Tuple[str, str, str, str]]:
+    """
+    按保留策略删除一批过期映射（最多 limit 条）
+
+    每批单独持锁、单独提交，调用方在批次之间让出，避免一次大 DELETE 长时间占用 db_lock。
+
+    Args:
+        retention: 各映射类型的默认保留小时数（None / 0 表示永久保留），
+                   retention_policies 表中的全局和按 Bot 覆盖项优先
+
+    Returns:
+        被删除的 (bot_username, map_type, key, value) 列表，供调用方同步移除内存映射
+    """
+    try:
+        rules = resolve_retention(retention, get_retention_policies())
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            deleted = []
+            for bot_username, map_type, hours, excluded in rules:
+                if len(deleted) >= limit:
+                    break
+                cutoff = time.time() - hours * 3600
+                for table in reversed(_mapping_tables(map_type)):
+                    if len(deleted) >= limit:
+                        break
+                    if table == 'message_mappings':
+                        age_filter = "AND created_at < datetime('now', '-' || ? || ' hours') ORDER BY created_at"
+                        age_args = (hours,)
+                    else:
+                        # 分桶按天清理：只处理整桶都已过期的分桶（精度为一天）
+                        day = table.rsplit('_', 1)[1]
+                        if calendar.timegm(time.strptime(day, '%Y%m%d')) + 86400 > cutoff:
+                            continue
+                        age_filter, age_args = '', ()
+                    if bot_username is None:
+                        placeholders = ','.join('?' * len(excluded))
+                        bot_filter = f'AND bot_username NOT IN ({placeholders})' if excluded else ''
+                        bot_args = tuple(excluded)
+                    else:
+                        bot_filter, bot_args = 'AND bot_username = ?', (bot_username,)
+                    cursor.execute(f'''
+                        SELECT id, bot_username, map_type, key, value FROM {table}
+                        WHERE map_type = ? {bot_filter} {age_filter}
+                        LIMIT ?
+                    ''', (map_type, *bot_args, *age_args, limit - len(deleted)))
+                    rows = cursor.fetchall()
+                    if rows:
+                        cursor.executemany(f'DELETE FROM {table} WHERE id = ?', [(row['id'],) for row in rows])
+                        deleted.extend(rows)
+            if deleted:
+                conn.commit()
+            conn.close()
+            return [(row['bot_username'], row['map_type'], row['key'], row['value']) for row in deleted]
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 分批清理消息映射失败: {e}")
+        return []
+# ================== 启动预热加载 ==================
+
+def _bot_config(row) -> Dict:
+    return {
+        'token': row['token'],
+        'owner': row['owner'],
+        'welcome_msg': row['welcome_msg'] or '',
+        'mode': row['mode'] if row['mode'] else 'direct',
+        'forum_group_id': row['forum_group_id']
+    }
+
+
+@timed_op
+def load_state(batch_size: int = 5000) -> Dict:
+    """一次读出全部 Bot 配置和消息映射（宿主程序启动预热用）
+
+    同一连接、同一读事务内每张表一条有序查询，用 fetchmany 分批读取并直接按 Bot / 类型归类；
+    message_mappings 在前、分桶按日期从旧到新，后读到的同名键覆盖先读到的（与 get_mapping 的新桶优先一致）。
+
+    Returns:
+        {'bots': 同 get_all_bots(), 'mappings': {bot: {map_type: {key: value}}},
+         'rows': 映射行数, 'timings': {阶段: 秒}}
+    """
+    started = time.perf_counter()
+    conn = get_connection()
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN')  # 读事务：Bot 与映射处于同一时刻
+        bots = {row['bot_username']: _bot_config(row) for row in conn.execute('SELECT * FROM bots ORDER BY created_at')}
+        buckets = [row['name'] for row in conn.execute('SELECT name FROM mapping_buckets ORDER BY day, name')]
+        timings = {'bots': time.perf_counter() - started}
+
+        phase_started = time.perf_counter()
+        conn.row_factory = None  # 映射行直接按元组解包
+        mappings = {bot_username: {} for bot_username in bots}
+        rows = 0
+        tables = [('message_mappings', 'ORDER BY updated_at')] + [(name, 'ORDER BY id') for name in buckets]
+        for table, order in tables:
+            cursor = conn.execute(f'SELECT bot_username, map_type, key, value FROM {table} {order}')
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                rows += len(batch)
+                for bot_username, map_type, key, value in batch:
+                    per_bot = mappings.get(bot_username)
+                    if per_bot is None:
+                        continue  # 已删除 Bot 的残留行
+                    target = per_bot.get(map_type)
+                    if target is None:
+                        target = per_bot[map_type] = {}
+                    target[key] = value
+        conn.execute('COMMIT')
+        timings['mappings'] = time.perf_counter() - phase_started
+    finally:
+        conn.close()
+    logger.info(f"📖 预热读取 {len(bots)} 个 Bot、{rows} 条映射（{len(tables)} 张表），"
+                f"耗时 {time.perf_counter() - started:.3f}s")
+    return {'bots': bots, 'mappings': mappings, 'rows': rows, 'timings': timings}
+
+
 # ================== JSON 数据迁移 ==================
+@timed_op
 def migrate_from_json():
     """从旧版 JSON 文件迁移数据到数据库"""
     import json
@@ -788,44 +1780,116 @@ def migrate_from_json():
         logger.info(f"📦 旧文件已备份到: {backup_file}")
         
     except Exception as e:
+        _report_error()
         logger.error(f"❌ JSON 数据迁移失败: {e}")
         import traceback
         traceback.print_exc()
         raise
 
 # ================== 数据库维护 ==================
+@timed_op
 def vacuum_database():
     """压缩数据库（释放空间）"""
     try:
         conn = get_connection()
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')  # 旧库在 VACUUM 后切换为增量回收
         conn.execute('VACUUM')
         conn.close()
         logger.info("✅ 数据库压缩完成")
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 数据库压缩失败: {e}")
-def get_database_stats() -> Dict:
-    """获取数据库统计信息"""
+@timed_op
+def create_snapshot(dest_path: str) -> Optional[Dict]:
+    """在线生成一致性快照（供备份使用，不停止写入）
+
+    使用 VACUUM INTO 在一个读事务内导出整库（顺带压缩、不含 WAL），
+    旧版 SQLite（< 3.27）退回在线备份 API。先写同目录临时文件，校验通过后原子替换 dest_path。
+    不持有 db_lock，耗时与库大小成正比，异步代码中应放到工作线程执行。
+
+    Returns:
+        {'path', 'bytes', 'seconds', 'method'}，失败返回 None
+    """
+    started = time.perf_counter()
+    dest_path = os.path.abspath(dest_path)
+    tmp_path = f"{dest_path}.tmp-{os.getpid()}"
     try:
+        for leftover in (tmp_path, tmp_path + '-journal'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
         conn = get_connection()
-        cursor = conn.cursor()
-        
-        stats = {}
-        
-        # Bot 数量
-        cursor.execute('SELECT COUNT(*) as count FROM bots')
-        stats['total_bots'] = cursor.fetchone()['count']
-        
-        # 验证用户数量
-        cursor.execute('SELECT COUNT(*) as count FROM verified_users')
-        stats['total_verified_users'] = cursor.fetchone()['count']
-        
-        # 黑名单用户数量
-        cursor.execute('SELECT COUNT(*) as count FROM blacklist')
-        stats['total_blacklisted_users'] = cursor.fetchone()['count']
+        try:
+            if sqlite3.sqlite_version_info >= (3, 27, 0):
+                conn.execute('VACUUM INTO ?', (tmp_path,))
+                method = 'vacuum_into'
+            else:
+                target = sqlite3.connect(tmp_path)
+                try:
+                    conn.backup(target)
+                finally:
+                    target.close()
+                method = 'backup'
+        finally:
+            conn.close()
+
+        check = sqlite3.connect(tmp_path)
+        try:
+            result = check.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            check.close()
+        if result != 'ok':
+            raise sqlite3.DatabaseError(f"快照校验失败: {result}")
+
+        os.replace(tmp_path, dest_path)
+        snapshot = {
+            'path': dest_path,
+            'bytes': os.path.getsize(dest_path),
+            'seconds': round(time.perf_counter() - started, 3),
+            'method': method,
+        }
+        logger.info(f"✅ 数据库快照完成: {dest_path} ({snapshot['bytes'] / 1024:.1f} KB, {snapshot['seconds']}s, {method})")
+        return snapshot
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 生成数据库快照失败: {e}")
+        try:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        except OSError:
+            pass
+        return None
+@timed_op
+def get_database_stats() -> Dict:
+    """获取数据库统计信息（读计数器，不扫描大表）"""
+    try:
+        counters = get_counters()
+        stats = {
+            'total_bots': counters.get('', {}).get('bots', 0),
+            'total_verified_users': 0,
+            'total_blacklisted_users': 0,
+            'total_message_mappings': 0,
+            'mappings_by_type': {},
+            'per_bot': {},
+        }
+
+        for scope, items in counters.items():
+            if not scope:
+                continue
+            per_bot = stats['per_bot'][scope] = {
+                'verified_users': items.get('verified_users', 0),
+                'blacklisted_users': items.get('blacklist', 0),
+                'message_mappings': {},
+            }
+            stats['total_verified_users'] += per_bot['verified_users']
+            stats['total_blacklisted_users'] += per_bot['blacklisted_users']
+            for name, value in items.items():
+                if name.startswith('mappings:'):
+                    map_type = name.split(':', 1)[1]
+                    per_bot['message_mappings'][map_type] = value
+                    stats['mappings_by_type'][map_type] = stats['mappings_by_type'].get(map_type, 0) + value
+                    stats['total_message_mappings'] += value
         
-        # 消息映射数量
-        cursor.execute('SELECT COUNT(*) as count FROM message_mappings')
-        stats['total_message_mappings'] = cursor.fetchone()['count']
+        stats['mapping_buckets'] = sum(len(days) for days in _bucket_days.values())
         
         # 数据库文件大小
         if os.path.exists(DB_FILE):
@@ -833,13 +1897,286 @@ def get_database_stats() -> Dict:
         else:
             stats['db_size_kb'] = 0
         
-        conn.close()
         return stats
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 获取数据库统计失败: {e}")
         return {}
+# ================== 增量备份 ==================
+# 备份目录结构：manifest.json + <序号>-full-<时间>.ndjson.gz / <序号>-delta-<时间>.ndjson.gz
+# 每行一个 JSON：{"table", "row"} 写入；{"table", "delete": id} 删除；{"table", "truncate": true} 整表替换前清空
+# manifest["files"] 以一个全量开头，之后依次是增量；恢复时按顺序回放
+
+def _read_manifest(backup_dir: str) -> Dict:
+    path = os.path.join(backup_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {'version': 1, 'files': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(backup_dir: str, manifest: Dict):
+    path = os.path.join(backup_dir, 'manifest.json')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _backup_line(table: str, **fields) -> str:
+    return json.dumps({'table': table, **fields}, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+@timed_op
+def export_backup(backup_dir: str, full_every: int = 7, full: bool = False) -> Optional[Dict]:
+    """导出一次备份到 backup_dir（gzip 压缩的 NDJSON）
+
+    增量只包含上次导出后新增/修改的行（按 id 与修改时间高水位）和删除记录，大小与改动量成正比；
+    每 full_every 次导出一次全量（或 full=True / 距上次导出超过删除记录保留期），全量写入后删除旧文件。
+    整个导出在同一个读事务内完成（WAL 下不阻塞写入），各表数据处于同一时刻。
+
+    Returns:
+        本次的 manifest 条目（含 seconds），没有任何变化时 kind 为 'unchanged' 且不写文件；失败返回 None
+    """
+    started = time.perf_counter()
+    tmp_path = None
+    try:
+        os.makedirs(backup_dir, exist_ok=True)
+        manifest = _read_manifest(backup_dir)
+        files = manifest['files']
+        last = files[-1] if files else None
+        if last is None or len(files) >= full_every or \
+                time.time() - last['created_ts'] > (TOMBSTONE_RETENTION_DAYS - 1) * 86400:
+            full = True
+        previous = {} if full else last['watermarks']
+        kind = 'full' if full else 'delta'
+        created_ts = time.time()
+        seq = manifest.get('seq', 0) + 1
+        name = f"{seq:06d}-{kind}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime(created_ts))}.ndjson.gz"
+        tmp_path = os.path.join(backup_dir, name + '.tmp')
+
+        conn = get_connection()
+        conn.isolation_level = None
+        rows = deletes = 0
+        watermarks = {}
+        small_hash = hashlib.sha256()
+        try:
+            conn.execute('BEGIN')  # 读事务：所有表看到同一时刻的数据
+            existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            buckets = [(row['name'], row['day']) for row in conn.execute('SELECT name, day FROM mapping_buckets ORDER BY day')]
+            tombstone_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM backup_tombstones').fetchone()[0]
+            since = conn.execute('SELECT datetime(?, ?)', ('now', f'-{DELTA_OVERLAP_SECONDS} seconds')).fetchone()[0]
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as out:
+                # 1. 删除记录（先于写入回放，按 id 删除不会误删之后重新插入的行）
+                if not full:
+                    for row in conn.execute(
+                        'SELECT table_name, row_id FROM backup_tombstones WHERE id > ? AND id <= ? ORDER BY id',
+                        (last['tombstone_id'], tombstone_id)
+                    ):
+                        out.write(_backup_line(row['table_name'], delete=row['row_id']))
+                        deletes += 1
+
+                # 2. 小表整表导出
+                for table in SMALL_TABLES:
+                    if table not in existing:
+                        continue
+                    line = _backup_line(table, truncate=True)
+                    out.write(line)
+                    small_hash.update(line.encode('utf-8'))
+                    for row in conn.execute(f'SELECT * FROM {table}'):
+                        line = _backup_line(table, row=dict(row))
+                        out.write(line)
+                        small_hash.update(line.encode('utf-8'))
+
+                # 3. 大表和映射分桶：按高水位导出新增/修改的行
+                previous_day = time.strftime('%Y%m%d', time.gmtime(last['created_ts'])) if last else ''
+                tracked = [(table, column, None) for table, column in TRACKED_TABLES.items()]
+                tracked += [(bucket, 'updated_at', day) for bucket, day in buckets]
+                for table, column, day in tracked:
+                    if table not in existing:
+                        continue
+                    mark = previous.get(table)
+                    if mark is not None and day is not None and day < previous_day:
+                        watermarks[table] = mark  # 只有当天的分桶会被写入，更早的分桶上次导出后不再变化
+                        continue
+                    if mark is None:
+                        cursor = conn.execute(f'SELECT * FROM {table}')
+                    elif column is None:
+                        cursor = conn.execute(f'SELECT * FROM {table} WHERE id > ?', (mark['id'],))
+                    else:
+                        cursor = conn.execute(
+                            f'SELECT * FROM {table} WHERE id > ? OR {column} >= ?', (mark['id'], mark['ts'])
+                        )
+                    max_id = mark['id'] if mark else 0
+                    while True:
+                        batch = cursor.fetchmany(1000)
+                        if not batch:
+                            break
+                        for row in batch:
+                            out.write(_backup_line(table, row=dict(row)))
+                            max_id = max(max_id, row['id'])
+                        rows += len(batch)
+                    # 写入按 db_lock 串行且立即提交，导出开始前 DELTA_OVERLAP_SECONDS 秒之前的修改都已包含在内
+                    watermarks[table] = {'id': max_id, 'ts': since}
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+        small_hash = small_hash.hexdigest()
+        if not full and not rows and not deletes and small_hash == last['small_hash']:
+            os.remove(tmp_path)
+            logger.info("✅ 增量备份：数据无变化")
+            return {'kind': 'unchanged', 'rows': 0, 'deletes': 0, 'bytes': 0,
+                    'seconds': round(time.perf_counter() - started, 3)}
+
+        os.replace(tmp_path, os.path.join(backup_dir, name))
+        entry = {
+            'file': name,
+            'kind': kind,
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(created_ts)),
+            'created_ts': created_ts,
+            'rows': rows,
+            'deletes': deletes,
+            'bytes': os.path.getsize(os.path.join(backup_dir, name)),
+            'tombstone_id': tombstone_id,
+            'small_hash': small_hash,
+            'watermarks': watermarks,
+        }
+        if full:
+            # 新全量之前的文件不再需要（仍保留在 Git 历史中）
+            for old in files:
+                old_path = os.path.join(backup_dir, old['file'])
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+            manifest['files'] = [entry]
+        else:
+            files.append(entry)
+        manifest['seq'] = seq
+        _write_manifest(backup_dir, manifest)
+
+        if full:
+            # 全量已包含此前的全部删除，对应的删除记录可以清掉
+            with db_lock:
+                conn = get_connection()
+                conn.execute('DELETE FROM backup_tombstones WHERE id <= ?', (tombstone_id,))
+                conn.commit()
+                conn.close()
+
+        entry = dict(entry, seconds=round(time.perf_counter() - started, 3))
+        logger.info(f"✅ {'全量' if full else '增量'}备份: {name}（{rows} 行，{deletes} 条删除，"
+                    f"{entry['bytes'] / 1024:.1f} KB，{entry['seconds']}s）")
+        return entry
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 导出备份失败: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+
+@timed_op
+def restore_backup(backup_dir: str, force: bool = False) -> Optional[Dict]:
+    """把 backup_dir 中的全量和之后的增量依次回放到当前数据库（用于空库恢复）
+
+    当前库已有 Bot 时需要 force=True；回放完成后重建计数器并清空删除记录。
+
+    Returns:
+        {'files', 'rows', 'deletes', 'seconds'}，失败返回 None
+    """
+    started = time.perf_counter()
+    try:
+        files = _read_manifest(backup_dir)['files']
+        if not files or files[0]['kind'] != 'full':
+            raise ValueError(f"{backup_dir} 中没有可用的全量备份")
+        rows = deletes = 0
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            if not force and cursor.execute('SELECT COUNT(*) FROM bots').fetchone()[0]:
+                conn.close()
+                raise ValueError("当前数据库不是空库（使用 force 覆盖）")
+            existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            statements = {}
+            for entry in files:
+                with gzip.open(os.path.join(backup_dir, entry['file']), 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        item = json.loads(line)
+                        table = item['table']
+                        if table not in existing:
+                            if not BUCKET_TABLE_RE.fullmatch(table):
+                                raise ValueError(f"未知的表: {table}")
+                            _create_bucket_table(cursor, table)
+                            existing.add(table)
+                        if 'delete' in item:
+                            cursor.execute(f'DELETE FROM {table} WHERE id = ?', (item['delete'],))
+                            deletes += 1
+                        elif item.get('truncate'):
+                            cursor.execute(f'DELETE FROM {table}')
+                        else:
+                            row = item['row']
+                            columns = tuple(row)
+                            sql = statements.get((table, columns))
+                            if sql is None:
+                                if any(not re.fullmatch(r'\w+', column) for column in columns):
+                                    raise ValueError(f"非法的列名: {table} {columns}")
+                                sql = statements[(table, columns)] = (
+                                    f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                                    f"VALUES ({', '.join('?' * len(columns))})"
+                                )
+                            cursor.execute(sql, tuple(row.values()))
+                            rows += 1
+
+            # 登记表里没有的分桶已整桶过期；已删除 Bot 的分桶行没有删除记录，这里一并清理
+            registered = {row[0] for row in cursor.execute('SELECT name FROM mapping_buckets')}
+            for table in existing:
+                if BUCKET_TABLE_RE.fullmatch(table) and table not in registered:
+                    cursor.execute(f'DROP TABLE IF EXISTS {table}')
+            for table in registered:
+                _create_bucket_table(cursor, table)
+                cursor.execute(f'DELETE FROM {table} WHERE bot_username NOT IN (SELECT bot_username FROM bots)')
+            cursor.execute('DELETE FROM backup_tombstones')
+            _bump_state_generation(cursor)
+            _load_bucket_registry(cursor)
+            conn.commit()
+            conn.close()
+        rebuild_counters()
+        result = {'files': len(files), 'rows': rows, 'deletes': deletes,
+                  'seconds': round(time.perf_counter() - started, 3)}
+        logger.info(f"✅ 备份恢复完成: {result}")
+        return result
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 恢复备份失败: {e}")
+        return None
+
+
+@timed_op
+def prune_backup_tombstones(days: int = TOMBSTONE_RETENTION_DAYS, limit: int = 500) -> int:
+    """删除一批超过保留期的删除记录（最多 limit 条），返回删除条数"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM backup_tombstones
+                WHERE id IN (
+                    SELECT id FROM backup_tombstones
+                    WHERE deleted_at < datetime('now', '-' || ? || ' days')
+                    LIMIT ?
+                )
+            ''', (days, limit))
+            deleted = cursor.rowcount
+            conn.commit()
+            conn.close()
+            return deleted
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 清理备份删除记录失败: {e}")
+        return 0
+
+
 # ================== 待验证用户管理 ==================
 
+@timed_op
 def add_pending_verification(bot_username: str, user_id: int, captcha_answer: str) -> bool:
     """添加待验证用户"""
     try:
@@ -847,18 +2184,6 @@ def add_pending_verification(bot_username: str, user_id: int, captcha_answer: st
             conn = get_connection()
             cursor = conn.cursor()
             
-            # 检查表是否存在，不存在则创建
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS pending_verifications (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bot_username TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    captcha_answer TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(bot_username, user_id)
-                )
-            ''')
-            
             # 删除旧记录（如果存在）
             cursor.execute('''
                 DELETE FROM pending_verifications 
@@ -876,28 +2201,18 @@ def add_pending_verification(bot_username: str, user_id: int, captcha_answer: st
             conn.close()
             return True
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 添加待验证用户失败: {e}")
         return False
 
 
+@timed_op
 def get_pending_verification(bot_username: str, user_id: int) -> Optional[str]:
     """获取待验证用户的验证码答案"""
     try:
         conn = get_connection()
         cursor = conn.cursor()
         
-        # 确保表存在
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pending_verifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bot_username TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                captcha_answer TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(bot_username, user_id)
-            )
-        ''')
-        
         cursor.execute('''
             SELECT captcha_answer FROM pending_verifications 
             WHERE bot_username = ? AND user_id = ?
@@ -908,10 +2223,12 @@ def get_pending_verification(bot_username: str, user_id: int) -> Optional[str]:
         
         return row['captcha_answer'] if row else None
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询待验证用户失败: {e}")
         return None
 
 
+@timed_op
 def remove_pending_verification(bot_username: str, user_id: int) -> bool:
     """移除待验证用户"""
     try:
@@ -930,10 +2247,58 @@ def remove_pending_verification(bot_username: str, user_id: int) -> bool:
             
             return affected > 0
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 移除待验证用户失败: {e}")
         return False
 
 
+@timed_op
+def get_pending_verifications(hours: int = 24) -> Dict[Tuple[str, int], Tuple[str, float]]:
+    """加载未过期的待验证记录（宿主程序启动时恢复到内存），返回 {(bot_username, user_id): (答案, 创建时间戳)}"""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT bot_username, user_id, captcha_answer, CAST(strftime('%s', created_at) AS INTEGER) AS created_ts
+            FROM pending_verifications
+            WHERE created_at >= datetime('now', '-' || ? || ' hours')
+        ''', (hours,))
+        rows = cursor.fetchall()
+        conn.close()
+        return {(row['bot_username'], row['user_id']): (row['captcha_answer'], float(row['created_ts'])) for row in rows}
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 加载待验证记录失败: {e}")
+        return {}
+
+
+@timed_op
+def save_pending_verifications(upserts: List[Tuple[str, int, str, float]], deletes: List[Tuple[str, int]]) -> bool:
+    """批量写回待验证记录（宿主程序延迟写入）：upserts 为 (bot_username, user_id, 答案, 创建时间戳)"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.executemany('''
+                DELETE FROM pending_verifications WHERE bot_username = ? AND user_id = ?
+            ''', deletes)
+            cursor.executemany('''
+                INSERT INTO pending_verifications (bot_username, user_id, captcha_answer, created_at)
+                VALUES (?, ?, ?, datetime(?, 'unixepoch'))
+                ON CONFLICT(bot_username, user_id) DO UPDATE SET
+                    captcha_answer = excluded.captcha_answer,
+                    created_at = excluded.created_at
+            ''', [(bot_username, user_id, answer, int(created)) for bot_username, user_id, answer, created in upserts])
+            conn.commit()
+            conn.close()
+            return True
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 写回待验证记录失败: {e}")
+        return False
+
+
+@timed_op
 def cleanup_old_pending_verifications(hours: int = 24) -> int:
     """清理过期的待验证记录（默认24小时）"""
     try:
@@ -941,18 +2306,6 @@ def cleanup_old_pending_verifications(hours: int = 24) -> int:
             conn = get_connection()
             cursor = conn.cursor()
             
-            # 确保表存在
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS pending_verifications (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bot_username TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    captcha_answer TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(bot_username, user_id)
-                )
-            ''')
-            
             cursor.execute('''
                 DELETE FROM pending_verifications 
                 WHERE created_at < datetime('now', '-' || ? || ' hours')
@@ -966,13 +2319,383 @@ def cleanup_old_pending_verifications(hours: int = 24) -> int:
                 logger.info(f"🧹 清理 {deleted} 条过期的待验证记录")
             return deleted
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 清理待验证记录失败: {e}")
         return 0
 
 
 
+@timed_op
+def prune_expired_pending_verifications(hours: int = 24, limit: int = 500) -> int:
+    """删除一批过期的待验证记录（最多 limit 条），返回删除条数"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM pending_verifications
+                WHERE id IN (
+                    SELECT id FROM pending_verifications
+                    WHERE created_at < datetime('now', '-' || ? || ' hours')
+                    LIMIT ?
+                )
+            ''', (hours, limit))
+            deleted = cursor.rowcount
+            conn.commit()
+            conn.close()
+            return deleted
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 分批清理待验证记录失败: {e}")
+        return 0
+
+# ================== 管理事件审计 ==================
+
+@timed_op
+def add_admin_event(category: str, text: str, bot_username: str = None, critical: bool = False) -> bool:
+    """追加一条管理事件到审计表"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO admin_events (category, bot_username, critical, text, created_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (category, bot_username, 1 if critical else 0, text))
+            conn.commit()
+            conn.close()
+            return True
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 记录管理事件失败: {e}")
+        return False
+
+
+@timed_op
+def prune_admin_events(days: int = 90, limit: int = 500) -> int:
+    """删除一批超过保留期的管理事件（最多 limit 条），返回删除条数"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM admin_events
+                WHERE id IN (
+                    SELECT id FROM admin_events
+                    WHERE created_at < datetime('now', '-' || ? || ' days')
+                    LIMIT ?
+                )
+            ''', (days, limit))
+            deleted = cursor.rowcount
+            conn.commit()
+            conn.close()
+            return deleted
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 清理管理事件失败: {e}")
+        return 0
+
+
+@timed_op
+def get_admin_events(limit: int = 20, bot_username: str = None, category: str = None) -> List[Dict]:
+    """查询最近的管理事件（按时间倒序）"""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        
+        conditions = []
+        params = []
+        if bot_username:
+            conditions.append('bot_username = ?')
+            params.append(bot_username)
+        if category:
+            conditions.append('category = ?')
+            params.append(category)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        cursor.execute(f'''
+            SELECT id, category, bot_username, critical, text, created_at
+            FROM admin_events {where}
+            ORDER BY id DESC LIMIT ?
+        ''', (*params, limit))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return [dict(row) for row in rows]
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 查询管理事件失败: {e}")
+        return []
+
+
+# ================== 消息重发队列 / 死信 ==================
+
+@timed_op
+def enqueue_delivery(bot_username: str, method: str, payload: Dict, next_attempt_at: float,
+                     attempts: int = 0, last_error: str = '') -> Optional[int]:
+    """
+    把投递失败的消息写入重发队列
+    
+    Args:
+        bot_username: Bot用户名
+        method: Bot API 方法名（如 'send_message'、'copy_message'）
+        payload: 重发所需数据（JSON 可序列化）
+        next_attempt_at: 下次重试时间（Unix 时间戳）
+        attempts: 已尝试次数
+        last_error: 最近一次错误信息
+    
+    Returns:
+        队列记录ID，失败返回 None
+    """
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO outbound_queue 
+                (bot_username, method, payload, attempts, next_attempt_at, last_error, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (bot_username, method, json.dumps(payload, ensure_ascii=False), attempts, next_attempt_at, last_error))
+            item_id = cursor.lastrowid
+            conn.commit()
+            conn.close()
+            return item_id
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 写入重发队列失败: {e}")
+        return None
+
+
+@timed_op
+def get_due_deliveries(now: float, limit: int = 50) -> List[Dict]:
+    """获取已到重试时间的待重发消息"""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM outbound_queue 
+            WHERE next_attempt_at <= ?
+            ORDER BY next_attempt_at LIMIT ?
+        ''', (now, limit))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        items = []
+        for row in rows:
+            item = dict(row)
+            item['payload'] = json.loads(item['payload'])
+            items.append(item)
+        return items
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 查询重发队列失败: {e}")
+        return []
+
+
+@timed_op
+def reschedule_delivery(item_id: int, attempts: int, next_attempt_at: float, last_error: str = '') -> bool:
+    """更新重试次数和下次重试时间"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE outbound_queue 
+                SET attempts = ?, next_attempt_at = ?, last_error = ?
+                WHERE id = ?
+            ''', (attempts, next_attempt_at, last_error, item_id))
+            conn.commit()
+            conn.close()
+            return True
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 更新重发队列失败: {e}")
+        return False
+
+
+@timed_op
+def delete_delivery(item_id: int) -> bool:
+    """从重发队列删除（已成功投递）"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM outbound_queue WHERE id = ?', (item_id,))
+            conn.commit()
+            affected = cursor.rowcount
+            conn.close()
+            return affected > 0
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 删除重发队列记录失败: {e}")
+        return False
+
+
+@timed_op
+def get_outbound_queue_size() -> int:
+    """获取重发队列中的消息数量"""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) as count FROM outbound_queue')
+        count = cursor.fetchone()['count']
+        conn.close()
+        return count
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 统计重发队列失败: {e}")
+        return 0
+
+
+@timed_op
+def add_dead_letter(bot_username: str, method: str, payload: Dict, attempts: int = 1, last_error: str = '') -> Optional[int]:
+    """直接写入死信表（不适合自动重发的消息，如可能已送达的超时请求）"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO dead_letters 
+                (bot_username, method, payload, attempts, last_error, created_at, failed_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ''', (bot_username, method, json.dumps(payload, ensure_ascii=False), attempts, last_error))
+            letter_id = cursor.lastrowid
+            conn.commit()
+            conn.close()
+            return letter_id
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 写入死信表失败: {e}")
+        return None
+
+
+@timed_op
+def move_to_dead_letter(item_id: int, last_error: str, attempts: int) -> bool:
+    """把重发队列中的消息移入死信表（同一事务）"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO dead_letters 
+                (bot_username, method, payload, attempts, last_error, created_at, failed_at)
+                SELECT bot_username, method, payload, ?, ?, created_at, CURRENT_TIMESTAMP
+                FROM outbound_queue WHERE id = ?
+            ''', (attempts, last_error, item_id))
+            cursor.execute('DELETE FROM outbound_queue WHERE id = ?', (item_id,))
+            conn.commit()
+            conn.close()
+            return True
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 移入死信表失败: {e}")
+        return False
+
+
+@timed_op
+def get_dead_letters(bot_usernames: Optional[List[str]] = None, limit: int = 10) -> List[Dict]:
+    """
+    查询死信（按时间倒序）
+    
+    Args:
+        bot_usernames: 只查询这些 Bot 的死信；None 表示全部（管理员）
+        limit: 最多返回条数
+    """
+    try:
+        if bot_usernames is not None and not bot_usernames:
+            return []
+        conn = get_connection()
+        cursor = conn.cursor()
+        if bot_usernames is None:
+            cursor.execute('SELECT * FROM dead_letters ORDER BY id DESC LIMIT ?', (limit,))
+        else:
+            placeholders = ','.join('?' * len(bot_usernames))
+            cursor.execute(f'''
+                SELECT * FROM dead_letters 
+                WHERE bot_username IN ({placeholders})
+                ORDER BY id DESC LIMIT ?
+            ''', (*bot_usernames, limit))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        letters = []
+        for row in rows:
+            letter = dict(row)
+            letter['payload'] = json.loads(letter['payload'])
+            letters.append(letter)
+        return letters
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 查询死信失败: {e}")
+        return []
+
+
+@timed_op
+def get_dead_letter(letter_id: int) -> Optional[Dict]:
+    """获取单条死信"""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM dead_letters WHERE id = ?', (letter_id,))
+        row = cursor.fetchone()
+        conn.close()
+        
+        if not row:
+            return None
+        letter = dict(row)
+        letter['payload'] = json.loads(letter['payload'])
+        return letter
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 查询死信失败: {e}")
+        return None
+
+
+@timed_op
+def replay_dead_letter(letter_id: int, next_attempt_at: float) -> bool:
+    """把死信重新放回重发队列（重试次数清零）"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO outbound_queue 
+                (bot_username, method, payload, attempts, next_attempt_at, last_error, created_at)
+                SELECT bot_username, method, payload, 0, ?, last_error, created_at
+                FROM dead_letters WHERE id = ?
+            ''', (next_attempt_at, letter_id))
+            moved = cursor.rowcount
+            cursor.execute('DELETE FROM dead_letters WHERE id = ?', (letter_id,))
+            conn.commit()
+            conn.close()
+            return moved > 0
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 重发死信失败: {e}")
+        return False
+
+
+@timed_op
+def delete_dead_letter(letter_id: int) -> bool:
+    """丢弃死信"""
+    try:
+        with db_lock:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM dead_letters WHERE id = ?', (letter_id,))
+            conn.commit()
+            affected = cursor.rowcount
+            conn.close()
+            return affected > 0
+    except Exception as e:
+        _report_error()
+        logger.error(f"❌ 删除死信失败: {e}")
+        return False
+
+
 # ================== 全局设置管理 ==================
 
+@timed_op
 def get_global_setting(key: str) -> Optional[str]:
     """获取全局设置值"""
     try:
@@ -989,10 +2712,12 @@ def get_global_setting(key: str) -> Optional[str]:
         
         return row['value'] if row else None
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 查询全局设置失败: {e}")
         return None
 
 
+@timed_op
 def set_global_setting(key: str, value: str) -> bool:
     """设置全局设置值"""
     try:
@@ -1011,10 +2736,12 @@ def set_global_setting(key: str, value: str) -> bool:
             logger.info(f"✅ 设置全局配置: {key}")
             return True
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 设置全局配置失败: {e}")
         return False
 
 
+@timed_op
 def delete_global_setting(key: str) -> bool:
     """删除全局设置"""
     try:
@@ -1036,36 +2763,67 @@ def delete_global_setting(key: str) -> bool:
                 return True
             return False
     except Exception as e:
+        _report_error()
         logger.error(f"❌ 删除全局配置失败: {e}")
         return False
 
 
+@timed_op
 def get_global_welcome() -> Optional[str]:
     """获取管理员设置的全局欢迎语"""
     return get_global_setting('global_welcome_msg')
 
 
+@timed_op
 def set_global_welcome(welcome_msg: str) -> bool:
     """设置管理员的全局欢迎语"""
     return set_global_setting('global_welcome_msg', welcome_msg)
 
 
+@timed_op
 def delete_global_welcome() -> bool:
     """删除管理员的全局欢迎语"""
     return delete_global_setting('global_welcome_msg')
 
 
-# ================== 启动时初始化 ==================
-# 模块导入时自动初始化数据库
-init_database()
-
-# 清理过期数据（可选）
-try:
-    cleanup_old_pending_verifications(24)  # 清理24小时前的待验证记录
-    cleanup_old_mappings(7)  # 清理7天前的消息映射
-except Exception as e:
-    logger.error(f"清理过期数据失败: {e}")
 if __name__ == '__main__':
+    import sys
+
+    # 命令行（备份脚本使用）：
+    #   python database.py snapshot <目标文件>
+    #   python database.py export <备份目录> [--full] [--full-every N]
+    #   python database.py restore <备份目录> [--force]
+    command = sys.argv[1] if len(sys.argv) >= 2 else ''
+    if command == 'snapshot':
+        if len(sys.argv) != 3:
+            print("用法: python database.py snapshot <目标文件>", file=sys.stderr)
+            sys.exit(2)
+        snapshot = create_snapshot(sys.argv[2])
+        if snapshot is None:
+            print("❌ 生成数据库快照失败", file=sys.stderr)
+            sys.exit(1)
+        print(f"✅ 数据库快照: {snapshot['path']} ({snapshot['bytes']} 字节, {snapshot['seconds']}s, {snapshot['method']})")
+        sys.exit(0)
+    if command in ('export', 'restore'):
+        import argparse
+        parser = argparse.ArgumentParser(prog=f"database.py {command}")
+        parser.add_argument('backup_dir')
+        if command == 'export':
+            parser.add_argument('--full', action='store_true', help="强制全量导出")
+            parser.add_argument('--full-every', type=int, default=7, help="每 N 次导出做一次全量")
+        else:
+            parser.add_argument('--force', action='store_true', help="当前库非空时仍然回放")
+        args = parser.parse_args(sys.argv[2:])
+        if command == 'export':
+            result = export_backup(args.backup_dir, full_every=args.full_every, full=args.full)
+        else:
+            result = restore_backup(args.backup_dir, force=args.force)
+        if result is None:
+            print(f"❌ {'导出' if command == 'export' else '恢复'}备份失败", file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(result, ensure_ascii=False))
+        sys.exit(0)
+
     # 测试代码
     print("数据库测试模式")
     print(f"数据库文件: {DB_FILE}")
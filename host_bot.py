@@ -2,54 +2,391 @@
 import os
 import logging
 import asyncio
+import atexit
+import contextvars
+import copy
+import html
+import cProfile
+import json
+import marshal
+import mmap
+import pstats
+import queue
 import random
+import signal
+import struct
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from functools import partial
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
+    Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
 )
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters
+    ContextTypes, TypeHandler, filters
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, InvalidToken, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 load_dotenv()
 
 # ================== 数据库模块 ==================
 import database as db
+import metrics
 
 # ================== 配置 ==================
 ADMIN_CHANNEL = os.environ.get("ADMIN_CHANNEL")      # 宿主通知群/频道（可选）
 MANAGER_TOKEN = os.environ.get("MANAGER_TOKEN")      # 管理机器人 Token（必须）
 
+# 用户资料缓存（get_chat 结果 / 消息自带的 from_user）
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", "3600"))              # 缓存有效期（秒）
+PROFILE_CACHE_MAX = int(os.environ.get("PROFILE_CACHE_MAX", "20000"))             # 最多缓存的用户数
+PROFILE_FETCH_CONCURRENCY = int(os.environ.get("PROFILE_FETCH_CONCURRENCY", "8"))  # 并发 get_chat 上限
+
+# Bot Token 健康检查
+HEALTH_CHECK_INTERVAL = int(os.environ.get("HEALTH_CHECK_INTERVAL", "21600"))      # 后台检测周期（秒）
+HEALTH_CHECK_CONCURRENCY = int(os.environ.get("HEALTH_CHECK_CONCURRENCY", "10"))   # 并发检测上限
+HEALTH_CHECK_TIMEOUT = float(os.environ.get("HEALTH_CHECK_TIMEOUT", "15"))         # 单个 get_me 超时（秒）
+
+# 宿主通知：非紧急事件合并为定期汇总消息
+ADMIN_LOG_DIGEST_INTERVAL = int(os.environ.get("ADMIN_LOG_DIGEST_INTERVAL", "60"))  # 汇总发送周期（秒）
+ADMIN_LOG_BUFFER_MAX = int(os.environ.get("ADMIN_LOG_BUFFER_MAX", "500"))           # 单个周期最多缓冲的事件数
+
+# 投递失败重发队列（指数退避 + 随机抖动，超过次数进入死信表）
+OUTBOUND_MAX_ATTEMPTS = int(os.environ.get("OUTBOUND_MAX_ATTEMPTS", "8"))          # 最多尝试次数
+OUTBOUND_RETRY_BASE = float(os.environ.get("OUTBOUND_RETRY_BASE", "5"))            # 首次重试等待（秒）
+OUTBOUND_RETRY_MAX = float(os.environ.get("OUTBOUND_RETRY_MAX", "1800"))           # 单次等待上限（秒）
+OUTBOUND_POLL_INTERVAL = float(os.environ.get("OUTBOUND_POLL_INTERVAL", "5"))      # 扫描队列周期（秒）
+
+# 运行指标（Prometheus 文本格式，默认只监听本机）
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "127.0.0.1")                         # 监听地址
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))                         # 监听端口（0 = 关闭）
+TG_API_BASE_URL = os.environ.get("TG_API_BASE_URL")                                # 自定义 Bot API 地址（如 http://127.0.0.1:8081/bot，压测用）
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "500"))                 # 飞行记录保留最近多少个 Update 的耗时明细
+
+# 事件循环健康监测（所有子 Bot 共用一个事件循环，任何同步阻塞都会拖慢全部 Bot）
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.5"))              # 调度延迟采样周期（秒）
+LOOP_LAG_THRESHOLD = float(os.environ.get("LOOP_LAG_THRESHOLD", "0.25"))           # 超过该延迟视为卡顿（秒）
+LOOP_STALL_DUMP = float(os.environ.get("LOOP_STALL_DUMP", "1.0"))                  # 卡住超过该时间时抓取主线程调用栈（秒）
+LOOP_SLOW_CALLBACK = float(os.environ.get("LOOP_SLOW_CALLBACK", "0.1"))            # asyncio 慢回调阈值（秒，需 LOOP_DEBUG）
+LOOP_DEBUG = os.environ.get("LOOP_DEBUG", "0") == "1"                              # 开启 asyncio 调试模式（有额外开销）
+LOOP_ALERT_INTERVAL = int(os.environ.get("LOOP_ALERT_INTERVAL", "600"))             # 卡顿告警推送最小间隔（秒）
+
+# 内存统计（按租户估算各结构占用）
+MEMORY_REPORT_INTERVAL = int(os.environ.get("MEMORY_REPORT_INTERVAL", "300"))       # 统计周期（秒）
+MEMORY_TRACEMALLOC = int(os.environ.get("MEMORY_TRACEMALLOC", "0"))                 # >0 时开启 tracemalloc（保存的栈深度），每个周期对比快照
+MEMORY_TRACEMALLOC_TOP = int(os.environ.get("MEMORY_TRACEMALLOC_TOP", "10"))        # 快照对比显示的条数
+
+# 性能面板（管理员 📈 性能，按固定周期预聚合，查看时不查库）
+PERF_SAMPLE_INTERVAL = int(os.environ.get("PERF_SAMPLE_INTERVAL", "15"))           # 采样周期（秒）
+PERF_WINDOW = int(os.environ.get("PERF_WINDOW", "300"))                             # 速率/增长的统计窗口（秒）
+
+# 数据库后台维护（分批清理过期数据）
+MAINTENANCE_INTERVAL = int(os.environ.get("MAINTENANCE_INTERVAL", "3600"))         # 清理周期（秒）
+MAPPING_RETENTION = os.environ.get(
+    "MAPPING_RETENTION", "topic=0,direct=168,user_forward=48,forward_user=48,owner_user=48"
+)                                                                                   # 各映射类型保留小时数（0 = 永久），可用 /retention 按 Bot 覆盖
+PENDING_RETENTION_HOURS = int(os.environ.get("PENDING_RETENTION_HOURS", "24"))     # 待验证记录保留小时数
+ADMIN_EVENT_RETENTION_DAYS = int(os.environ.get("ADMIN_EVENT_RETENTION_DAYS", "90"))  # 管理事件审计表保留天数（0 = 永久）
+PENDING_FLUSH_INTERVAL = float(os.environ.get("PENDING_FLUSH_INTERVAL", "1"))       # 待验证记录写回数据库的间隔（秒）
+PRUNE_CHUNK = int(os.environ.get("PRUNE_CHUNK", "500"))                            # 每批删除的行数（空闲时最多放大到 4 倍）
+PRUNE_PAUSE = float(os.environ.get("PRUNE_PAUSE", "0.2"))                          # 批次间最短间隔（秒，繁忙时自动加长）
+
+# 状态快照（bots_data / msg_map 的二进制快照，数据库代数一致时启动直接载入，不再全量读库）
+STATE_SNAPSHOT_FILE = os.environ.get(
+    "STATE_SNAPSHOT_FILE", os.path.join(db.DB_DIR, "state.snapshot")
+)                                                                                   # 快照文件（空 = 关闭）
+STATE_SNAPSHOT_INTERVAL = int(os.environ.get("STATE_SNAPSHOT_INTERVAL", "600"))    # 定期写入周期（秒，0 = 只在正常退出时写入）
+
+# GitHub 备份
+BACKUP_MODE = os.environ.get("BACKUP_MODE", "snapshot")                            # snapshot = 提交整库快照；incremental = 全量 + 增量 NDJSON
+BACKUP_DEBOUNCE = float(os.environ.get("BACKUP_DEBOUNCE", "60"))                    # 触发后等待合并的秒数（窗口内多次触发只备份一次）
+BACKUP_TIMEOUT = float(os.environ.get("BACKUP_TIMEOUT", "900"))                     # 单次备份最长运行时间（秒，超时终止）
+
+# 运行时性能分析（管理员 /profile）
+PROFILER_MAX_SECONDS = int(os.environ.get("PROFILER_MAX_SECONDS", "120"))           # 采样模式最长时间（到时自动停止）
+PROFILER_CPROFILE_MAX_SECONDS = int(os.environ.get("PROFILER_CPROFILE_MAX_SECONDS", "30"))  # cProfile 模式最长时间（开销大）
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", "0.005"))              # 采样间隔（秒）
+PROFILER_MAX_OVERHEAD = float(os.environ.get("PROFILER_MAX_OVERHEAD", "0.02"))       # 采样耗时占比上限，超过自动拉长间隔
+
+# 日志
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")                                   # text / json（结构化，每行一个 JSON）
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))                     # 异步写日志的缓冲条数（满了直接丢弃）
+LOG_SAMPLE_RATES = os.environ.get("LOG_SAMPLE_RATES", "direct=0.1,forum=0.1,owner_reply=0.1")  # 消息热路径日志采样率（分类=比例）
+
 bots_data = {}
 msg_map = {}
-pending_verifications = {}  # 待验证用户（内存临时数据）
+pending_verifications = {}  # 待验证用户：(bot_username, user_id) -> (答案, 创建时间)，以内存为准，延迟写回数据库
+pending_dirty = {}          # 待写回数据库的改动：(bot_username, user_id) -> (答案, 创建时间) 或 None（删除）
 running_apps = {}
+user_profiles = OrderedDict()  # user_id -> (过期时间, User/Chat 对象)，按最近使用排序
+background_tasks = set()  # 后台常驻任务（保持引用，防止被回收）
+
+# ================== 日志 ==================
+class JsonFormatter(logging.Formatter):
+    """结构化日志：每行一个 JSON 对象，hot_log 的字段原样输出"""
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        category = getattr(record, "category", None)
+        if category:
+            entry["category"] = category
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    """有界日志队列：写满时丢弃新日志，而不是阻塞事件循环"""
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 同进程内的监听线程，无需序列化：只固定消息文本，格式化交给后台线程
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+def setup_logging() -> QueueListener:
+    """日志格式化和写出放到后台线程，业务代码只负责入队"""
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE)))
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(root.handlers[0].queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+def parse_sample_rates(spec: str) -> dict:
+    rates = {}
+    for item in spec.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+log_sample_rates = parse_sample_rates(LOG_SAMPLE_RATES)
+
+def hot_log(category: str, msg: str, *args, **fields):
+    """热路径 INFO 日志：按分类采样，参数延迟格式化
+
+    用法：hot_log("forum", "[话题模式] 转发成功 %s", chat_id, bot=bot_username)
+    fields 只在 JSON 格式下输出。
+    """
+    rate = log_sample_rates.get(category, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(msg, *args, extra={"category": category, "fields": fields})
+
+# ================== 运行指标 ==================
+UPDATE_TYPES = (
+    "message", "edited_message", "callback_query", "channel_post", "edited_channel_post",
+    "my_chat_member", "chat_member", "chat_join_request", "inline_query",
+)
+
+UPDATES_TOTAL = metrics.Counter("tg_updates_total", "收到的 Update 数量", ("bot", "type"))
+HANDLE_MESSAGE_SECONDS = metrics.Histogram("tg_handle_message_seconds", "handle_message 处理耗时", ("path",))
+API_REQUEST_SECONDS = metrics.Histogram("tg_api_request_seconds", "Bot API 请求耗时", ("method",))
+API_ERRORS_TOTAL = metrics.Counter("tg_api_errors_total", "Bot API 请求失败次数", ("method", "code"))
+API_RATE_LIMITED_TOTAL = metrics.Counter("tg_api_rate_limited_total", "Bot API 429 限流次数", ("method",))
+DB_OP_SECONDS = metrics.Histogram(
+    "tg_db_op_seconds", "数据库操作耗时", ("op",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+DB_OP_ERRORS_TOTAL = metrics.Counter("tg_db_op_errors_total", "数据库操作异常次数", ("op",))
+LOOP_LAG_SECONDS = metrics.Histogram(
+    "tg_loop_lag_seconds", "事件循环调度延迟",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+LOOP_LAG_MAX = metrics.Gauge("tg_loop_lag_max_seconds", "最近一分钟最大调度延迟")
+LOOP_STALLS_TOTAL = metrics.Counter("tg_loop_stalls_total", "调度延迟超过阈值的次数")
+SLOW_CALLBACKS_TOTAL = metrics.Counter("tg_slow_callbacks_total", "asyncio 报告的慢回调次数（LOOP_DEBUG）")
+PRUNED_ROWS_TOTAL = metrics.Counter("tg_pruned_rows_total", "后台维护清理的过期行数", ("table",))
+BACKUP_RUNS_TOTAL = metrics.Counter("tg_backup_runs_total", "备份运行次数", ("result",))
+metrics.Gauge(
+    "tg_log_dropped_total", "日志队列已满被丢弃的条数",
+    collect=lambda: {(): DroppingQueueHandler.dropped}
+)
+metrics.Gauge(
+    "tg_memory_bytes", "按 Bot 估算的内存占用（周期统计）", ("bot", "component"),
+    collect=lambda: {
+        (bot_username, component): size
+        for bot_username, entry in memory_report.get("bots", {}).items()
+        for component, size in entry["bytes"].items()
+    }
+)
+metrics.Gauge(
+    "tg_memory_shared_bytes", "共享结构估算内存占用（周期统计）", ("component",),
+    collect=lambda: {(component,): size for component, size in memory_report.get("shared", {}).items()}
+)
+metrics.Gauge("tg_process_rss_bytes", "进程常驻内存", collect=lambda: {(): process_rss()})
+metrics.Gauge(
+    "tg_backup_last_duration_seconds", "最近一次备份耗时",
+    collect=lambda: {(): backup_state["last"]["seconds"]} if backup_state["last"] else {}
+)
+metrics.Gauge(
+    "tg_running_apps", "运行中的子 Bot 数量",
+    collect=lambda: {(): sum(1 for name in running_apps if name != "__manager__")}
+)
+metrics.Gauge(
+    "tg_msg_map_entries", "内存消息映射条目数", ("bot", "map"),
+    collect=lambda: {
+        (bot_username, map_name): len(entries)
+        for bot_username, maps in list(msg_map.items())
+        for map_name, entries in list(maps.items())
+    }
+)
+metrics.Gauge(
+    "tg_db_rows", "数据库行数（计数器表，触发器增量维护）", ("bot", "kind"),
+    collect=lambda: {
+        (bot_username or "*", kind): value
+        for bot_username, items in db.get_counters().items()
+        for kind, value in items.items()
+    }
+)
+metrics.Gauge(
+    "tg_pending_verifications", "待验证用户数量",
+    collect=lambda: {(): len(pending_verifications)}
+)
+
+# 当前 handle_message 走的分支（verify / direct_forward / forum_forward / owner_reply / command / ...）
+message_path = contextvars.ContextVar("message_path", default="other")
+flight_recorder = metrics.FlightRecorder(TRACE_BUFFER_SIZE)  # 最近 Update 的耗时明细（/slow、/traces）
+
+def update_type(update: Update) -> str:
+    return next((t for t in UPDATE_TYPES if getattr(update, t, None) is not None), "other")
+
+def observe_db_op(op: str, seconds: float, ok: bool):
+    """database.timed_op 的观察者"""
+    DB_OP_SECONDS.observe(seconds, op)
+    if not ok:
+        DB_OP_ERRORS_TOTAL.inc(op)
+    metrics.record_span(f"db.{op}", seconds, "" if ok else "error")
+
+db.set_op_observer(observe_db_op)
+
+class MetricsHTTPXRequest(HTTPXRequest):
+    """记录每个 Bot API 方法的耗时、错误和限流次数"""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            API_ERRORS_TOTAL.inc(api_method, "network")
+            metrics.record_span(f"api.{api_method}", time.perf_counter() - start, type(e).__name__)
+            raise
+        finally:
+            API_REQUEST_SECONDS.observe(time.perf_counter() - start, api_method)
+        metrics.record_span(f"api.{api_method}", time.perf_counter() - start, str(code) if code >= 400 else "")
+        if code >= 400:
+            API_ERRORS_TOTAL.inc(api_method, str(code))
+            if code == 429:
+                API_RATE_LIMITED_TOTAL.inc(api_method)
+        return code, payload
+
+class TracedApplication(Application):
+    """为每个 Update 建立一条 Trace，处理结束后放入飞行记录"""
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            return await super().process_update(update)
+        message = update.effective_message
+        user = update.effective_user
+        queue_delay = None
+        if message is not None and message.date is not None:
+            sent_at = message.edit_date or message.date
+            queue_delay = round(max(0.0, time.time() - sent_at.timestamp()), 1)
+        trace = metrics.Trace(self.bot.username, update_type(update), user.id if user else None, queue_delay)
+        token = metrics.current_trace.set(trace)
+        try:
+            await super().process_update(update)
+        finally:
+            trace.finish()
+            metrics.current_trace.reset(token)
+            flight_recorder.add(trace)
+
+def app_builder(token: str):
+    """带指标统计的 Application 构造器（TG_API_BASE_URL 设置时指向自定义 Bot API）"""
+    builder = (
+        Application.builder().token(token)
+        .application_class(TracedApplication)
+        .request(MetricsHTTPXRequest(connection_pool_size=256))
+        .get_updates_request(MetricsHTTPXRequest())
+    )
+    if TG_API_BASE_URL:
+        builder = builder.base_url(TG_API_BASE_URL)
+    return builder
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE, bot_username: str):
+    """统计每个 Bot 收到的 Update（按类型）"""
+    UPDATES_TOTAL.inc(bot_username, update_type(update))
+
+def build_sub_app(token: str, owner_id, bot_username: str):
+    """创建子 Bot 的 Application 并注册处理器"""
+    app = app_builder(token).build()
+    app.add_handler(TypeHandler(Update, partial(count_update, bot_username=bot_username)), group=-1)
+    app.add_handler(CommandHandler("start", subbot_start))
+    # 处理普通消息
+    app.add_handler(MessageHandler(filters.ALL, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
+    # 处理编辑消息 - 使用 filters.UpdateType.EDITED_MESSAGE
+    app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
+    # 💡 添加回调处理器（处理 /id 命令的按钮）
+    app.add_handler(CallbackQueryHandler(callback_handler))
+    return app
 
 # ================== 工具函数 ==================
-def load_bots():
-    """从数据库加载 Bot 配置"""
-    global bots_data
-    all_bots = db.get_all_bots()
-    
-    bots_data = {}
+def build_bots_data(all_bots: dict) -> dict:
+    """按主人分组 Bot 配置（all_bots 同 db.get_all_bots()）"""
+    grouped = {}
     for bot_username, bot_info in all_bots.items():
         owner_id = str(bot_info['owner'])
-        if owner_id not in bots_data:
-            bots_data[owner_id] = {"bots": []}
-        bots_data[owner_id]["bots"].append({
+        if owner_id not in grouped:
+            grouped[owner_id] = {"bots": []}
+        grouped[owner_id]["bots"].append({
             "bot_username": bot_username,
             "token": bot_info['token'],
             "welcome_msg": bot_info.get('welcome_msg', ''),
             "mode": bot_info.get('mode', 'direct'),
             "forum_group_id": bot_info.get('forum_group_id')
         })
-    
+    return grouped
+
+def load_bots():
+    """从数据库加载 Bot 配置"""
+    global bots_data
+    all_bots = db.get_all_bots()
+    bots_data = build_bots_data(all_bots)
     logger.info(f"✅ 从数据库加载了 {len(all_bots)} 个 Bot")
     return bots_data
 
@@ -57,64 +394,276 @@ def save_bots():
     """保存 Bot 配置到数据库"""
     pass
 
+def build_msg_map(mappings: dict) -> dict:
+    """把 db.load_state() 的映射（按 Bot / 类型归类）转换成 msg_map 结构，字典直接复用不再复制"""
+    result = {}
+    for bot_username, per_type in mappings.items():
+        bot_map = result[bot_username] = {}
+        for map_type, key in MAP_TYPE_KEYS.items():
+            values = per_type.get(map_type, {})
+            if map_type == "topic":
+                # topic 映射需要转换为 int
+                values = {k: int(v) for k, v in values.items() if v.isdigit()}
+            bot_map[key] = values
+    return result
+
 def load_map():
     """从数据库加载消息映射"""
     global msg_map
-    msg_map = {}
-    
-    # 从数据库加载所有机器人的映射
-    all_bots = db.get_all_bots()
-    for bot_username in all_bots.keys():
-        ensure_bot_map(bot_username)
-        
-        # 加载各种类型的映射
-        msg_map[bot_username]["direct"] = db.get_all_mappings(bot_username, "direct")
-        
-        # 加载 topic 映射（需要转换为 int）
-        topic_mappings = db.get_all_mappings(bot_username, "topic")
-        msg_map[bot_username]["topics"] = {k: int(v) for k, v in topic_mappings.items() if v.isdigit()}
-        
-        msg_map[bot_username]["user_to_forward"] = db.get_all_mappings(bot_username, "user_forward")
-        msg_map[bot_username]["forward_to_user"] = db.get_all_mappings(bot_username, "forward_user")
-        msg_map[bot_username]["owner_to_user"] = db.get_all_mappings(bot_username, "owner_user")
-    
+    msg_map = build_msg_map(db.load_state()["mappings"])
     logger.info(f"✅ 从数据库加载了 {len(msg_map)} 个 Bot 的消息映射")
 
+def warm_start():
+    """启动预热：一次读出 Bot 配置和全部映射，同时构建 bots_data 与 msg_map，并记录各阶段耗时"""
+    global bots_data, msg_map
+    state = db.load_state()
+    started = time.perf_counter()
+    bots_data = build_bots_data(state["bots"])
+    msg_map = build_msg_map(state["mappings"])
+    timings = dict(state["timings"], build=time.perf_counter() - started)
+    logger.info(
+        f"✅ 预热完成：{len(state['bots'])} 个 Bot、{state['rows']} 条映射（"
+        + " · ".join(f"{phase} {seconds:.3f}s" for phase, seconds in timings.items()) + "）"
+    )
+    return timings
+
 def save_map():
     """保存消息映射到数据库"""
     pass
 
-def trigger_backup(silent=False):
-    """触发自动备份（异步执行，不阻塞主进程）
-    
-    Args:
-        silent: 是否静默备份（不推送通知）
+# ================== 状态快照（快速重启） ==================
+# 文件头：魔数、格式版本、marshal 版本、状态代数 (value, stamp)、写入时间、数据长度、CRC32；之后是 marshal 数据
+STATE_SNAPSHOT_MAGIC = b"TGSS"
+STATE_SNAPSHOT_VERSION = 1
+STATE_SNAPSHOT_HEADER = struct.Struct("<4sHHqqdQI")
+state_snapshot_generation = None  # 最近一次写入/载入的快照对应的状态代数（未变化时跳过定期写入）
+
+def write_state_snapshot(path: str, generation, payload: bytes) -> int:
+    """写入快照文件（临时文件 + fsync + 原子替换，工作线程中执行），返回字节数"""
+    header = STATE_SNAPSHOT_HEADER.pack(
+        STATE_SNAPSHOT_MAGIC, STATE_SNAPSHOT_VERSION, marshal.version,
+        generation[0], generation[1], time.time(), len(payload), zlib.crc32(payload)
+    )
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(header)
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(header) + len(payload)
+
+async def save_state_snapshot(reason: str) -> bool:
+    """把 bots_data / msg_map 写入状态快照；状态代数与上次相同时跳过"""
+    global state_snapshot_generation
+    if not STATE_SNAPSHOT_FILE:
+        return False
+    if maintenance_running:
+        # 清理线程可能已删除数据库行、尚未同步移除内存映射，此时的内存与代数对不上
+        logger.info(f"ℹ️ 后台维护进行中，跳过状态快照（{reason}）")
+        return False
+    started = time.perf_counter()
+    try:
+        # 读代数和序列化之间没有 await，期间不会有其它协程修改内存状态
+        generation = db.get_state_generation()
+        if generation is None:
+            return False
+        if generation == state_snapshot_generation and os.path.exists(STATE_SNAPSHOT_FILE):
+            return True
+        payload = marshal.dumps((bots_data, msg_map))
+        size = await asyncio.to_thread(write_state_snapshot, STATE_SNAPSHOT_FILE, generation, payload)
+    except Exception as e:
+        logger.error(f"❌ 写入状态快照失败（{reason}）: {e}")
+        return False
+    state_snapshot_generation = generation
+    logger.info(f"💾 状态快照已写入（{reason}）：{size} 字节，代数 {generation[0]}，"
+                f"耗时 {time.perf_counter() - started:.3f}s")
+    return True
+
+def load_state_snapshot() -> bool:
+    """启动时从状态快照恢复 bots_data / msg_map（内存映射读取）
+
+    文件缺失、格式不符、校验失败或数据库在快照之后有改动时返回 False，由调用方走完整加载
     """
-    import subprocess
-    backup_script = "/opt/tg_multi_bot/backup.sh"
-    
-    # 检查备份脚本是否存在
-    if not os.path.exists(backup_script):
-        logger.info("⏭️  备份脚本不存在，跳过自动备份")
-        return
-    
+    global bots_data, msg_map, state_snapshot_generation
+    if not STATE_SNAPSHOT_FILE or not os.path.exists(STATE_SNAPSHOT_FILE):
+        return False
+    started = time.perf_counter()
+    try:
+        with open(STATE_SNAPSHOT_FILE, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, marshal_version, value, stamp, written_at, length, crc = STATE_SNAPSHOT_HEADER.unpack_from(mm)
+            if magic != STATE_SNAPSHOT_MAGIC or version != STATE_SNAPSHOT_VERSION or marshal_version != marshal.version:
+                logger.info("ℹ️ 状态快照格式不匹配，改为完整加载")
+                return False
+            generation = db.get_state_generation()
+            if generation != (value, stamp):
+                current = generation[0] if generation else "?"
+                logger.info(f"ℹ️ 数据库在状态快照之后有改动（快照代数 {value}，当前 {current}），改为完整加载")
+                return False
+            offset = STATE_SNAPSHOT_HEADER.size
+            if offset + length > len(mm):
+                logger.warning("⚠️ 状态快照不完整，改为完整加载")
+                return False
+            with memoryview(mm)[offset:offset + length] as view:
+                if zlib.crc32(view) != crc:
+                    logger.warning("⚠️ 状态快照校验失败，改为完整加载")
+                    return False
+                loaded_bots, loaded_map = marshal.loads(view)
+    except Exception as e:
+        logger.warning(f"⚠️ 读取状态快照失败，改为完整加载: {e}")
+        return False
+    if not isinstance(loaded_bots, dict) or not isinstance(loaded_map, dict):
+        logger.warning("⚠️ 状态快照内容无效，改为完整加载")
+        return False
+
+    bots_data, msg_map = loaded_bots, loaded_map
+    state_snapshot_generation = generation
+    bots = sum(len(info.get("bots", [])) for info in bots_data.values())
+    mappings = sum(len(mapping) for maps in msg_map.values() for mapping in maps.values())
+    logger.info(
+        f"⚡ 从状态快照恢复：{bots} 个 Bot、{mappings} 条映射，耗时 {time.perf_counter() - started:.3f}s"
+        f"（快照写于 {datetime.fromtimestamp(written_at).strftime('%Y-%m-%d %H:%M:%S')}）"
+    )
+    return True
+
+async def state_snapshot_loop():
+    """定期写入状态快照（异常退出时下次启动仍可能直接使用）"""
+    while True:
+        await asyncio.sleep(STATE_SNAPSHOT_INTERVAL)
+        await save_state_snapshot("定期")
+
+BACKUP_SCRIPT = "/opt/tg_multi_bot/backup.sh"
+BACKUP_SNAPSHOT_FILE = os.path.join(db.DB_DIR, "bot_data.snapshot.db")  # 交给备份脚本提交的一致性快照
+
+# 备份协调：窗口内的多次触发合并为一次运行，同一时间最多一个备份进程
+backup_state = {
+    "pending": False,        # 是否有等待执行的触发
+    "silent": True,          # 合并后的静默标志（任一触发要求通知则通知）
+    "first_requested": 0.0,  # 本窗口第一次触发的时间（monotonic）
+    "requests": 0,           # 本窗口合并的触发次数
+    "running_since": None,   # 正在运行的备份开始时间（time.time）
+    "last": None,            # 最近一次结果 {"ok", "finished_at", "seconds", "returncode", "requests", "output"}
+}
+backup_task = None
+backup_wakeup = asyncio.Event()  # /backup now 唤醒正在等待合并窗口的协调任务
+
+async def run_backup(silent=False) -> dict:
+    """执行一次备份并等待结束：先在工作线程生成数据库快照，再运行备份脚本（脚本提交快照而不是正在写入的库文件）"""
+    started = time.monotonic()
+    result = {"ok": False, "returncode": None, "output": ""}
     try:
+        snapshot = None
+        if BACKUP_MODE != "incremental":  # 增量模式由备份脚本自行导出
+            snapshot = await asyncio.to_thread(db.create_snapshot, BACKUP_SNAPSHOT_FILE)
         # 构建环境变量
         env = os.environ.copy()
         if silent:
             env["SILENT_BACKUP"] = "1"  # 传递静默标志
+        if snapshot:
+            env["SNAPSHOT_FILE"] = snapshot["path"]  # 快照失败时由脚本自行生成
         
-        # 异步执行备份脚本（不等待完成）
-        subprocess.Popen(
-            ["/bin/bash", backup_script],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            start_new_session=True,  # 脱离主进程
+        proc = await asyncio.create_subprocess_exec(
+            "/bin/bash", BACKUP_SCRIPT,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,  # 宿主进程重启不会打断正在推送的备份
             env=env
         )
-        logger.info(f"🔄 已触发{'静默' if silent else ''}备份（后台执行）")
+        try:
+            output, _ = await asyncio.wait_for(proc.communicate(), BACKUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            # 终止整个进程组：只杀 bash 时 git push 等子进程仍持有输出管道和备份锁，communicate() 会一直等待
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            output, _ = await proc.communicate()
+            output += f"\n备份超时（{BACKUP_TIMEOUT}s），已终止".encode()
+        lines = output.decode("utf-8", "replace").strip().splitlines()
+        result.update(ok=proc.returncode == 0, returncode=proc.returncode, output="\n".join(lines[-5:]))
     except Exception as e:
-        logger.error(f"❌ 触发备份失败: {e}")
+        result["output"] = str(e)
+    result.update(finished_at=time.time(), seconds=time.monotonic() - started)
+    BACKUP_RUNS_TOTAL.inc("ok" if result["ok"] else "failed")
+    return result
+
+async def backup_coordinator():
+    """等待窗口结束后执行一次备份；运行期间的新触发排到下一个窗口"""
+    global backup_task
+    try:
+        while backup_state["pending"]:
+            while True:
+                delay = backup_state["first_requested"] + BACKUP_DEBOUNCE - time.monotonic()
+                if delay <= 0:
+                    break
+                backup_wakeup.clear()
+                try:
+                    await asyncio.wait_for(backup_wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            silent, requests = backup_state["silent"], backup_state["requests"]
+            backup_state.update(pending=False, silent=True, requests=0, running_since=time.time())
+            logger.info(f"🔄 开始{'静默' if silent else ''}备份（合并 {requests} 次触发）")
+            try:
+                result = await run_backup(silent)
+            finally:
+                backup_state["running_since"] = None
+            backup_state["last"] = dict(result, requests=requests)
+            if result["ok"]:
+                logger.info(f"✅ 备份完成，耗时 {result['seconds']:.1f}s")
+            else:
+                logger.error(f"❌ 备份失败（退出码 {result['returncode']}）: {result['output']}")
+                await send_admin_log(
+                    f"❌ 备份失败（退出码 {result['returncode']}，耗时 {result['seconds']:.1f}s）\n{html.escape(result['output'])}",
+                    category="backup"
+                )
+    finally:
+        backup_task = None
+
+def trigger_backup(silent=False, immediate=False):
+    """请求一次备份（防抖合并，后台执行，不阻塞主进程）
+    
+    Args:
+        silent: 是否静默备份（不推送通知）
+        immediate: 跳过合并等待（正在备份时排在其后立即执行）
+    """
+    global backup_task
+    # 检查备份脚本是否存在
+    if not os.path.exists(BACKUP_SCRIPT):
+        logger.info("⏭️  备份脚本不存在，跳过自动备份")
+        return
+    if not backup_state["pending"]:
+        backup_state.update(pending=True, first_requested=time.monotonic())
+    backup_state["silent"] = backup_state["silent"] and silent
+    backup_state["requests"] += 1
+    if immediate:
+        backup_state["first_requested"] = time.monotonic() - BACKUP_DEBOUNCE
+        backup_wakeup.set()
+    if backup_task is None:
+        backup_task = start_background_task(backup_coordinator(), name="backup")
+
+def format_backup_status() -> str:
+    """备份状态文本（/backup）"""
+    text = f"💾 GitHub 备份（{'增量' if BACKUP_MODE == 'incremental' else '整库快照'}，合并窗口 {BACKUP_DEBOUNCE:.0f}s）\n\n"
+    if not os.path.exists(BACKUP_SCRIPT):
+        return text + "⚠️ 未配置备份脚本（运行 setup.sh 开启 GitHub 备份）"
+    if backup_state["running_since"] is not None:
+        text += f"🔄 正在备份，已运行 {format_duration(time.time() - backup_state['running_since'])}\n"
+    if backup_state["pending"]:
+        wait = max(0.0, backup_state["first_requested"] + BACKUP_DEBOUNCE - time.monotonic())
+        text += f"⏳ 待执行：合并 {backup_state['requests']} 次触发，约 {wait:.0f}s 后开始\n"
+    last = backup_state["last"]
+    if last is None:
+        text += "📭 本次启动后尚未备份"
+    else:
+        finished = datetime.fromtimestamp(last["finished_at"]).strftime("%Y-%m-%d %H:%M:%S")
+        text += (
+            f"{'✅ 成功' if last['ok'] else '❌ 失败'} · {finished} · 耗时 {last['seconds']:.1f}s"
+            f" · 合并 {last['requests']} 次触发\n"
+        )
+        if last["output"]:
+            text += f"\n{last['output']}"
+    return text
 
 # 使用数据库的验证用户管理
 def is_verified(bot_username: str, user_id: int) -> bool:
@@ -129,6 +678,68 @@ def remove_verified_user(bot_username: str, user_id: int):
     """取消用户验证"""
     return db.remove_verified_user(bot_username, user_id)
 
+# ================== 待验证记录（内存 + 延迟写入） ==================
+# 验证码检查只查内存；改动合并后由 pending_flush_loop 批量写回数据库，重启时 load_pending_verifications 恢复
+
+def get_pending_captcha(bot_username: str, user_id: int):
+    """返回未过期的验证码答案（过期的顺带移除）"""
+    key = (bot_username, user_id)
+    entry = pending_verifications.get(key)
+    if entry is None:
+        return None
+    if time.time() - entry[1] > PENDING_RETENTION_HOURS * 3600:
+        pop_pending_captcha(bot_username, user_id)
+        return None
+    return entry[0]
+
+def set_pending_captcha(bot_username: str, user_id: int, answer: str):
+    """记录新的验证码（覆盖旧题）"""
+    key = (bot_username, user_id)
+    pending_verifications[key] = pending_dirty[key] = (answer, time.time())
+
+def pop_pending_captcha(bot_username: str, user_id: int):
+    """移除验证码（验证通过或过期）"""
+    key = (bot_username, user_id)
+    if pending_verifications.pop(key, None) is not None:
+        pending_dirty[key] = None
+
+def expire_pending_captchas() -> int:
+    """移除内存中过期的验证码（数据库中的由后台维护分批删除），返回移除个数"""
+    cutoff = time.time() - PENDING_RETENTION_HOURS * 3600
+    expired = [key for key, (_, created) in pending_verifications.items() if created < cutoff]
+    for key in expired:
+        pending_verifications.pop(key, None)
+    return len(expired)
+
+def load_pending_verifications():
+    """启动时从数据库恢复未过期的验证码"""
+    pending_verifications.clear()
+    pending_verifications.update(db.get_pending_verifications(PENDING_RETENTION_HOURS))
+    logger.info(f"✅ 从数据库恢复了 {len(pending_verifications)} 个待验证用户")
+
+async def flush_pending_verifications() -> bool:
+    """把积累的改动一次写回数据库；失败时放回，下次重试（期间更新的改动优先）"""
+    global pending_dirty
+    if not pending_dirty:
+        return True
+    batch, pending_dirty = pending_dirty, {}
+    upserts = [(bot, user, entry[0], entry[1]) for (bot, user), entry in batch.items() if entry is not None]
+    deletes = [key for key, entry in batch.items() if entry is None]
+    ok = await asyncio.to_thread(db.save_pending_verifications, upserts, deletes)
+    if not ok:
+        for key, entry in batch.items():
+            pending_dirty.setdefault(key, entry)
+    return ok
+
+async def pending_flush_loop():
+    """定期写回待验证记录"""
+    while True:
+        await asyncio.sleep(PENDING_FLUSH_INTERVAL)
+        try:
+            await flush_pending_verifications()
+        except Exception as e:
+            logger.error(f"❌ 写回待验证记录失败: {e}")
+
 def generate_captcha() -> dict:
     """生成复杂验证码（多种类型）- 完全免费"""
     captcha_type = random.choice(['math', 'sequence', 'chinese', 'logic', 'time'])
@@ -340,33 +951,360 @@ def ensure_bot_map(bot_username: str):
     # 主人消息ID -> 发送给用户的消息ID (用于编辑主人发送的消息)
     msg_map[bot_username].setdefault("owner_to_user", {})
 
-async def reply_and_auto_delete(message, text, delay=5, **kwargs):
+# ================== 用户资料缓存 ==================
+profile_fetch_semaphore = asyncio.Semaphore(PROFILE_FETCH_CONCURRENCY)
+
+def remember_user(user):
+    """把消息自带的 from_user 写入资料缓存（零成本，无需调用 API）"""
+    if user is None or getattr(user, "id", None) is None:
+        return
+    user_profiles[user.id] = (time.monotonic() + PROFILE_CACHE_TTL, user)
+    user_profiles.move_to_end(user.id)
+    while len(user_profiles) > PROFILE_CACHE_MAX:
+        user_profiles.popitem(last=False)
+
+def get_cached_profile(user_id: int):
+    """从缓存读取用户资料，过期或不存在返回 None"""
+    entry = user_profiles.get(int(user_id))
+    if not entry:
+        return None
+    expires_at, profile = entry
+    if expires_at < time.monotonic():
+        user_profiles.pop(int(user_id), None)
+        return None
+    user_profiles.move_to_end(int(user_id))
+    return profile
+
+async def get_user_profile(bot, user_id: int):
+    """获取用户资料：优先命中缓存，未命中时调用 get_chat（受并发上限控制）
+
+    获取失败时抛出原异常，由调用方决定如何展示。
+    """
+    profile = get_cached_profile(user_id)
+    if profile is not None:
+        return profile
+    async with profile_fetch_semaphore:
+        # 排队期间可能已被其它请求写入缓存
+        profile = get_cached_profile(user_id)
+        if profile is not None:
+            return profile
+        profile = await bot.get_chat(int(user_id))
+    remember_user(profile)
+    return profile
+
+async def get_user_profiles(bot, user_ids) -> dict:
+    """批量获取用户资料（并发解析未命中项），失败的用户对应 None"""
+    user_ids = list(user_ids)
+    results = await asyncio.gather(
+        *(get_user_profile(bot, uid) for uid in user_ids),
+        return_exceptions=True
+    )
+    return {
+        uid: (None if isinstance(res, Exception) else res)
+        for uid, res in zip(user_ids, results)
+    }
+
+# ================== 消息投递与重发 ==================
+# 数据库 map_type -> msg_map 中的字段名
+MAP_TYPE_KEYS = {
+    "direct": "direct",
+    "topic": "topics",
+    "user_forward": "user_to_forward",
+    "forward_user": "forward_to_user",
+    "owner_user": "owner_to_user",
+}
+SENT = "$sent"  # 映射占位符：投递成功后替换为新消息ID
+QUEUED_NOTICE = "⏳ 网络繁忙，消息可能延迟送达"
+
+def record_mappings(bot_username: str, maps, sent_message_id: int, user_id=None):
+    """投递成功后写入消息映射（内存 + 数据库）
+
+    Args:
+        maps: [[map_type, key, value], ...]，key/value 为 SENT 时替换为 sent_message_id
+    """
+    ensure_bot_map(bot_username)
+    for map_type, key, value in maps:
+        key = sent_message_id if key == SENT else key
+        value = sent_message_id if value == SENT else value
+        msg_map[bot_username][MAP_TYPE_KEYS[map_type]][str(key)] = value
+        db.set_mapping(bot_username, map_type, str(key), str(value), int(user_id) if user_id is not None else None)
+
+def is_transient_error(e: Exception) -> bool:
+    """网络错误和限流可以重试；BadRequest/Forbidden 等重试也不会成功"""
+    if isinstance(e, RetryAfter):
+        return True
+    return isinstance(e, NetworkError) and not isinstance(e, BadRequest)
+
+# 会产生新消息的方法：超时后请求可能已经到达 Telegram，重发会导致重复
+NON_IDEMPOTENT_PREFIXES = ("send_", "copy_", "forward_")
+
+def is_retryable(method: str, e: Exception) -> bool:
+    """可以安全重发的错误（发送类请求超时时不确定是否已送达，不自动重发）"""
+    if isinstance(e, TimedOut) and method.startswith(NON_IDEMPOTENT_PREFIXES):
+        return False
+    return is_transient_error(e)
+
+def retry_delay(attempts: int, error: Exception = None) -> float:
+    """指数退避 + 随机抖动；RetryAfter 时至少等待服务器要求的时间"""
+    delay = min(OUTBOUND_RETRY_MAX, OUTBOUND_RETRY_BASE * (2 ** max(0, attempts - 1)))
+    delay = random.uniform(delay / 2, delay)
+    if isinstance(error, RetryAfter):
+        delay = max(delay, float(error.retry_after))
+    return delay
+
+async def deliver(bot, bot_username: str, method: str, kwargs: dict, maps=None, user_id=None, then=None):
+    """调用 Bot API 投递消息，成功后写入映射
+
+    遇到网络错误或限流时把消息写入重发队列并返回 None；发送类请求超时时可能已经送达，
+    不自动重发，直接记入死信表（管理员确认未送达后可手动重发），同样返回 None。
+    其它错误（如 BadRequest）原样抛出，由调用方处理。
+    then: 本条送达后再依次投递的消息 [{"method", "kwargs", "maps", "user_id"}]；本条进入重发队列时
+          随它一起排队，保证先后顺序。有 then 时返回最后一条的结果（任一条排队时为 None）
+    """
+    try:
+        sent = await getattr(bot, method)(**kwargs)
+    except Exception as e:
+        if not is_transient_error(e):
+            raise
+        payload = {"kwargs": kwargs, "maps": maps or [], "user_id": user_id, "then": then or []}
+        if not is_retryable(method, e):
+            db.add_dead_letter(bot_username, method, payload, attempts=1, last_error=str(e))
+            logger.warning(f"💀 [{bot_username}] {method} 超时，可能已送达，不自动重发，已记入死信: {e}")
+            await send_admin_log(
+                f"💀 Bot @{bot_username} 消息投递超时（可能已送达）已记入死信: {html.escape(str(e)[:100])}",
+                category="dead_letter", bot_username=bot_username
+            )
+            return None
+        db.enqueue_delivery(
+            bot_username, method, payload,
+            next_attempt_at=time.time() + retry_delay(1, e),
+            attempts=1, last_error=str(e)
+        )
+        logger.warning(f"⏳ [{bot_username}] {method} 投递失败，已加入重发队列: {e}")
+        return None
+    if maps:
+        record_mappings(bot_username, maps, sent.message_id, user_id)
+    if then:
+        return await deliver_then(bot, bot_username, then)
+    return sent
+
+async def deliver_then(bot, bot_username: str, then: list):
+    """投递排在某条消息之后的后续消息（见 deliver 的 then 参数）"""
+    step, rest = then[0], then[1:]
+    return await deliver(bot, bot_username, step["method"], step["kwargs"], step.get("maps"), step.get("user_id"), then=rest)
+
+def is_bot_configured(bot_username: str) -> bool:
+    return any(b["bot_username"] == bot_username for info in bots_data.values() for b in info.get("bots", []))
+
+async def process_outbound_queue():
+    """重发到期的消息；超过最大次数或遇到不可重试的错误时移入死信表"""
+    for item in db.get_due_deliveries(time.time()):
+        bot_username = item["bot_username"]
+        payload = item["payload"]
+        attempts = item["attempts"] + 1
+        app = running_apps.get(bot_username)
+        if app is None and is_bot_configured(bot_username):
+            # Bot 暂未运行（启动中或重启中）：不算一次尝试，稍后再试
+            db.reschedule_delivery(item["id"], item["attempts"], time.time() + retry_delay(max(1, item["attempts"])), "Bot 未运行")
+            continue
+        try:
+            if app is None:
+                raise RuntimeError("Bot 已删除")
+            sent = await getattr(app.bot, item["method"])(**payload["kwargs"])
+        except Exception as e:
+            if app is not None and is_retryable(item["method"], e) and attempts < OUTBOUND_MAX_ATTEMPTS:
+                db.reschedule_delivery(item["id"], attempts, time.time() + retry_delay(attempts, e), str(e))
+            else:
+                db.move_to_dead_letter(item["id"], str(e), attempts)
+                logger.warning(f"💀 [{bot_username}] {item['method']} 重发失败 {attempts} 次，已移入死信: {e}")
+                await send_admin_log(
+                    f"💀 Bot @{bot_username} 消息投递失败（{attempts} 次）已移入死信: {html.escape(str(e)[:100])}",
+                    category="dead_letter", bot_username=bot_username
+                )
+            continue
+        db.delete_delivery(item["id"])
+        if payload.get("maps"):
+            record_mappings(bot_username, payload["maps"], sent.message_id, payload.get("user_id"))
+        logger.info(f"✅ [{bot_username}] {item['method']} 第 {attempts} 次重发成功")
+        if payload.get("then"):
+            try:
+                await deliver_then(app.bot, bot_username, payload["then"])
+            except Exception as e:
+                logger.warning(f"⚠️ [{bot_username}] 排在重发消息之后的 {payload['then'][0]['method']} 投递失败: {e}")
+
+async def outbound_retry_loop():
+    """后台扫描重发队列"""
+    while True:
+        await asyncio.sleep(OUTBOUND_POLL_INTERVAL)
+        try:
+            await process_outbound_queue()
+        except Exception as e:
+            logger.error(f"❌ 处理重发队列失败: {e}")
+
+# ================== 话题创建（single-flight） ==================
+topic_creation_inflight = {}  # (bot_username, uid_key) -> 正在进行的创建任务
+
+async def _create_topic(bot, bot_username: str, forum_group_id: int, user) -> int:
+    """创建话题并保存映射"""
+    display_name = (
+        user.full_name
+        or (f"@{user.username}" if user.username else None)
+        or "匿名用户"
+    )
+    topic = await bot.create_forum_topic(chat_id=forum_group_id, name=f"{display_name}")
+    topic_id = topic.message_thread_id
+    # 💾 保存到数据库和内存
+    msg_map[bot_username]["topics"][str(user.id)] = topic_id
+    db.set_mapping(bot_username, "topic", str(user.id), str(topic_id), user.id)
+    return topic_id
+
+async def get_or_create_topic(bot, bot_username: str, forum_group_id: int, user, stale_topic_id: int = None) -> int:
+    """获取用户对应的话题，不存在（或已失效）时创建
+
+    同一用户的并发请求共享同一次创建，避免连续发消息时重复建话题。
+    stale_topic_id: 已确认失效的话题ID；若缓存已被其它请求换成新话题则直接复用。
+    """
+    uid_key = str(user.id)
+    topic_id = msg_map[bot_username]["topics"].get(uid_key)
+    if topic_id and topic_id != stale_topic_id:
+        return topic_id
+    
+    key = (bot_username, uid_key)
+    task = topic_creation_inflight.get(key)
+    stage = "topic.wait"
+    if task is None:
+        stage = "topic.create"
+        task = asyncio.create_task(_create_topic(bot, bot_username, forum_group_id, user))
+        topic_creation_inflight[key] = task
+        task.add_done_callback(lambda _: topic_creation_inflight.pop(key, None))
+    # shield：某个等待者被取消时不影响其它等待者共享的创建任务
+    with metrics.span(stage):
+        return await asyncio.shield(task)
+
+async def _delete_later(sent, delay):
+    """等待 delay 秒后删除提示消息（后台执行，不占用处理器）"""
     try:
-        sent = await message.reply_text(text, **kwargs)
         await asyncio.sleep(delay)
         await sent.delete()
     except Exception:
         pass
 
+async def reply_and_auto_delete(message, text, delay=5, **kwargs):
+    try:
+        sent = await message.reply_text(text, **kwargs)
+        start_background_task(_delete_later(sent, delay))
+    except Exception:
+        pass
+
 async def send_and_auto_delete(context, chat_id, text, delay=5, **kwargs):
     """发送消息并自动删除(不使用reply)"""
     try:
         sent = await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
-        await asyncio.sleep(delay)
-        await sent.delete()
+        start_background_task(_delete_later(sent, delay))
     except Exception:
         pass
 
-async def send_admin_log(text: str):
-    if not ADMIN_CHANNEL:
-        return
+# ================== 宿主通知（管理日志） ==================
+# 分类名称（用于汇总消息和 /audit 查询）
+ADMIN_EVENT_LABELS = {
+    "block": "拉黑",
+    "unblock": "解除拉黑",
+    "unverify": "取消验证",
+    "welcome": "欢迎语",
+    "config": "配置变更",
+    "broadcast": "广播",
+    "bot_add": "新增Bot",
+    "bot_delete": "删除Bot",
+    "bot_clean": "清理失效Bot",
+    "dead_letter": "投递失败",
+    "loop_lag": "事件循环卡顿",
+    "maintenance": "数据库维护",
+    "backup": "备份",
+    "system": "系统",
+    "general": "其它",
+}
+admin_log_buffer = deque(maxlen=ADMIN_LOG_BUFFER_MAX)  # 待汇总的非紧急事件 (时间, 分类, 文本)
+admin_log_dropped = 0  # 缓冲区溢出丢弃的条数（审计表中仍有记录）
+
+async def _send_admin_message(text: str):
+    """直接发送一条消息到管理频道（HTML 解析失败时改为纯文本重发，不丢消息）"""
     try:
         app = running_apps.get("__manager__")
         if app:
-            await app.bot.send_message(chat_id=ADMIN_CHANNEL, text=text, parse_mode="HTML")
+            try:
+                await app.bot.send_message(chat_id=ADMIN_CHANNEL, text=text, parse_mode="HTML")
+            except BadRequest as e:
+                if "parse entities" not in str(e).lower():
+                    raise
+                logger.warning(f"⚠️ 宿主通知 HTML 解析失败，改为纯文本发送: {e}")
+                await app.bot.send_message(chat_id=ADMIN_CHANNEL, text=text)
     except Exception as e:
         logger.error(f"宿主通知失败: {e}")
 
+async def send_admin_log(text: str, category: str = "general", bot_username: str = None, critical: bool = False):
+    """记录管理事件
+
+    所有事件都会写入审计表；紧急事件立即推送到管理频道，
+    其余事件进入缓冲区，由 admin_log_digest_loop 定期合并成汇总消息发送。
+    """
+    global admin_log_dropped
+    # 写库放到工作线程，避免在事件循环上等待 db_lock（死信、卡顿告警等热路径也会调用）
+    await asyncio.to_thread(db.add_admin_event, category, text, bot_username, critical)
+    if not ADMIN_CHANNEL:
+        return
+    if critical:
+        await _send_admin_message(text)
+        return
+    if len(admin_log_buffer) == admin_log_buffer.maxlen:
+        admin_log_dropped += 1
+    admin_log_buffer.append((datetime.now(), category, text))
+
+def build_admin_digests(events, dropped: int = 0, limit: int = 4000) -> list:
+    """把缓冲的事件合并成若干条汇总消息（每条不超过 limit 字符）"""
+    counts = {}
+    for _, category, _ in events:
+        counts[category] = counts.get(category, 0) + 1
+    summary = " · ".join(f"{ADMIN_EVENT_LABELS.get(c, c)} {n}" for c, n in counts.items())
+    header = (
+        f"🧾 管理日志汇总（{len(events)} 条，"
+        f"{events[0][0].strftime('%H:%M')}–{events[-1][0].strftime('%H:%M')}）\n"
+        f"{summary}\n"
+    )
+    if dropped:
+        header += f"⚠️ 另有 {dropped} 条因缓冲区已满未推送，可用 /audit 查看\n"
+    
+    messages = []
+    current = header + "\n"
+    for _, _, text in events:
+        line = text.replace("\n", " | ") + "\n"
+        if len(current) + len(line) > limit:
+            messages.append(current)
+            current = ""
+        current += line
+    if current.strip():
+        messages.append(current)
+    return messages
+
+async def flush_admin_log():
+    """把缓冲区中的事件作为汇总消息发送"""
+    global admin_log_dropped
+    if not admin_log_buffer:
+        return
+    events = list(admin_log_buffer)
+    admin_log_buffer.clear()
+    dropped, admin_log_dropped = admin_log_dropped, 0
+    for text in build_admin_digests(events, dropped):
+        await _send_admin_message(text)
+
+async def admin_log_digest_loop():
+    """定期发送管理日志汇总"""
+    while True:
+        await asyncio.sleep(ADMIN_LOG_DIGEST_INTERVAL)
+        try:
+            await flush_admin_log()
+        except Exception as e:
+            logger.error(f"❌ 发送管理日志汇总失败: {e}")
+
 def get_bot_cfg(owner_id, bot_username: str):
     """从 bots_data 中找到某个 owner 的某个子机器人配置"""
     owner_id = str(owner_id)
@@ -418,6 +1356,614 @@ def get_welcome_message(bot_username: str) -> str:
     # 优先级3：系统默认欢迎语
     return DEFAULT_WELCOME_MSG
 
+# ================== 后台任务 ==================
+def start_background_task(coro, name: str = None):
+    """启动后台任务并保存引用"""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# ================== 事件循环健康监测 ==================
+loop_heartbeat = time.monotonic()  # 监测任务最近一次被调度的时间
+loop_stall_stack = None            # 看门狗线程抓到的最近一次卡顿调用栈 (卡住秒数, 调用栈文本)
+last_loop_alert = 0.0
+
+class SlowCallbackHandler(logging.Handler):
+    """统计 asyncio 调试模式下 "Executing <Handle ...> took X seconds" 日志"""
+
+    def emit(self, record: logging.LogRecord):
+        if record.getMessage().startswith("Executing "):
+            SLOW_CALLBACKS_TOTAL.inc()
+
+def loop_watchdog(loop_thread_id: int):
+    """看门狗线程：事件循环长时间没有心跳时抓取主线程调用栈"""
+    global loop_stall_stack
+    dumped_for = None
+    while True:
+        time.sleep(min(0.1, LOOP_STALL_DUMP / 2))
+        heartbeat = loop_heartbeat
+        stalled = time.monotonic() - heartbeat
+        if stalled >= LOOP_STALL_DUMP and dumped_for != heartbeat:
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is not None:
+                loop_stall_stack = (stalled, "".join(traceback.format_stack(frame)[-12:]))
+                dumped_for = heartbeat
+
+async def loop_monitor():
+    """持续测量调度延迟：sleep 实际醒来时间与预期之差"""
+    global loop_heartbeat, loop_stall_stack, last_loop_alert
+    loop = asyncio.get_running_loop()
+    if LOOP_DEBUG:
+        loop.set_debug(True)
+        loop.slow_callback_duration = LOOP_SLOW_CALLBACK
+        logging.getLogger("asyncio").addHandler(SlowCallbackHandler())
+        logger.info(f"🐞 asyncio 调试模式已开启（慢回调阈值 {LOOP_SLOW_CALLBACK}s）")
+    threading.Thread(
+        target=loop_watchdog, args=(threading.get_ident(),), name="loop_watchdog", daemon=True
+    ).start()
+    
+    window_start, window_max = time.monotonic(), 0.0
+    while True:
+        loop_heartbeat = time.monotonic()
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - expected)
+        loop_heartbeat = time.monotonic()
+        LOOP_LAG_SECONDS.observe(lag)
+        window_max = max(window_max, lag)
+        if loop_heartbeat - window_start >= 60:
+            LOOP_LAG_MAX.set(window_max)
+            window_start, window_max = loop_heartbeat, 0.0
+        
+        if lag < LOOP_LAG_THRESHOLD:
+            continue
+        LOOP_STALLS_TOTAL.inc()
+        stack = loop_stall_stack[1] if loop_stall_stack else ""
+        loop_stall_stack = None
+        logger.warning(f"🐌 事件循环卡顿 {lag * 1000:.0f}ms" + (f"，卡住时主线程调用栈:\n{stack}" if stack else ""))
+        
+        now = time.monotonic()
+        if now - last_loop_alert >= LOOP_ALERT_INTERVAL:
+            last_loop_alert = now
+            where = next(
+                (line.strip() for line in reversed(stack.splitlines()) if line.strip().startswith("File ")),
+                "未抓到调用栈"
+            )
+            await send_admin_log(
+                f"🐌 事件循环卡顿 {lag:.2f}s（阈值 {LOOP_LAG_THRESHOLD}s），所有 Bot 在此期间暂停响应\n"
+                f"📍 {html.escape(where[:300])}",
+                category="loop_lag", critical=True
+            )
+
+# ================== 内存统计 ==================
+MEMORY_SAMPLE = 500  # 大字典只抽样前 N 项估算平均大小
+memory_report = {}          # 最近一次统计结果（/mem 和指标读取）
+tracemalloc_snapshot = None  # 上一次 tracemalloc 快照
+
+def deep_sizeof(obj, depth: int = 4) -> int:
+    """估算对象占用字节数（递归容器，深度有限；共享的小对象会被重复计算）"""
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        return size + sum(deep_sizeof(k, depth - 1) + deep_sizeof(v, depth - 1) for k, v in list(obj.items()))
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        return size + sum(deep_sizeof(item, depth - 1) for item in list(obj))
+    if hasattr(obj, "to_json"):  # Telegram 对象：按 JSON 长度粗略估算
+        try:
+            return size + len(obj.to_json())
+        except Exception:
+            return size
+    return size
+
+def sizeof_mapping(mapping) -> int:
+    """估算字典占用：抽样前 MEMORY_SAMPLE 项求平均后按条数放大"""
+    size = sys.getsizeof(mapping)
+    count = len(mapping)
+    if not count:
+        return size
+    sample = list(islice(mapping.items(), MEMORY_SAMPLE))
+    per_item = sum(deep_sizeof(k) + deep_sizeof(v) for k, v in sample) / len(sample)
+    return int(size + per_item * count)
+
+def process_rss() -> int:
+    """当前进程常驻内存（字节），非 Linux 返回 0"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def build_memory_report() -> dict:
+    """按 Bot 统计 msg_map（按类型）、待验证、Application 队列和 user_data/chat_data"""
+    bots = {}
+    for bot_username, maps in list(msg_map.items()):
+        entry = bots.setdefault(bot_username, {"bytes": {}, "entries": {}})
+        for map_name, mapping in list(maps.items()):
+            entry["bytes"][f"msg_map.{map_name}"] = sizeof_mapping(mapping)
+            entry["entries"][f"msg_map.{map_name}"] = len(mapping)
+    
+    pending = {}
+    for key, entry in list(pending_verifications.items()):
+        bot_username = key[0]
+        count, size = pending.get(bot_username, (0, 0))
+        pending[bot_username] = (count + 1, size + deep_sizeof(key) + deep_sizeof(entry))
+    for bot_username, (count, size) in pending.items():
+        entry = bots.setdefault(bot_username, {"bytes": {}, "entries": {}})
+        entry["bytes"]["pending_verifications"] = size
+        entry["entries"]["pending_verifications"] = count
+    
+    for bot_username, app in list(running_apps.items()):
+        if bot_username == "__manager__":
+            continue
+        entry = bots.setdefault(bot_username, {"bytes": {}, "entries": {}})
+        queued = list(getattr(app.update_queue, "_queue", ()))
+        entry["bytes"]["update_queue"] = sum(deep_sizeof(u) for u in queued)
+        entry["entries"]["update_queue"] = len(queued)
+        entry["bytes"]["user_data"] = sizeof_mapping(app.user_data)
+        entry["entries"]["user_data"] = len(app.user_data)
+        entry["bytes"]["chat_data"] = sizeof_mapping(app.chat_data)
+        entry["entries"]["chat_data"] = len(app.chat_data)
+    
+    for entry in bots.values():
+        entry["total"] = sum(entry["bytes"].values())
+    
+    shared = {
+        "user_profiles": sizeof_mapping(user_profiles),
+        "flight_recorder": sum(deep_sizeof(t.spans) for t in list(flight_recorder.traces)),
+        "admin_log_buffer": deep_sizeof(admin_log_buffer),
+        "bots_data": deep_sizeof(bots_data, depth=5),
+    }
+    return {"at": datetime.now(), "rss": process_rss(), "bots": bots, "shared": shared, "tracemalloc": []}
+
+def diff_tracemalloc() -> list:
+    """与上一次快照对比，返回增长最多的代码位置"""
+    global tracemalloc_snapshot
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    previous, tracemalloc_snapshot = tracemalloc_snapshot, snapshot
+    if previous is None:
+        return []
+    stats = snapshot.compare_to(previous, "lineno")
+    return [str(stat) for stat in stats[:MEMORY_TRACEMALLOC_TOP] if stat.size_diff > 0]
+
+def format_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.2f}GB"
+
+async def memory_accounting_loop():
+    """定期刷新内存统计（可选 tracemalloc 快照对比）"""
+    global memory_report
+    if MEMORY_TRACEMALLOC > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACEMALLOC)
+        logger.info(f"🧠 tracemalloc 已开启（栈深度 {MEMORY_TRACEMALLOC}）")
+    while True:
+        try:
+            report = build_memory_report()
+            if tracemalloc.is_tracing():
+                report["tracemalloc"] = await asyncio.to_thread(diff_tracemalloc)
+                for line in report["tracemalloc"]:
+                    logger.info(f"🧠 内存增长: {line}")
+            memory_report = report
+        except Exception as e:
+            logger.error(f"❌ 内存统计失败: {e}")
+        await asyncio.sleep(MEMORY_REPORT_INTERVAL)
+
+def render_memory_report(bot_username: str = None, top: int = 10) -> str:
+    report = memory_report
+    if not report:
+        return "🧠 内存统计尚未完成，请稍后再试"
+    
+    bots = report["bots"]
+    tracked = sum(e["total"] for e in bots.values()) + sum(report["shared"].values())
+    text = (
+        f"🧠 内存统计（{report['at'].strftime('%H:%M:%S')}，估算值）\n"
+        f"进程 RSS: {format_bytes(report['rss'])} · 已统计: {format_bytes(tracked)}\n\n"
+    )
+    if bot_username:
+        entry = bots.get(bot_username)
+        if not entry:
+            return text + f"⚠️ 没有 @{bot_username} 的数据"
+        text += f"🤖 @{bot_username} 共 {format_bytes(entry['total'])}\n"
+        for name, size in sorted(entry["bytes"].items(), key=lambda x: -x[1]):
+            text += f"  • {name}: {format_bytes(size)}（{entry['entries'].get(name, 0)} 条）\n"
+        return text
+    
+    text += f"占用最多的 {min(top, len(bots))} 个 Bot：\n"
+    for name, entry in sorted(bots.items(), key=lambda x: -x[1]["total"])[:top]:
+        biggest = max(entry["bytes"].items(), key=lambda x: x[1], default=("-", 0))
+        text += f"  • @{name}: {format_bytes(entry['total'])}（最大: {biggest[0]} {format_bytes(biggest[1])}）\n"
+    text += "\n共享结构：\n"
+    for name, size in report["shared"].items():
+        text += f"  • {name}: {format_bytes(size)}\n"
+    if report["tracemalloc"]:
+        text += "\n📈 tracemalloc 增长（与上次快照对比）：\n"
+        for line in report["tracemalloc"]:
+            text += f"  • {line[:150]}\n"
+    return text
+
+# ================== 性能面板 ==================
+# 后台定期采样计数器快照，面板用窗口首尾两个快照相减得到速率、增长和分位数
+PERF_FORWARD_PATHS = {"direct_forward": "直连", "forum_forward": "话题"}
+perf_samples = deque(maxlen=max(2, PERF_WINDOW // max(1, PERF_SAMPLE_INTERVAL) + 1))
+process_started_at = time.time()
+
+def take_perf_sample() -> dict:
+    """读取内存中的计数器和队列长度（数据库相关的值由调用方在线程里查）"""
+    updates = defaultdict(float)
+    for (bot_username, _), value in list(UPDATES_TOTAL.values.items()):
+        if bot_username != "__manager__":  # 管理 Bot 不参与子 Bot 排行
+            updates[bot_username] += value
+    update_queues = {
+        bot_username: app.update_queue.qsize()
+        for bot_username, app in list(running_apps.items()) if bot_username != "__manager__"
+    }
+    return {
+        "t": time.monotonic(),
+        "at": datetime.now(),
+        "updates": dict(updates),
+        "forward": {path: HANDLE_MESSAGE_SECONDS.snapshot(path) for path in PERF_FORWARD_PATHS},
+        "rate_limited": sum(API_RATE_LIMITED_TOTAL.values.values()),
+        "api_errors": sum(API_ERRORS_TOTAL.values.values()),
+        "update_queues": update_queues,
+        "log_queue": log_listener.queue.qsize(),
+        "loop_lag_max": LOOP_LAG_MAX.values.get((), 0.0),
+        "running_bots": len(update_queues),
+    }
+
+def sample_db_stats() -> dict:
+    """数据库文件大小、映射行数（计数器表）和重发队列长度"""
+    size = sum(
+        os.path.getsize(path) for path in (db.DB_FILE, db.DB_FILE + "-wal") if os.path.exists(path)
+    )
+    counters = db.get_counters()
+    mappings = sum(
+        value for items in counters.values() for name, value in items.items() if name.startswith("mappings:")
+    )
+    return {"db_size": size, "db_mappings": mappings, "outbound_queue": db.get_outbound_queue_size()}
+
+async def perf_sampler_loop():
+    """定期采样，供 📈 性能面板使用"""
+    while True:
+        try:
+            sample = take_perf_sample()
+            sample.update(await asyncio.to_thread(sample_db_stats))
+            perf_samples.append(sample)
+        except Exception as e:
+            logger.error(f"❌ 性能采样失败: {e}")
+        await asyncio.sleep(PERF_SAMPLE_INTERVAL)
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes = seconds // 60
+    if days:
+        return f"{days}天{hours}小时"
+    if hours:
+        return f"{hours}小时{minutes}分"
+    return f"{minutes}分"
+
+def render_perf_dashboard(top: int = 5):
+    """管理员性能面板（只读内存中的采样结果）"""
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 刷新", callback_data="admin_perf")],
+        [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
+    ])
+    if not perf_samples:
+        return "📈 性能数据采集中，请稍后刷新", keyboard
+    
+    last, first = perf_samples[-1], perf_samples[0]
+    window = last["t"] - first["t"]
+    text = (
+        f"📈 性能概览（{last['at'].strftime('%H:%M:%S')} 采样"
+        f"{f'，近 {format_duration(window)}' if window >= 60 else ''}）\n"
+        f"⏱ 运行时长: {format_duration(time.time() - process_started_at)} · 运行中 Bot: {last['running_bots']}\n\n"
+    )
+    
+    if window > 0:
+        rates = {
+            bot_username: (count - first["updates"].get(bot_username, 0)) / window
+            for bot_username, count in last["updates"].items()
+        }
+        text += f"📥 消息速率: {sum(rates.values()):.2f}/s\n"
+        busiest = [(name, rate) for name, rate in sorted(rates.items(), key=lambda x: -x[1]) if rate > 0][:top]
+        for name, rate in busiest:
+            text += f"  • @{name}: {rate:.2f}/s\n"
+    else:
+        text += "📥 消息速率: 需要两次采样后显示\n"
+    
+    # 处理耗时不含提示消息的自动删除等待（删除在后台任务中进行）
+    latencies = []
+    for path, label in PERF_FORWARD_PATHS.items():
+        data = [b - a for a, b in zip(first["forward"][path], last["forward"][path])] if window > 0 else last["forward"][path]
+        count = sum(data[:-1])
+        if count:
+            p95 = metrics.bucket_quantile(HANDLE_MESSAGE_SECONDS.buckets, data, 0.95)
+            bound = f"≤{p95 * 1000:.0f}ms" if p95 != float("inf") else f">{HANDLE_MESSAGE_SECONDS.buckets[-1]:.0f}s"
+            latencies.append(f"{label} {bound}（{count:.0f} 条）")
+    text += f"⚡ 转发耗时 p95: {' · '.join(latencies) if latencies else '暂无'}\n"
+    
+    text += (
+        f"🚦 429 限流: 窗口内 {last['rate_limited'] - first['rate_limited']:.0f} 次 · 累计 {last['rate_limited']:.0f} 次"
+        f"（API 错误累计 {last['api_errors']:.0f}）\n"
+    )
+    text += (
+        f"💾 数据库: {format_bytes(last['db_size'])}（{'+' if last['db_size'] >= first['db_size'] else '-'}"
+        f"{format_bytes(abs(last['db_size'] - first['db_size']))}）· 映射 {last['db_mappings']} 条"
+        f"（{last['db_mappings'] - first['db_mappings']:+d}）\n"
+    )
+    
+    queued = last["update_queues"]
+    deepest = max(queued.items(), key=lambda x: x[1], default=(None, 0))
+    text += f"📬 队列: 重发 {last['outbound_queue']} · 更新合计 {sum(queued.values())}"
+    if deepest[1]:
+        text += f"（最长 @{deepest[0]}: {deepest[1]}）"
+    text += f" · 日志 {last['log_queue']}\n"
+    text += f"🌀 事件循环最大延迟: {last['loop_lag_max'] * 1000:.0f}ms"
+    return text, keyboard
+
+# ================== 数据库后台维护 ==================
+def parse_retention(spec: str) -> dict:
+    """解析 "类型=小时" 列表；0 表示永久保留（None）"""
+    retention = {map_type: None for map_type in MAP_TYPE_KEYS}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, hours = item.partition("=")
+        name, hours = name.strip(), hours.strip()
+        if name not in MAP_TYPE_KEYS or not hours.isdigit():
+            logger.warning(f"⚠️ 忽略无效的 MAPPING_RETENTION 项: {item.strip()!r}")
+            continue
+        retention[name] = int(hours) or None
+    return retention
+
+mapping_retention = parse_retention(MAPPING_RETENTION)
+
+def maintenance_busy() -> bool:
+    """是否有积压：任一 Bot 的更新队列非空，或最近事件循环延迟超过阈值"""
+    if LOOP_LAG_MAX.values.get((), 0.0) >= LOOP_LAG_THRESHOLD:
+        return True
+    return any(
+        app.update_queue.qsize() > 0
+        for bot_username, app in list(running_apps.items()) if bot_username != "__manager__"
+    )
+
+def evict_pruned_mappings(rows) -> int:
+    """同步移除内存中对应的映射；只有值仍与被删除的行一致时才移除（可能已被新消息覆盖）"""
+    evicted = 0
+    for bot_username, map_type, key, value in rows:
+        mapping = msg_map.get(bot_username, {}).get(MAP_TYPE_KEYS.get(map_type))
+        if mapping is not None and key in mapping and str(mapping[key]) == value:
+            del mapping[key]
+            evicted += 1
+    return evicted
+
+async def prune_in_chunks(prune, label: str = None, on_deleted=None) -> int:
+    """循环调用 prune(limit)（工作线程中）直到删完；批次之间让出事件循环，按负载调整批大小和间隔
+
+    prune 返回本批删除的行数或被删除行的列表；on_deleted 在事件循环中处理每批结果；
+    label 为 tg_pruned_rows_total 的表名标签
+    """
+    chunk, pause, total = PRUNE_CHUNK, PRUNE_PAUSE, 0
+    while True:
+        started = time.perf_counter()
+        result = await asyncio.to_thread(prune, chunk)
+        held = time.perf_counter() - started
+        deleted = len(result) if isinstance(result, list) else result
+        if on_deleted is not None and deleted:
+            on_deleted(result)
+        total += deleted
+        if label:
+            PRUNED_ROWS_TOTAL.inc(label, amount=deleted)
+        if deleted < chunk:
+            return total
+        
+        if maintenance_busy():
+            # 有积压：减小批量、拉长间隔，把 db_lock 让给消息处理
+            chunk = max(50, chunk // 2)
+            pause = min(5.0, pause * 2)
+        else:
+            chunk = min(PRUNE_CHUNK * 4, chunk * 2)
+            pause = PRUNE_PAUSE
+        # 间隔至少等于本批耗时，清理最多占用一半的数据库时间
+        await asyncio.sleep(max(pause, held))
+
+maintenance_running = False  # 后台维护进行中（期间不写状态快照）
+
+async def run_maintenance() -> dict:
+    """分批清理过期映射（同步移除内存映射）、待验证记录和旧审计事件，返回统计"""
+    started = time.monotonic()
+    evicted = 0
+    
+    def evict(rows):
+        nonlocal evicted
+        evicted += evict_pruned_mappings(rows)
+    
+    # 1. 整桶过期的分桶：先分页同步内存映射，再 DROP TABLE
+    buckets = bucket_rows = 0
+    for name, map_type, day in await asyncio.to_thread(db.list_expired_buckets, mapping_retention):
+        after_id = 0
+        while True:
+            rows = await asyncio.to_thread(db.get_bucket_rows, name, after_id, PRUNE_CHUNK * 4)
+            if not rows:
+                break
+            evict([row[1:] for row in rows])
+            after_id = rows[-1][0]
+            await asyncio.sleep(0)
+        dropped = await asyncio.to_thread(db.drop_bucket, name)
+        PRUNED_ROWS_TOTAL.inc("mapping_buckets", amount=dropped)
+        buckets += 1
+        bucket_rows += dropped
+    
+    # 2. 其余过期行（旧表数据、按 Bot 更短的保留期）逐批删除
+    mappings = await prune_in_chunks(
+        lambda limit: db.prune_expired_mappings(mapping_retention, limit), "message_mappings", evict
+    )
+    expire_pending_captchas()
+    pending = await prune_in_chunks(
+        lambda limit: db.prune_expired_pending_verifications(PENDING_RETENTION_HOURS, limit), "pending_verifications"
+    )
+    # 增量备份的删除记录：超过保留期后下次导出自动改为全量，不再需要
+    await prune_in_chunks(lambda limit: db.prune_backup_tombstones(limit=limit), "backup_tombstones")
+    if ADMIN_EVENT_RETENTION_DAYS > 0:
+        await prune_in_chunks(lambda limit: db.prune_admin_events(ADMIN_EVENT_RETENTION_DAYS, limit), "admin_events")
+    
+    # 3. 把空闲页分批归还给文件系统（auto_vacuum=INCREMENTAL 时生效）
+    pages = await prune_in_chunks(lambda limit: db.incremental_vacuum(limit)) if buckets or mappings else 0
+    return {
+        "buckets": buckets, "bucket_rows": bucket_rows, "mappings": mappings, "evicted": evicted,
+        "pending": pending, "pages": pages, "seconds": time.monotonic() - started,
+    }
+
+async def maintenance_loop():
+    """定期后台维护（替代 database.py 导入时的一次性清理）"""
+    global maintenance_running
+    await asyncio.sleep(120)  # 启动后稍等，避开加载高峰
+    while True:
+        try:
+            maintenance_running = True
+            try:
+                result = await run_maintenance()
+            finally:
+                maintenance_running = False
+            if result["buckets"] or result["mappings"] or result["pending"]:
+                text = (
+                    f"🧹 定期清理：删除 {result['buckets']} 个过期分桶（{result['bucket_rows']} 条映射）、"
+                    f"逐行删除 {result['mappings']} 条过期映射（内存同步移除 {result['evicted']} 条）、"
+                    f"{result['pending']} 条待验证记录，归还 {result['pages']} 个空闲页，耗时 {result['seconds']:.1f}s"
+                )
+                logger.info(text)
+                await send_admin_log(text, category="maintenance")
+        except Exception as e:
+            logger.error(f"❌ 后台维护失败: {e}")
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+# ================== Bot 健康检查 ==================
+health_check_lock = asyncio.Lock()
+
+async def check_bot_health(bot_username: str, token: str, semaphore: asyncio.Semaphore) -> dict:
+    """检测单个 Bot 的 Token 是否有效（运行中的 Bot 直接复用其客户端）"""
+    async with semaphore:
+        started = time.monotonic()
+        result = {"bot_username": bot_username, "status": "ok", "error": ""}
+        try:
+            app = running_apps.get(bot_username)
+            if app is not None:
+                await asyncio.wait_for(app.bot.get_me(), HEALTH_CHECK_TIMEOUT)
+            else:
+                test_bot = Bot(token=token, base_url=TG_API_BASE_URL) if TG_API_BASE_URL else Bot(token=token)
+                try:
+                    # initialize() 内部会调用 get_me 校验 Token
+                    await asyncio.wait_for(test_bot.initialize(), HEALTH_CHECK_TIMEOUT)
+                finally:
+                    try:
+                        await test_bot.shutdown()
+                    except Exception:
+                        pass
+        except InvalidToken:
+            # 异常文本里带有完整 Token，不能写入数据库或显示在报告中
+            result.update(status="invalid", error="Token 无效")
+        except asyncio.TimeoutError:
+            result.update(status="error", error="检测超时")
+        except Exception as e:
+            # 网络错误等无法判断 Token 是否失效，仅记录为检测异常（错误里的请求地址可能包含 Token）
+            result.update(status="error", error=str(e).replace(token, "***")[:200])
+        result["latency_ms"] = int((time.monotonic() - started) * 1000)
+        return result
+
+async def run_health_checks() -> dict:
+    """并发检测所有 Bot，并把结果写入数据库；返回 {bot_username: result}"""
+    async with health_check_lock:
+        targets = [
+            (b["bot_username"], b["token"])
+            for info in bots_data.values()
+            for b in info.get("bots", [])
+        ]
+        semaphore = asyncio.Semaphore(HEALTH_CHECK_CONCURRENCY)
+        results = await asyncio.gather(
+            *(check_bot_health(username, token, semaphore) for username, token in targets)
+        )
+        await asyncio.to_thread(db.save_bot_health, results)
+        
+        invalid = sum(1 for r in results if r["status"] == "invalid")
+        errors = sum(1 for r in results if r["status"] == "error")
+        logger.info(f"🩺 健康检查完成: 共 {len(results)} 个，失效 {invalid} 个，异常 {errors} 个")
+        return {r["bot_username"]: r for r in results}
+
+async def health_check_loop():
+    """定时后台健康检查"""
+    await asyncio.sleep(60)  # 启动后稍等，避开启动高峰
+    while True:
+        try:
+            await run_health_checks()
+        except Exception as e:
+            logger.error(f"❌ 后台健康检查失败: {e}")
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+def render_health_report():
+    """根据数据库中保存的检测结果生成管理员界面（不发起任何网络请求）
+
+    Returns:
+        (text, keyboard, invalid_bot_usernames)
+    """
+    health = db.get_all_bot_health()
+    all_bots = [
+        (b["bot_username"], owner_id)
+        for owner_id, info in bots_data.items()
+        for b in info.get("bots", [])
+    ]
+    
+    valid, invalid, errors, unchecked = [], [], [], []
+    last_checked = None
+    for bot_username, owner_id in all_bots:
+        h = health.get(bot_username)
+        if not h:
+            unchecked.append(bot_username)
+            continue
+        if h["checked_at"] and (last_checked is None or h["checked_at"] > last_checked):
+            last_checked = h["checked_at"]
+        entry = {"username": bot_username, "owner": owner_id, "error": h["error"]}
+        if h["status"] == "ok":
+            valid.append(entry)
+        elif h["status"] == "invalid":
+            invalid.append(entry)
+        else:
+            errors.append(entry)
+    
+    text = "🩺 机器人健康状态\n\n"
+    text += f"⏰ 最近检测: {last_checked or '尚未检测'}\n"
+    text += f"✅ 有效: {len(valid)} 个\n"
+    text += f"❌ 失效: {len(invalid)} 个\n"
+    if errors:
+        text += f"⚠️ 检测异常: {len(errors)} 个（网络等原因，不会被清理）\n"
+    if unchecked:
+        text += f"⏳ 未检测: {len(unchecked)} 个\n"
+    
+    if invalid:
+        text += "\n🗑️ 失效机器人列表\n\n"
+        for idx, bot in enumerate(invalid[:10], 1):  # 最多显示10个
+            text += f"{idx}. @{bot['username']}\n"
+            text += f"   Owner ID: {bot['owner']}\n\n"
+        if len(invalid) > 10:
+            text += f"\n... 还有 {len(invalid) - 10} 个\n"
+    elif valid and not errors and not unchecked:
+        text += "\n🎉 所有机器人都正常！"
+    
+    keyboard = []
+    if invalid:
+        keyboard.append([InlineKeyboardButton("🗑️ 删除所有失效Bot", callback_data="admin_confirm_clean")])
+    keyboard.append([InlineKeyboardButton("🔄 立即检测", callback_data="admin_recheck_health")])
+    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
+    
+    return text, InlineKeyboardMarkup(keyboard), [bot["username"] for bot in invalid]
+
 # ================== 宿主机 /start 菜单 ==================
 def is_admin(user_id: int) -> bool:
     """检查用户是否为管理员"""
@@ -436,6 +1982,7 @@ def manager_main_menu(user_id: int):
         keyboard.append([InlineKeyboardButton("👥 用户清单", callback_data="admin_users")])
         keyboard.append([InlineKeyboardButton("📢 广播通知", callback_data="admin_broadcast")])
         keyboard.append([InlineKeyboardButton("🗑️ 清理失效Bot", callback_data="admin_clean_invalid")])
+        keyboard.append([InlineKeyboardButton("📈 性能", callback_data="admin_perf")])
     
     return InlineKeyboardMarkup(keyboard)
 
@@ -449,11 +1996,264 @@ async def manager_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
         await query.message.edit_text("📣 欢迎使用客服机器人管理面板\n👇 请选择操作：", reply_markup=manager_main_menu(user_id))
 
+async def admin_audit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """管理员查询审计日志：/audit [条数] [@bot] [分类]"""
+    if not is_admin(update.message.from_user.id):
+        await reply_and_auto_delete(update.message, "⚠️ 仅管理员可用", delay=5)
+        return
+    
+    limit, bot_username, category = 20, None, None
+    for arg in context.args:
+        if arg.isdigit():
+            limit = max(1, min(int(arg), 50))
+        elif arg.startswith("@"):
+            bot_username = arg[1:]
+        elif arg in ADMIN_EVENT_LABELS:
+            category = arg
+    
+    events = db.get_admin_events(limit, bot_username=bot_username, category=category)
+    if not events:
+        await update.message.reply_text("📋 暂无审计记录")
+        return
+    
+    text = f"🧾 审计日志（最近 {len(events)} 条）\n\n"
+    for ev in reversed(events):
+        label = ADMIN_EVENT_LABELS.get(ev["category"], ev["category"])
+        mark = "❗" if ev["critical"] else "•"
+        line = f"{mark} [{ev['created_at']}] {label}: {ev['text'].replace(chr(10), ' | ')}\n"
+        if len(text) + len(line) > 4000:
+            break
+        text += line
+    
+    await update.message.reply_text(text, parse_mode="HTML", disable_web_page_preview=True)
+
+async def admin_slow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """管理员查看最近最慢的 Update：/slow [条数] [@bot]"""
+    if not is_admin(update.message.from_user.id):
+        await reply_and_auto_delete(update.message, "⚠️ 仅管理员可用", delay=5)
+        return
+    
+    limit, bot_username = 5, None
+    for arg in context.args:
+        if arg.isdigit():
+            limit = max(1, min(int(arg), 20))
+        elif arg.startswith("@"):
+            bot_username = arg[1:]
+    
+    traces = flight_recorder.slowest(limit, bot=bot_username)
+    if not traces:
+        await update.message.reply_text("📋 暂无记录")
+        return
+    
+    text = f"🐢 最近 {len(flight_recorder.traces)} 个 Update 中最慢的 {len(traces)} 个\n\n"
+    for trace in traces:
+        block = trace.format() + "\n\n"
+        if len(text) + len(block) > 4000:
+            break
+        text += block
+    await update.message.reply_text(text)
+
+profile_session = None  # 进行中的分析：{"mode", "stop": asyncio.Event, "task"}
+
+async def run_profile(bot, chat_id: int, seconds: int, mode: str):
+    """在事件循环线程上做一次限时分析，结束后把折叠栈和函数排行作为文件发给管理员"""
+    global profile_session
+    stop = profile_session["stop"]
+    started = time.monotonic()
+    try:
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=seconds)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                profiler.disable()
+            stats = pstats.Stats(profiler)
+            collapsed = metrics.cprofile_collapsed(stats)
+            report = metrics.cprofile_top(stats)
+            summary = f"共 {stats.total_calls} 次函数调用"
+        else:
+            sampler = metrics.StackSampler(threading.get_ident(), PROFILER_INTERVAL, PROFILER_MAX_OVERHEAD)
+            sampler.start(seconds)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=seconds)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                await asyncio.to_thread(sampler.stop)
+            collapsed = sampler.collapsed()
+            report = sampler.top()
+            summary = (
+                f"{sampler.samples} 个样本 · 最终间隔 {sampler.interval * 1000:.1f}ms · "
+                f"采样开销 {sampler.overhead * 100:.2f}%"
+            )
+        
+        elapsed = time.monotonic() - started
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        caption = f"🔬 {mode} 分析完成：{elapsed:.0f}s，{summary}"
+        logger.info(caption)
+        await bot.send_document(chat_id, document=collapsed.encode("utf-8") or b"\n",
+                                filename=f"profile-{mode}-{stamp}.folded", caption=caption)
+        await bot.send_document(chat_id, document=report.encode("utf-8"),
+                                filename=f"profile-{mode}-{stamp}-top.txt")
+    except Exception as e:
+        logger.error(f"❌ 性能分析失败: {e}")
+        try:
+            await bot.send_message(chat_id, f"❌ 性能分析失败: {e}")
+        except Exception:
+            pass
+    finally:
+        profile_session = None
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """管理员运行时性能分析：/profile [秒数] [sample|cprofile]，/profile stop 提前结束"""
+    global profile_session
+    if not is_admin(update.message.from_user.id):
+        await reply_and_auto_delete(update.message, "⚠️ 仅管理员可用", delay=5)
+        return
+    
+    args = [a.lower() for a in context.args]
+    if "stop" in args:
+        if profile_session is None:
+            await update.message.reply_text("📋 当前没有进行中的分析")
+        else:
+            profile_session["stop"].set()
+            await update.message.reply_text("⏹ 正在停止，结果稍后发送")
+        return
+    if profile_session is not None:
+        await update.message.reply_text(f"⚠️ 已有 {profile_session['mode']} 分析在进行中（/profile stop 可提前结束）")
+        return
+    
+    mode = "cprofile" if "cprofile" in args else "sample"
+    limit = PROFILER_CPROFILE_MAX_SECONDS if mode == "cprofile" else PROFILER_MAX_SECONDS
+    seconds = next((int(a) for a in args if a.isdigit()), 30)
+    seconds = max(1, min(seconds, limit))
+    
+    profile_session = {"mode": mode, "stop": asyncio.Event()}
+    profile_session["task"] = start_background_task(
+        run_profile(context.bot, update.effective_chat.id, seconds, mode), name="profile"
+    )
+    note = "（cProfile 会明显拖慢所有 Bot，请尽量缩短时间）" if mode == "cprofile" else ""
+    await update.message.reply_text(f"🔬 开始 {mode} 分析，{seconds}s 后自动停止{note}")
+
+def format_retention(hours) -> str:
+    if not hours:
+        return "永久"
+    return f"{hours // 24}天" if hours % 24 == 0 else f"{hours}小时"
+
+async def admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """管理员查看备份状态：/backup，/backup now 立即备份（跳过合并等待）"""
+    if not is_admin(update.message.from_user.id):
+        await reply_and_auto_delete(update.message, "⚠️ 仅管理员可用", delay=5)
+        return
+    
+    if context.args and context.args[0].lower() == "now" and os.path.exists(BACKUP_SCRIPT):
+        trigger_backup(silent=False, immediate=True)
+    await update.message.reply_text(format_backup_status())
+
+async def admin_retention(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """管理员设置映射保留策略：/retention [类型 小时数|forever|default] [@bot]"""
+    if not is_admin(update.message.from_user.id):
+        await reply_and_auto_delete(update.message, "⚠️ 仅管理员可用", delay=5)
+        return
+    
+    bot_username = next((a[1:] for a in context.args if a.startswith("@")), "")
+    args = [a for a in context.args if not a.startswith("@")]
+    
+    if len(args) >= 2:
+        map_type, value = args[0], args[1].lower()
+        if map_type not in MAP_TYPE_KEYS:
+            await update.message.reply_text(f"⚠️ 未知的映射类型，可选: {', '.join(MAP_TYPE_KEYS)}")
+            return
+        if bot_username and value != "default" and not is_bot_configured(bot_username):  # default 仍可清除已删除 Bot 的残留覆盖
+            await update.message.reply_text(f"⚠️ 找不到 Bot @{bot_username}")
+            return
+        if value == "default":
+            db.delete_retention_policy(map_type, bot_username)
+        elif value in ("forever", "0"):
+            db.set_retention_policy(map_type, None, bot_username)
+        elif value.isdigit():
+            db.set_retention_policy(map_type, int(value), bot_username)
+        else:
+            await update.message.reply_text("⚠️ 用法: /retention 类型 小时数|forever|default [@bot]")
+            return
+        await send_admin_log(
+            f"🗂 保留策略: {'@' + html.escape(bot_username) if bot_username else '全局'} {map_type} → {value}",
+            category="config", bot_username=bot_username or None
+        )
+    
+    policies = db.get_retention_policies()
+    effective = {**mapping_retention, **policies.get("", {})}
+    text = "🗂 映射保留策略（后台维护按此清理）\n\n全局：\n"
+    for map_type in MAP_TYPE_KEYS:
+        mark = " ✏️" if map_type in policies.get("", {}) else ""
+        text += f"  • {map_type}: {format_retention(effective[map_type])}{mark}\n"
+    overrides = {bot: items for bot, items in policies.items() if bot}
+    if overrides:
+        text += "\n按 Bot 覆盖：\n"
+        for bot, items in sorted(overrides.items()):
+            text += f"  • @{bot}: " + ", ".join(f"{t}={format_retention(h)}" for t, h in items.items()) + "\n"
+    text += "\n用法: /retention 类型 小时数|forever|default [@bot]"
+    await update.message.reply_text(text)
+
+async def admin_memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """管理员查看内存统计：/mem [@bot]"""
+    if not is_admin(update.message.from_user.id):
+        await reply_and_auto_delete(update.message, "⚠️ 仅管理员可用", delay=5)
+        return
+    bot_username = next((arg[1:] for arg in context.args if arg.startswith("@")), None)
+    await update.message.reply_text(render_memory_report(bot_username)[:4000])
+
+def traces_route(query: str):
+    """HTTP /traces?n=10&bot=xxx：最慢的 Update（JSON）"""
+    params = dict(part.partition("=")[::2] for part in query.split("&") if part)
+    limit = int(params["n"]) if params.get("n", "").isdigit() else 20
+    traces = flight_recorder.slowest(limit, bot=params.get("bot") or None)
+    return "application/json; charset=utf-8", json.dumps([t.to_dict() for t in traces], ensure_ascii=False, indent=2)
+
+metrics.routes["/traces"] = traces_route
+
+def visible_dead_letter_bots(user_id: int):
+    """管理员可查看全部死信（返回 None），Bot 主人只能查看自己的 Bot"""
+    if is_admin(user_id):
+        return None
+    return [b["bot_username"] for b in bots_data.get(str(user_id), {}).get("bots", [])]
+
+def render_dead_letters(user_id: int):
+    """生成死信列表文本和按钮"""
+    letters = db.get_dead_letters(visible_dead_letter_bots(user_id), limit=10)
+    if not letters:
+        return "📭 暂无投递失败的消息", None
+    
+    text = f"💀 投递失败的消息（最近 {len(letters)} 条）\n\n"
+    keyboard = []
+    for letter in letters:
+        target = letter["payload"].get("kwargs", {}).get("chat_id", "")
+        text += (
+            f"#{letter['id']} @{letter['bot_username']} {letter['method']} → {target}\n"
+            f"   重试 {letter['attempts']} 次 · {letter['failed_at']}\n"
+            f"   {letter['last_error'][:80]}\n"
+        )
+        keyboard.append([
+            InlineKeyboardButton(f"🔁 重发 #{letter['id']}", callback_data=f"dl_replay_{letter['id']}"),
+            InlineKeyboardButton(f"🗑 丢弃 #{letter['id']}", callback_data=f"dl_drop_{letter['id']}")
+        ])
+    keyboard.append([InlineKeyboardButton("🔁 全部重发", callback_data="dl_replay_all")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def dead_letters_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看投递失败的消息：/dl"""
+    text, markup = render_dead_letters(update.message.from_user.id)
+    await update.message.reply_text(text, reply_markup=markup)
+
 # ================== 子机器人 /start ==================
 async def subbot_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """子机器人的 /start 命令，发送验证码或欢迎消息"""
     user_id = update.message.from_user.id
     bot_username = context.bot.username
+    remember_user(update.message.from_user)
     
     # 如果用户已验证，显示欢迎信息
     if is_verified(bot_username, user_id):
@@ -463,11 +2263,8 @@ async def subbot_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         # 生成验证码并发送
         captcha_data = generate_captcha()
-        # 💾 保存到数据库（持久化）
-        db.add_pending_verification(bot_username, user_id, captcha_data['answer'])
-        # 内存中也保留（用于快速访问）
-        verification_key = f"{bot_username}_{user_id}"
-        pending_verifications[verification_key] = captcha_data['answer']
+        # 💾 记录验证码（内存，后台写回数据库）
+        set_pending_captcha(bot_username, user_id, captcha_data['answer'])
         
         # 根据验证码类型构建消息
         captcha_type = captcha_data['type']
@@ -525,6 +2322,20 @@ async def subbot_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ================== 消息转发逻辑（直连/话题 可切换） ==================
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, owner_id: int, bot_username: str):
+    """处理子 Bot 消息，并按分支记录处理耗时"""
+    token = message_path.set("other")
+    start = time.perf_counter()
+    try:
+        await _handle_message(update, context, owner_id, bot_username)
+    finally:
+        path = message_path.get()
+        HANDLE_MESSAGE_SECONDS.observe(time.perf_counter() - start, path)
+        trace = metrics.current_trace.get()
+        if trace is not None:
+            trace.path = path
+        message_path.reset(token)
+
+async def _handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, owner_id: int, bot_username: str):
     """
     - 直连模式(direct):
       用户私聊 -> 转发到 owner 私聊；owner 在私聊里"回复该条转发" -> 回到对应用户
@@ -547,6 +2358,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
         
         is_edit = update.edited_message is not None
         chat_id = message.chat.id
+        # 顺手刷新发送者资料缓存
+        remember_user(message.from_user)
 
         # 找到该子机器人的配置
         bot_cfg = get_bot_cfg(owner_id, bot_username)
@@ -561,6 +2374,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
 
         # ---------- /bl (blocklist) 功能 ----------
         cmd = message.text.strip() if message.text else ""
+        if cmd.startswith("/"):
+            message_path.set("command")
         if cmd and (cmd == "/bl" or cmd.startswith("/bl ") or cmd.startswith("/bl@") or 
                     cmd == "/blocklist" or cmd.startswith("/blocklist ") or cmd.startswith("/blocklist@")):
             if message.from_user.id != owner_id:
@@ -572,12 +2387,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                 return
 
             text = f"📋 黑名单列表 (@{bot_username})：\n\n"
+            # 缓存未命中的用户并发拉取资料
+            profiles = await get_user_profiles(context.bot, blocked_users)
             for idx, uid in enumerate(blocked_users, 1):
-                try:
-                    user = await context.bot.get_chat(uid)
+                user = profiles.get(uid)
+                if user:
                     name = user.full_name or f"@{user.username}" if user.username else "匿名用户"
                     text += f"{idx}. {name} (ID: <code>{uid}</code>)\n"
-                except:
+                else:
                     text += f"{idx}. 用户ID: <code>{uid}</code> (已删除账号)\n"
 
             await message.reply_text(text, parse_mode="HTML")
@@ -618,19 +2435,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     # 通知到管理频道 - 获取用户信息
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
                     try:
-                        user = await context.bot.get_chat(target_user)
+                        user = await get_user_profile(context.bot, target_user)
                         user_username = user.username
                         user_name = user.full_name or "匿名用户"
                         # 优先使用 @用户名
                         if user_username:
                             user_display = f"@{user_username}"
                         else:
-                            user_display = f"<a href='tg://user?id={target_user}'>{user_name}</a>"
+                            user_display = f"<a href='tg://user?id={target_user}'>{html.escape(user_name)}</a>"
                         log_text = f"🚫 Bot @{bot_username} 拉黑用户 {user_display} (ID: <code>{target_user}</code>) · {now}"
                     except:
                         # 如果获取失败，仅显示ID
                         log_text = f"🚫 Bot @{bot_username} 拉黑用户 ID: <code>{target_user}</code> · {now}"
-                    await send_admin_log(log_text)
+                    await send_admin_log(log_text, category="block", bot_username=bot_username)
                 else:
                     await message.reply_text(f"⚠️ 用户 {target_user} 已在黑名单中")
             else:
@@ -673,19 +2490,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     # 通知到管理频道 - 获取用户信息
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
                     try:
-                        user = await context.bot.get_chat(target_user)
+                        user = await get_user_profile(context.bot, target_user)
                         user_username = user.username
                         user_name = user.full_name or "匿名用户"
                         # 优先使用 @用户名
                         if user_username:
                             user_display = f"@{user_username}"
                         else:
-                            user_display = f"<a href='tg://user?id={target_user}'>{user_name}</a>"
+                            user_display = f"<a href='tg://user?id={target_user}'>{html.escape(user_name)}</a>"
                         log_text = f"✅ Bot @{bot_username} 解除拉黑用户 {user_display} (ID: <code>{target_user}</code>) · {now}"
                     except:
                         # 如果获取失败，仅显示ID
                         log_text = f"✅ Bot @{bot_username} 解除拉黑用户 ID: <code>{target_user}</code> · {now}"
-                    await send_admin_log(log_text)
+                    await send_admin_log(log_text, category="unblock", bot_username=bot_username)
                 else:
                     await message.reply_text(f"⚠️ 用户 {target_user} 不在黑名单中")
             else:
@@ -728,19 +2545,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     # 通知到管理频道 - 获取用户信息
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
                     try:
-                        user = await context.bot.get_chat(target_user)
+                        user = await get_user_profile(context.bot, target_user)
                         user_username = user.username
                         user_name = user.full_name or "匿名用户"
                         # 优先使用 @用户名
                         if user_username:
                             user_display = f"@{user_username}"
                         else:
-                            user_display = f"<a href='tg://user?id={target_user}'>{user_name}</a>"
+                            user_display = f"<a href='tg://user?id={target_user}'>{html.escape(user_name)}</a>"
                         log_text = f"🔓 Bot @{bot_username} 取消用户 {user_display} (ID: <code>{target_user}</code>) 验证 · {now}"
                     except:
                         # 如果获取失败，仅显示ID
                         log_text = f"🔓 Bot @{bot_username} 取消用户 ID: <code>{target_user}</code> 验证 · {now}"
-                    await send_admin_log(log_text)
+                    await send_admin_log(log_text, category="unverify", bot_username=bot_username)
                 else:
                     await message.reply_text(f"⚠️ 用户 {target_user} 未验证或不存在")
             else:
@@ -772,7 +2589,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
             # 如果找到了用户，展示信息；否则静默忽略
             if target_user:
                 try:
-                    user = await context.bot.get_chat(target_user)
+                    user = await get_user_profile(context.bot, target_user)
                     is_blocked = is_blacklisted(bot_username, user.id)
                     user_verified = is_verified(bot_username, user.id)
                     
@@ -831,25 +2648,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
         # ---------- 验证码检查（普通用户） ----------
         if message.chat.type == "private" and chat_id != owner_id:
             user_id = message.from_user.id
-            verification_key = f"{bot_username}_{user_id}"
-            
-            logger.info(f"[验证检查] Bot: @{bot_username}, 用户: {user_id}, 已验证: {is_verified(bot_username, user_id)}")
             
             # 如果用户未验证
             if not is_verified(bot_username, user_id):
-                # 检查是否有待验证的验证码（优先从数据库读取）
-                expected_captcha = db.get_pending_verification(bot_username, user_id)
-                
-                # 如果数据库中没有，检查内存
-                if not expected_captcha and verification_key in pending_verifications:
-                    expected_captcha = pending_verifications[verification_key]
+                message_path.set("verify")
+                # 检查是否有待验证的验证码（内存查找，启动时已从数据库恢复）
+                expected_captcha = get_pending_captcha(bot_username, user_id)
                 
                 if expected_captcha:
                     user_input = message.text.strip() if message.text else ""
                     
-                    logger.info(f"[验证码输入] 用户 {user_id} 输入: '{user_input}', 期望: '{expected_captcha}'")
-                    
-                    # 验证码正确
+                    # 验证码正确（不记录用户输入和答案）
+                    hot_log("verify", "[验证码输入] 用户 %s 提交验证码", user_id, bot=bot_username, user=user_id,
+                            passed=user_input == expected_captcha)
                     if user_input == expected_captcha:
                         # 获取用户信息
                         user_name = message.from_user.full_name or "匿名用户"
@@ -858,9 +2669,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                         # 添加到已验证用户（包含用户信息）
                         add_verified_user(bot_username, user_id, user_name, user_username)
                         
-                        # 💾 从数据库和内存中删除待验证记录
-                        db.remove_pending_verification(bot_username, user_id)
-                        pending_verifications.pop(verification_key, None)
+                        # 💾 删除待验证记录（后台写回数据库）
+                        pop_pending_captcha(bot_username, user_id)
                         
                         # 🔧 为 owner 设置命令菜单（如果之前没设置成功）
                         if user_id == owner_id:
@@ -917,13 +2727,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                         return
                 else:
                     # 没有待验证的验证码，生成新的
-                    logger.info(f"[生成验证码] 用户 {user_id} 首次发送消息，生成验证码")
+                    hot_log("verify", "[生成验证码] 用户 %s 首次发送消息，生成验证码", user_id, bot=bot_username, user=user_id)
                     captcha_data = generate_captcha()
                     
-                    # 💾 保存到数据库和内存
-                    db.add_pending_verification(bot_username, user_id, captcha_data['answer'])
-                    pending_verifications[verification_key] = captcha_data['answer']
-                    logger.info(f"[验证码] 类型: {captcha_data['type']}, 答案: {captcha_data['answer']}")
+                    # 💾 记录验证码（内存，后台写回数据库）
+                    set_pending_captcha(bot_username, user_id, captcha_data['answer'])
+                    hot_log("verify", "[验证码] 类型: %s", captcha_data['type'], bot=bot_username, user=user_id)
                     
                     # 根据验证码类型构建消息
                     retry_captcha_type = captcha_data['type']
@@ -947,15 +2756,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
         # ---------- 黑名单拦截 ----------
         if message.chat.type == "private" and chat_id != owner_id:
             if is_blacklisted(bot_username, chat_id):
+                message_path.set("blocked")
                 # 被拉黑用户发消息，静默忽略或返回提示
                 await reply_and_auto_delete(message, "⚠️ 你已被管理员拉黑，消息无法发送。", delay=5)
-                logger.info(f"拦截黑名单用户 {chat_id} 的消息 (@{bot_username})")
+                hot_log("blocked", "拦截黑名单用户 %s 的消息 (@%s)", chat_id, bot_username, bot=bot_username, user=chat_id)
                 return
 
         # ---------- 直连模式 ----------
         if mode == "direct":
             # 普通用户发私聊 -> 转给主人
             if message.chat.type == "private" and chat_id != owner_id:
+                message_path.set("direct_forward")
                 user_msg_key = f"{chat_id}_{message.message_id}"
                 
                 if is_edit:
@@ -975,7 +2786,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                     message_id=forward_msg_id,
                                     text=f"{user_header}\n\n{message.text} [✏️已编辑]"
                                 )
-                                logger.info(f"用户 {chat_id} 编辑消息成功")
+                                hot_log("direct", "用户 %s 编辑消息成功", chat_id, bot=bot_username, user=chat_id)
                                 await reply_and_auto_delete(message, "✅ 编辑同步成功", delay=3)
                             else:
                                 # 如果不是文本消息，无法直接编辑，发送新消息提示
@@ -1002,39 +2813,39 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     
                     if message.text:
                         # 文本消息：发送可编辑的消息
-                        sent_msg = await context.bot.send_message(
-                            chat_id=owner_id,
-                            text=f"{user_header}\n\n{message.text}"
+                        # 💾 投递成功后保存到数据库和内存（失败则进入重发队列）
+                        sent_msg = await deliver(
+                            context.bot, bot_username, "send_message",
+                            {"chat_id": owner_id, "text": f"{user_header}\n\n{message.text}"},
+                            maps=[
+                                ["direct", SENT, chat_id],
+                                ["user_forward", user_msg_key, SENT],
+                                ["forward_user", SENT, user_msg_key],
+                            ],
+                            user_id=chat_id
                         )
-                        # 💾 保存到数据库和内存
-                        msg_map[bot_username]["direct"][str(sent_msg.message_id)] = chat_id
-                        db.set_mapping(bot_username, "direct", str(sent_msg.message_id), str(chat_id), chat_id)
-                        
-                        msg_map[bot_username]["user_to_forward"][user_msg_key] = sent_msg.message_id
-                        db.set_mapping(bot_username, "user_forward", user_msg_key, str(sent_msg.message_id), chat_id)
-                        
-                        msg_map[bot_username]["forward_to_user"][str(sent_msg.message_id)] = user_msg_key
-                        db.set_mapping(bot_username, "forward_user", str(sent_msg.message_id), user_msg_key, chat_id)
                     else:
-                        # 非文本消息：先发送用户信息，再转发原消息
-                        await context.bot.send_message(
-                            chat_id=owner_id,
-                            text=user_header
-                        )
-                        fwd_msg = await context.bot.forward_message(
-                            chat_id=owner_id,
-                            from_chat_id=chat_id,
-                            message_id=message.message_id
+                        # 非文本消息：先发送用户信息，再转发原消息（用户信息进入重发队列时，转发排在它之后）
+                        sent_msg = await deliver(
+                            context.bot, bot_username, "send_message",
+                            {"chat_id": owner_id, "text": user_header},
+                            then=[{
+                                "method": "forward_message",
+                                "kwargs": {"chat_id": owner_id, "from_chat_id": chat_id, "message_id": message.message_id},
+                                "maps": [["direct", SENT, chat_id]],
+                                "user_id": chat_id,
+                            }]
                         )
-                        # 💾 保存到数据库和内存
-                        msg_map[bot_username]["direct"][str(fwd_msg.message_id)] = chat_id
-                        db.set_mapping(bot_username, "direct", str(fwd_msg.message_id), str(chat_id), chat_id)
                     
-                    await reply_and_auto_delete(message, "✅ 已成功发送", delay=3)
+                    if sent_msg:
+                        await reply_and_auto_delete(message, "✅ 已成功发送", delay=3)
+                    else:
+                        await reply_and_auto_delete(message, QUEUED_NOTICE, delay=5)
                 return
 
             # 主人在私聊里回复 -> 回用户
             if message.chat.type == "private" and chat_id == owner_id and message.reply_to_message:
+                message_path.set("owner_reply")
                 direct_map = msg_map[bot_username]["direct"]
                 target_user = direct_map.get(str(message.reply_to_message.message_id))
                 
@@ -1052,7 +2863,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                         message_id=user_msg_id,
                                         text=message.text
                                     )
-                                    logger.info(f"主人编辑回复成功")
+                                    hot_log("owner_reply", "主人编辑回复成功", bot=bot_username)
                                     await reply_and_auto_delete(message, "✅ 编辑同步成功", delay=2)
                                 else:
                                     await reply_and_auto_delete(message, "⚠️ 非文本消息无法编辑", delay=3)
@@ -1062,15 +2873,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                         return
                     else:
                         # 新回复
-                        sent_msg = await context.bot.copy_message(
-                            chat_id=target_user,
-                            from_chat_id=owner_id,
-                            message_id=message.message_id
+                        # 💾 投递成功后保存映射关系到数据库和内存
+                        sent_msg = await deliver(
+                            context.bot, bot_username, "copy_message",
+                            {"chat_id": target_user, "from_chat_id": owner_id, "message_id": message.message_id},
+                            maps=[["owner_user", owner_msg_key, SENT]],
+                            user_id=int(target_user)
                         )
-                        # 💾 保存映射关系到数据库和内存
-                        msg_map[bot_username]["owner_to_user"][owner_msg_key] = sent_msg.message_id
-                        db.set_mapping(bot_username, "owner_user", owner_msg_key, str(sent_msg.message_id), int(target_user))
-                        await reply_and_auto_delete(message, "✅ 回复已送达", delay=2)
+                        if sent_msg:
+                            await reply_and_auto_delete(message, "✅ 回复已送达", delay=2)
+                        else:
+                            await reply_and_auto_delete(message, QUEUED_NOTICE, delay=5)
                 else:
                     if not is_edit:
                         await reply_and_auto_delete(message, "⚠️ 找不到对应的用户映射。", delay=5)
@@ -1078,7 +2891,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
 
         # ---------- 话题模式 ----------
         elif mode == "forum":
-            logger.info(f"[话题模式] Bot: @{bot_username}, forum_group_id: {forum_group_id}")
             
             if not forum_group_id:
                 logger.warning(f"[话题模式] 未设置群ID，无法转发")
@@ -1090,27 +2902,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
 
             # 普通用户发私聊 -> 转到对应话题
             if message.chat.type == "private" and chat_id != owner_id:
-                logger.info(f"[话题模式] 收到用户 {chat_id} 的私聊消息，准备转发到群 {forum_group_id}")
+                message_path.set("forum_forward")
+                hot_log("forum", "[话题模式] 收到用户 %s 的私聊消息，准备转发到群 %s", chat_id, forum_group_id,
+                        bot=bot_username, user=chat_id)
                 uid_key = str(chat_id)
                 topic_id = topics.get(uid_key)
                 user_msg_key = f"{chat_id}_{message.message_id}"
 
                 # 若无映射，先创建话题
                 if not topic_id:
-                    display_name = (
-                        message.from_user.full_name
-                        or (f"@{message.from_user.username}" if message.from_user.username else None)
-                        or "匿名用户"
-                    )
                     try:
-                        topic = await context.bot.create_forum_topic(
-                            chat_id=forum_group_id,
-                            name=f"{display_name}"
-                        )
-                        topic_id = topic.message_thread_id
-                        # 💾 保存到数据库和内存
-                        topics[uid_key] = topic_id
-                        db.set_mapping(bot_username, "topic", uid_key, str(topic_id), chat_id)
+                        topic_id = await get_or_create_topic(context.bot, bot_username, forum_group_id, message.from_user)
                     except Exception as e:
                         logger.error(f"创建话题失败: {e}")
                         await reply_and_auto_delete(message, "❌ 创建话题失败，请联系管理员。", delay=5)
@@ -1130,7 +2932,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                         message_id=forward_msg_id,
                                         text=f"{message.text} [✏️已编辑]"
                                     )
-                                    logger.info(f"[话题模式] 用户 {chat_id} 编辑消息成功")
+                                    hot_log("forum", "[话题模式] 用户 %s 编辑消息成功", chat_id, bot=bot_username, user=chat_id)
                                     # 话题模式：直接发送消息给用户，不使用reply
                                     await send_and_auto_delete(context, chat_id, "✅ 编辑同步成功", delay=3)
                                 else:
@@ -1153,50 +2955,46 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                         return
                     else:
                         # 新消息
-                        logger.info(f"[话题模式] 转发消息到话题 {topic_id}")
+                        hot_log("forum", "[话题模式] 转发消息到话题 %s", topic_id, bot=bot_username, user=chat_id)
                         
                         if message.text:
                             # 文本消息：发送可编辑的消息(话题模式不显示用户信息)
-                            sent_msg = await context.bot.send_message(
-                                chat_id=forum_group_id,
-                                message_thread_id=topic_id,
-                                text=message.text
+                            # 💾 投递成功后保存映射关系到数据库和内存
+                            sent_msg = await deliver(
+                                context.bot, bot_username, "send_message",
+                                {"chat_id": forum_group_id, "message_thread_id": topic_id, "text": message.text},
+                                maps=[
+                                    ["user_forward", user_msg_key, SENT],
+                                    ["forward_user", SENT, user_msg_key],
+                                ],
+                                user_id=chat_id
                             )
-                            # 💾 保存映射关系到数据库和内存
-                            msg_map[bot_username]["user_to_forward"][user_msg_key] = sent_msg.message_id
-                            db.set_mapping(bot_username, "user_forward", user_msg_key, str(sent_msg.message_id), chat_id)
-                            
-                            msg_map[bot_username]["forward_to_user"][str(sent_msg.message_id)] = user_msg_key
-                            db.set_mapping(bot_username, "forward_user", str(sent_msg.message_id), user_msg_key, chat_id)
                         else:
                             # 非文本消息：直接转发(话题模式)
-                            await context.bot.forward_message(
-                                chat_id=forum_group_id,
-                                from_chat_id=chat_id,
-                                message_id=message.message_id,
-                                message_thread_id=topic_id
+                            sent_msg = await deliver(
+                                context.bot, bot_username, "forward_message",
+                                {
+                                    "chat_id": forum_group_id,
+                                    "from_chat_id": chat_id,
+                                    "message_id": message.message_id,
+                                    "message_thread_id": topic_id,
+                                }
                             )
                         
-                        logger.info(f"[话题模式] 转发成功")
-                        await reply_and_auto_delete(message, "✅ 已转交客服处理", delay=2)
+                        if sent_msg:
+                            hot_log("forum", "[话题模式] 转发成功", bot=bot_username, user=chat_id)
+                            await reply_and_auto_delete(message, "✅ 已转交客服处理", delay=2)
+                        else:
+                            await reply_and_auto_delete(message, QUEUED_NOTICE, delay=5)
 
                 except BadRequest as e:
                     low = str(e).lower()
                     if ("message thread not found" in low) or ("topic not found" in low):
                         try:
-                            display_name = (
-                                message.from_user.full_name
-                                or (f"@{message.from_user.username}" if message.from_user.username else None)
-                                or "匿名用户"
-                            )
-                            topic = await context.bot.create_forum_topic(
-                                chat_id=forum_group_id,
-                                name=f"{display_name}"
+                            topic_id = await get_or_create_topic(
+                                context.bot, bot_username, forum_group_id, message.from_user,
+                                stale_topic_id=topic_id
                             )
-                            topic_id = topic.message_thread_id
-                            # 💾 保存到数据库和内存
-                            topics[uid_key] = topic_id
-                            db.set_mapping(bot_username, "topic", uid_key, str(topic_id), chat_id)
 
                             await context.bot.forward_message(
                                 chat_id=forum_group_id,
@@ -1216,8 +3014,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
 
             # 群里该话题下的消息 -> 回到用户
             if message.chat.id == forum_group_id and getattr(message, "is_topic_message", False):
+                message_path.set("owner_reply")
                 topic_id = message.message_thread_id
-                logger.info(f"[话题模式] 收到群消息，topic_id: {topic_id}, 查找对应用户")
+                hot_log("owner_reply", "[话题模式] 收到群消息，topic_id: %s, 查找对应用户", topic_id, bot=bot_username)
                 target_uid = None
                 for uid_str, t_id in topics.items():
                     if t_id == topic_id:
@@ -1238,7 +3037,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                             message_id=user_msg_id,
                                             text=message.text
                                         )
-                                        logger.info(f"[话题模式] 主人编辑回复成功")
+                                        hot_log("owner_reply", "[话题模式] 主人编辑回复成功", bot=bot_username)
                                         # 话题模式下主人在群里编辑，给一个简单的反馈(不使用reply_and_auto_delete，因为可能没有reply_to_message)
                                         try:
                                             sent = await message.reply_text("✅ 编辑同步成功")
@@ -1252,16 +3051,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                     logger.error(f"[话题模式] 编辑回复失败: {e}")
                         else:
                             # 新消息
-                            logger.info(f"[话题模式] 找到用户 {target_uid}，准备发送")
-                            sent_msg = await context.bot.copy_message(
-                                chat_id=target_uid,
-                                from_chat_id=forum_group_id,
-                                message_id=message.message_id
+                            hot_log("owner_reply", "[话题模式] 找到用户 %s，准备发送", target_uid, bot=bot_username, user=target_uid)
+                            # 💾 投递成功后保存映射关系到数据库和内存
+                            sent_msg = await deliver(
+                                context.bot, bot_username, "copy_message",
+                                {"chat_id": target_uid, "from_chat_id": forum_group_id, "message_id": message.message_id},
+                                maps=[["owner_user", owner_msg_key, SENT]],
+                                user_id=target_uid
                             )
-                            # 💾 保存映射关系到数据库和内存
-                            msg_map[bot_username]["owner_to_user"][owner_msg_key] = sent_msg.message_id
-                            db.set_mapping(bot_username, "owner_user", owner_msg_key, str(sent_msg.message_id), target_uid)
-                            logger.info(f"[话题模式] 回复发送成功")
+                            if sent_msg:
+                                hot_log("owner_reply", "[话题模式] 回复发送成功", bot=bot_username, user=target_uid)
+                            else:
+                                hot_log("owner_reply", "[话题模式] 回复已加入重发队列", bot=bot_username, user=target_uid)
                     except Exception as e:
                         logger.error(f"群->用户 复制失败: {e}")
                 else:
@@ -1355,7 +3156,9 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_admin_log(
             f"📢 {admin_display} 发送广播\n"
             f"成功: {success_count}/{len(all_owners)}\n"
-            f"时间: {now}"
+            f"时间: {now}",
+            category="broadcast",
+            critical=True
         )
         
         return
@@ -1396,7 +3199,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
             now = datetime.now().strftime("%Y-%m-%d %H:%M")
             user_username = update.message.from_user.username
             user_display = f"@{user_username}" if user_username else f"用户ID: {owner_id}"
-            await send_admin_log(f"✏️ {user_display} (ID: <code>{owner_id}</code>) 为 @{bot_username} 设置了自定义欢迎语 · {now}")
+            await send_admin_log(f"✏️ {user_display} (ID: <code>{owner_id}</code>) 为 @{bot_username} 设置了自定义欢迎语 · {now}", category="welcome", bot_username=bot_username)
         else:
             await update.message.reply_text("❌ 设置失败，请稍后重试")
         
@@ -1425,7 +3228,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # 通知管理员
             now = datetime.now().strftime("%Y-%m-%d %H:%M")
-            await send_admin_log(f"📝 管理员设置了全局欢迎语 · {now}")
+            await send_admin_log(f"📝 管理员设置了全局欢迎语 · {now}", category="welcome")
         else:
             await update.message.reply_text("❌ 设置失败，请稍后重试")
         
@@ -1478,7 +3281,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 now = datetime.now().strftime("%Y-%m-%d %H:%M")
                 user_username = update.message.from_user.username
                 user_display = f"@{user_username}" if user_username else f"用户ID: {owner_id}"
-                await send_admin_log(f"🛠 {user_display} (ID: <code>{owner_id}</code>) 为 @{bot_username} 设置话题群ID为 {gid} · {now}")
+                await send_admin_log(f"🛠 {user_display} (ID: <code>{owner_id}</code>) 为 @{bot_username} 设置话题群ID为 {gid} · {now}", category="config", bot_username=bot_username)
                 break
         context.user_data.pop("waiting_forum_for", None)
         return
@@ -1491,7 +3294,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["waiting_token"] = False
 
     try:
-        tmp_app = Application.builder().token(token).build()
+        tmp_app = app_builder(token).build()
         bot_info = await tmp_app.bot.get_me()
         bot_username = bot_info.username
     except Exception:
@@ -1526,14 +3329,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
     trigger_backup(silent=True)
 
     # 启动子 Bot
-    new_app = Application.builder().token(token).build()
-    new_app.add_handler(CommandHandler("start", subbot_start))
-    # 处理普通消息
-    new_app.add_handler(MessageHandler(filters.ALL, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
-    # 处理编辑消息
-    new_app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
-    # 💡 添加回调处理器（处理 /id 命令的按钮）
-    new_app.add_handler(CallbackQueryHandler(callback_handler))
+    new_app = build_sub_app(token, owner_id, bot_username)
 
     running_apps[bot_username] = new_app
     await new_app.initialize()
@@ -1582,15 +3378,17 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🤖 Bot: @{bot_username}\n"
         f"⏰ {now}"
     )
-    await send_admin_log(log_text)
+    await send_admin_log(log_text, category="bot_add", bot_username=bot_username, critical=True)
 
 # ================== 菜单回调 ==================
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
     
+    remember_user(query.from_user)
+    
     # 🔍 添加日志：记录回调触发
-    logger.info(f"[回调] 收到回调: {data}, 来自用户: {query.from_user.id}")
+    hot_log("callback", "[回调] 收到回调: %s, 来自用户: %s", data, query.from_user.id, user=query.from_user.id)
     
     try:
         await query.answer()
@@ -1647,25 +3445,26 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = f"👥 托管用户列表（共 {len(all_users)} 人）\n"
         text += f"📄 第 {page + 1}/{total_pages} 页\n\n"
         
-        for idx, user_info in enumerate(page_users, start=start_idx + 1):
+        # 并发获取本页用户资料（优先命中缓存，通过该用户的第一个运行中 bot 获取）
+        async def fetch_owner_profile(user_info):
+            for bot_username in user_info['bot_usernames'][:1]:  # 只取第一个bot
+                if bot_username in running_apps:
+                    try:
+                        return await get_user_profile(running_apps[bot_username].bot, int(user_info['owner_id']))
+                    except Exception:
+                        pass
+            return get_cached_profile(int(user_info['owner_id']))
+        
+        page_profiles = await asyncio.gather(*(fetch_owner_profile(u) for u in page_users))
+        
+        for idx, (user_info, chat) in enumerate(zip(page_users, page_profiles), start=start_idx + 1):
             # 获取用户信息
-            try:
-                owner_id_int = int(user_info['owner_id'])
-                # 尝试通过任意一个bot获取用户信息
-                user_display = f"ID: {owner_id_int}"
-                for bot_username in user_info['bot_usernames'][:1]:  # 只取第一个bot
-                    if bot_username in running_apps:
-                        try:
-                            chat = await running_apps[bot_username].bot.get_chat(owner_id_int)
-                            if chat.username:
-                                user_display = f"@{chat.username}"
-                            elif chat.first_name:
-                                user_display = chat.first_name
-                            break
-                        except:
-                            pass
-            except:
-                user_display = f"ID: {user_info['owner_id']}"
+            user_display = f"ID: {user_info['owner_id']}"
+            if chat:
+                if chat.username:
+                    user_display = f"@{chat.username}"
+                elif chat.first_name:
+                    user_display = chat.first_name
             
             # 显示用户的bot列表
             bot_list = ", ".join([f"@{bot}" for bot in user_info['bot_usernames'][:3]])
@@ -1706,68 +3505,49 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["waiting_broadcast"] = True
         return
     
+    # 性能面板（读取后台采样结果，不查库）
+    if data == "admin_perf":
+        if not is_admin(query.from_user.id):
+            await query.answer("⚠️ 仅管理员可用", show_alert=True)
+            return
+        
+        text, keyboard = render_perf_dashboard()
+        try:
+            await query.message.edit_text(text, reply_markup=keyboard)
+        except BadRequest:
+            pass  # 两次采样之间刷新，内容没有变化
+        return
+    
     # 清理失效Bot
     if data == "admin_clean_invalid":
         if not is_admin(query.from_user.id):
             await query.answer("⚠️ 仅管理员可用", show_alert=True)
             return
         
-        await query.message.edit_text(
-            "🗑️ 正在检测失效的机器人...\n\n"
-            "请稍候..."
-        )
+        # 直接展示后台检测保存的结果（秒开）
+        text, keyboard, invalid_bots = render_health_report()
         
-        # 检测所有bot的token有效性
-        all_bots = db.get_all_bots()
-        invalid_bots = []
-        valid_count = 0
-        
-        for bot_username, bot_info in all_bots.items():
-            try:
-                # 尝试验证token
-                from telegram import Bot
-                test_bot = Bot(token=bot_info['token'])
-                await test_bot.get_me()
-                valid_count += 1
-            except Exception as e:
-                invalid_bots.append({
-                    'username': bot_username,
-                    'owner': bot_info['owner'],
-                    'token': bot_info['token'][:20] + "...",
-                    'error': str(e)
-                })
+        # 保存失效bot列表到上下文
+        context.user_data["invalid_bots"] = invalid_bots
         
-        if not invalid_bots:
-            await query.message.edit_text(
-                f"✅ 检测完成\n\n"
-                f"有效机器人: {valid_count} 个\n"
-                f"失效机器人: 0 个\n\n"
-                f"🎉 所有机器人都正常！",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]])
-            )
+        await query.message.edit_text(text, reply_markup=keyboard)
+        return
+    
+    # 立即重新检测所有Bot
+    if data == "admin_recheck_health":
+        if not is_admin(query.from_user.id):
+            await query.answer("⚠️ 仅管理员可用", show_alert=True)
             return
         
-        # 显示失效bot列表
-        text = f"🗑️ 失效机器人列表\n\n"
-        text += f"✅ 有效: {valid_count} 个\n"
-        text += f"❌ 失效: {len(invalid_bots)} 个\n\n"
-        
-        for idx, bot in enumerate(invalid_bots[:10], 1):  # 最多显示10个
-            text += f"{idx}. @{bot['username']}\n"
-            text += f"   Owner ID: {bot['owner']}\n\n"
-        
-        if len(invalid_bots) > 10:
-            text += f"\n... 还有 {len(invalid_bots) - 10} 个\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("🗑️ 删除所有失效Bot", callback_data="admin_confirm_clean")],
-            [InlineKeyboardButton("🔙 取消", callback_data="back_home")]
-        ]
-        
-        # 保存失效bot列表到上下文
-        context.user_data["invalid_bots"] = [bot['username'] for bot in invalid_bots]
+        await query.message.edit_text(
+            "🗑️ 正在检测失效的机器人...\n\n"
+            "请稍候..."
+        )
+        await run_health_checks()
         
-        await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        text, keyboard, invalid_bots = render_health_report()
+        context.user_data["invalid_bots"] = invalid_bots
+        await query.message.edit_text(text, reply_markup=keyboard)
         return
     
     # 确认删除失效Bot
@@ -1839,7 +3619,9 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🗑️ 管理员清理失效Bot\n"
             f"成功: {deleted_count} 个\n"
             f"失败: {failed_count} 个\n"
-            f"时间: {now}"
+            f"时间: {now}",
+            category="bot_clean",
+            critical=True
         )
         return
 
@@ -1879,19 +3661,19 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
                     # 获取用户信息
                     try:
-                        user = await context.bot.get_chat(user_id)
+                        user = await get_user_profile(context.bot, user_id)
                         user_username = user.username
                         user_name = user.full_name or "匿名用户"
                         # 优先使用 @用户名
                         if user_username:
                             user_display = f"@{user_username}"
                         else:
-                            user_display = f"<a href='tg://user?id={user_id}'>{user_name}</a>"
+                            user_display = f"<a href='tg://user?id={user_id}'>{html.escape(user_name)}</a>"
                         log_text = f"🚫 Bot @{bot_username} 拉黑用户 {user_display} (ID: <code>{user_id}</code>) · {now}"
                     except:
                         # 如果获取失败，仅显示ID
                         log_text = f"🚫 Bot @{bot_username} 拉黑用户 ID: <code>{user_id}</code> · {now}"
-                    await send_admin_log(log_text)
+                    await send_admin_log(log_text, category="block", bot_username=bot_username)
                 else:
                     await query.message.edit_text(f"⚠️ 用户 {user_id} 已在黑名单中")
                     logger.info(f"[回调] 用户已在黑名单: {user_id}")
@@ -1906,19 +3688,19 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
                     # 获取用户信息
                     try:
-                        user = await context.bot.get_chat(user_id)
+                        user = await get_user_profile(context.bot, user_id)
                         user_username = user.username
                         user_name = user.full_name or "匿名用户"
                         # 优先使用 @用户名
                         if user_username:
                             user_display = f"@{user_username}"
                         else:
-                            user_display = f"<a href='tg://user?id={user_id}'>{user_name}</a>"
+                            user_display = f"<a href='tg://user?id={user_id}'>{html.escape(user_name)}</a>"
                         log_text = f"✅ Bot @{bot_username} 解除拉黑用户 {user_display} (ID: <code>{user_id}</code>) · {now}"
                     except:
                         # 如果获取失败，仅显示ID
                         log_text = f"✅ Bot @{bot_username} 解除拉黑用户 ID: <code>{user_id}</code> · {now}"
-                    await send_admin_log(log_text)
+                    await send_admin_log(log_text, category="unblock", bot_username=bot_username)
                 else:
                     await query.message.edit_text(f"⚠️ 用户 {user_id} 不在黑名单中")
                     logger.info(f"[回调] 用户不在黑名单: {user_id}")
@@ -1933,19 +3715,19 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
                     # 获取用户信息
                     try:
-                        user = await context.bot.get_chat(user_id)
+                        user = await get_user_profile(context.bot, user_id)
                         user_username = user.username
                         user_name = user.full_name or "匿名用户"
                         # 优先使用 @用户名
                         if user_username:
                             user_display = f"@{user_username}"
                         else:
-                            user_display = f"<a href='tg://user?id={user_id}'>{user_name}</a>"
+                            user_display = f"<a href='tg://user?id={user_id}'>{html.escape(user_name)}</a>"
                         log_text = f"🔓 Bot @{bot_username} 取消用户 {user_display} (ID: <code>{user_id}</code>) 验证 · {now}"
                     except:
                         # 如果获取失败，仅显示ID
                         log_text = f"🔓 Bot @{bot_username} 取消用户 ID: <code>{user_id}</code> 验证 · {now}"
-                    await send_admin_log(log_text)
+                    await send_admin_log(log_text, category="unverify", bot_username=bot_username)
                 else:
                     await query.message.edit_text(f"⚠️ 用户 {user_id} 未验证或不存在")
                     logger.info(f"[回调] 用户未验证: {user_id}")
@@ -1995,7 +3777,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # 获取主人的用户名
         try:
-            owner_user = await context.bot.get_chat(int(owner_id))
+            owner_user = await get_user_profile(context.bot, int(owner_id))
             owner_display = f"@{owner_user.username}" if owner_user.username else owner_user.full_name or "未知"
         except:
             owner_display = "未知"
@@ -2066,7 +3848,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         now = datetime.now().strftime("%Y-%m-%d %H:%M")
         user_username = query.from_user.username
         user_display = f"@{user_username}" if user_username else f"用户ID: {owner_id}"
-        await send_admin_log(f"📡 {user_display} (ID: <code>{owner_id}</code>) 将 @{bot_username} 切换为 {mode_cn_full} · {now}")
+        await send_admin_log(f"📡 {user_display} (ID: <code>{owner_id}</code>) 将 @{bot_username} 切换为 {mode_cn_full} · {now}", category="config", bot_username=bot_username)
 
         await query.message.reply_text(f"✅ 已将 @{bot_username} 切换为 {mode_cn_full.split('模式')[0]} 模式。")
 
@@ -2243,6 +4025,30 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         return
 
+    # 死信重发 / 丢弃
+    if data.startswith("dl_"):
+        user_id = query.from_user.id
+        allowed = visible_dead_letter_bots(user_id)
+        if data == "dl_replay_all":
+            letters = db.get_dead_letters(allowed, limit=100)
+            replayed = sum(1 for letter in letters if db.replay_dead_letter(letter["id"], time.time()))
+            notice = f"✅ 已将 {replayed} 条消息放回重发队列"
+        else:
+            action, letter_id = data[len("dl_"):].rsplit("_", 1)
+            letter = db.get_dead_letter(int(letter_id))
+            if not letter or (allowed is not None and letter["bot_username"] not in allowed):
+                await reply_and_auto_delete(query.message, "⚠️ 该记录不存在或已处理", delay=5)
+                return
+            if action == "replay":
+                db.replay_dead_letter(letter["id"], time.time())
+                notice = f"✅ #{letter['id']} 已放回重发队列"
+            else:
+                db.delete_dead_letter(letter["id"])
+                notice = f"🗑 #{letter['id']} 已丢弃"
+        text, markup = render_dead_letters(user_id)
+        await query.message.edit_text(f"{notice}\n\n{text}", reply_markup=markup)
+        return
+
     if data.startswith("del_"):
         bot_username = data.split("_", 1)[1]
         owner_id = str(query.from_user.id)
@@ -2281,7 +4087,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🤖 Bot: @{bot_username}\n"
                 f"⏰ {now}"
             )
-            await send_admin_log(log_text)
+            await send_admin_log(log_text, category="bot_delete", bot_username=bot_username, critical=True)
         except Exception as e:
             await reply_and_auto_delete(query.message, f"❌ 删除失败: {e}", delay=10)
         return
@@ -2292,26 +4098,23 @@ async def run_all_bots():
         logger.error("MANAGER_TOKEN 未设置，无法启动管理Bot。")
         return
 
-    # 初始化数据库
-    db.init_database()
+    # 事件循环健康监测（尽早启动，覆盖子 Bot 启动阶段）
+    start_background_task(loop_monitor(), name="loop_monitor")
+
+    # 打开数据库（执行未应用的迁移）
+    db.open_database()
     
-    # 从数据库加载配置
-    load_bots()
-    load_map()
+    # 加载配置和消息映射：状态快照与数据库一致时直接载入，否则从数据库完整加载
+    if not load_state_snapshot():
+        warm_start()
+    load_pending_verifications()
 
     # 启动子 bot（恢复）
     for owner_id, info in bots_data.items():
         for b in info.get("bots", []):
             token = b["token"]; bot_username = b["bot_username"]
             try:
-                app = Application.builder().token(token).build()
-                app.add_handler(CommandHandler("start", subbot_start))
-                # 处理普通消息
-                app.add_handler(MessageHandler(filters.ALL, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
-                # 处理编辑消息 - 使用 filters.UpdateType.EDITED_MESSAGE
-                app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
-                # 💡 添加回调处理器（处理 /id 命令的按钮）
-                app.add_handler(CallbackQueryHandler(callback_handler))
+                app = build_sub_app(token, owner_id, bot_username)
                 running_apps[bot_username] = app
                 await app.initialize()
                 await app.start()
@@ -2346,7 +4149,8 @@ async def run_all_bots():
                 logger.error(f"子Bot启动失败: @{bot_username} {e}")
 
     # 管理 Bot
-    manager_app = Application.builder().token(MANAGER_TOKEN).build()
+    manager_app = app_builder(MANAGER_TOKEN).build()
+    manager_app.add_handler(TypeHandler(Update, partial(count_update, bot_username="__manager__")), group=-1)
     manager_app.add_handler(CommandHandler("start", manager_start))
     # 添加欢迎语设置相关的命令处理器
     async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2394,19 +4198,63 @@ async def run_all_bots():
     
     manager_app.add_handler(CommandHandler("cancel", handle_cancel))
     manager_app.add_handler(CommandHandler("clear", handle_clear))
+    manager_app.add_handler(CommandHandler("audit", admin_audit))
+    manager_app.add_handler(CommandHandler("dl", dead_letters_command))
+    manager_app.add_handler(CommandHandler("slow", admin_slow))
+    manager_app.add_handler(CommandHandler("mem", admin_memory))
+    manager_app.add_handler(CommandHandler("profile", admin_profile))
+    manager_app.add_handler(CommandHandler("retention", admin_retention))
+    manager_app.add_handler(CommandHandler("backup", admin_backup))
     manager_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, token_listener))
     manager_app.add_handler(CallbackQueryHandler(callback_handler))
     running_apps["__manager__"] = manager_app
 
     await manager_app.initialize(); await manager_app.start(); await manager_app.updater.start_polling()
     logger.info("管理 Bot 已启动 ✅")
-    if ADMIN_CHANNEL:
+
+    # 指标端点
+    if METRICS_PORT:
         try:
-            await manager_app.bot.send_message(ADMIN_CHANNEL, "✅ 宿主管理Bot已启动")
-        except Exception as e:
-            logger.error(f"启动通知失败: {e}")
+            await metrics.start_http_server(METRICS_ADDR, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"❌ 指标端点启动失败: {e}")
+
+    # 后台定时任务
+    start_background_task(health_check_loop(), name="health_check")
+    start_background_task(admin_log_digest_loop(), name="admin_log_digest")
+    start_background_task(outbound_retry_loop(), name="outbound_retry")
+    start_background_task(memory_accounting_loop(), name="memory_accounting")
+    start_background_task(perf_sampler_loop(), name="perf_sampler")
+    start_background_task(maintenance_loop(), name="maintenance")
+    start_background_task(pending_flush_loop(), name="pending_flush")
+    if STATE_SNAPSHOT_FILE and STATE_SNAPSHOT_INTERVAL > 0:
+        start_background_task(state_snapshot_loop(), name="state_snapshot")
+    await send_admin_log("✅ 宿主管理Bot已启动", category="system", critical=True)
 
-    await asyncio.Event().wait()
+    # systemd 停止服务时发送 SIGTERM：先发出待汇总的管理日志并停止各 Bot，再写回内存中的待验证记录、写入状态快照并关闭数据库
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+        logger.info("🛑 收到退出信号，正在停止...")
+        # 管理 Bot 停止前发出缓冲中的管理日志汇总
+        try:
+            await flush_admin_log()
+        except Exception as e:
+            logger.error(f"❌ 发送管理日志汇总失败: {e}")
+        for bot_username, app in list(running_apps.items()):
+            try:
+                await app.updater.stop()
+                await app.stop()
+                await app.shutdown()
+            except Exception as e:
+                logger.warning(f"停止 @{bot_username} 失败: {e}")
+    finally:
+        await flush_pending_verifications()
+        await save_state_snapshot("退出")
+        db.close_database()
 
 if __name__ == "__main__":
     asyncio.run(run_all_bots())
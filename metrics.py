@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+指标模块 - 进程内计数器 / 直方图 / 仪表盘 / 链路追踪 / 采样分析
+支持：Prometheus 文本格式导出、本地 HTTP 端点、慢请求飞行记录、折叠栈输出
+"""
+import asyncio
+import bisect
+import contextvars
+import io
+import itertools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter as TallyCounter, deque
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 默认直方图分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 已注册的指标（按注册顺序导出）
+_registry = []
+_lock = Lock()  # 数据库操作在工作线程中也会记录指标
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """单调递增计数器"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values: Dict[tuple, float] = {}
+        _registry.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self.values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """瞬时值；可以直接 set，也可以传入 collect 回调在导出时计算
+
+    collect 返回 {标签值元组: 数值}
+    """
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), collect: Callable = None):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values: Dict[tuple, float] = {}
+        self.collect = collect
+        _registry.append(self)
+
+    def set(self, value: float, *label_values):
+        with _lock:
+            self.values[label_values] = value
+
+    def snapshot(self) -> Dict[tuple, float]:
+        if self.collect is None:
+            with _lock:
+                return dict(self.values)
+        try:
+            return self.collect()
+        except Exception as e:
+            logger.error(f"采集指标 {self.name} 失败: {e}")
+            return {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """固定分桶直方图（累计计数在导出时计算）"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[tuple, list] = {}  # 标签 -> [各桶计数..., +Inf 计数, 总和]
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            data = self.values.get(label_values)
+            if data is None:
+                data = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            data[index] += 1
+            data[-1] += value
+
+    def time(self, *label_values):
+        """上下文管理器：记录代码块耗时"""
+        return _Timer(self, label_values)
+
+    def count(self, *label_values) -> int:
+        data = self.values.get(label_values)
+        return sum(data[:-1]) if data else 0
+
+    def snapshot(self, *label_values) -> list:
+        """当前各桶计数的副本（两次快照相减即为区间内的分布）"""
+        with _lock:
+            data = self.values.get(label_values)
+            return list(data) if data else [0] * (len(self.buckets) + 1) + [0.0]
+
+    def quantile(self, q: float, *label_values) -> float:
+        """按分桶估算分位数（取所在桶上界），无数据返回 0"""
+        data = self.values.get(label_values)
+        return bucket_quantile(self.buckets, data, q) if data else 0.0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            items = sorted((key, list(data)) for key, data in self.values.items())
+        for key, data in items:
+            running = 0
+            for bound, n in zip(self.buckets, data):
+                running += n
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {running}")
+            running += data[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {running}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {data[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {running}")
+        return lines
+
+
+def bucket_quantile(buckets: tuple, data: list, q: float) -> float:
+    """由分桶计数（Histogram.snapshot 格式）估算分位数"""
+    total = sum(data[:-1])
+    if not total:
+        return 0.0
+    target = q * total
+    running = 0
+    for bound, n in zip(buckets, data):
+        running += n
+        if running >= target:
+            return bound
+    return float("inf")
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+        return False
+
+
+def render_prometheus() -> str:
+    """导出所有指标（Prometheus 文本格式 0.0.4）"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ================== 链路追踪 ==================
+# 每个 Update 一条 Trace；处理过程中的各阶段、Bot API 和数据库调用记录为 Span
+current_trace = contextvars.ContextVar("current_trace", default=None)
+_trace_ids = itertools.count(1)
+
+
+class Trace:
+    """一次 Update 处理的耗时明细"""
+
+    def __init__(self, bot: str, kind: str, user_id: Optional[int] = None, queue_delay: Optional[float] = None):
+        self.id = next(_trace_ids)
+        self.bot = bot
+        self.kind = kind
+        self.user_id = user_id
+        self.queue_delay = queue_delay  # 消息发出到开始处理的间隔（秒，按消息时间戳估算）
+        self.path = ""
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans: List[tuple] = []  # (名称, 相对开始时间, 耗时, 错误)
+
+    def add_span(self, name: str, start: float, duration: float, error: str = ""):
+        if self.duration is None:
+            self.spans.append((name, start - self.start, duration, error))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    def format(self) -> str:
+        header = (
+            f"#{self.id} @{self.bot} {self.kind}{f'/{self.path}' if self.path else ''} "
+            f"{(self.duration or 0) * 1000:.0f}ms · {self.started_at.strftime('%H:%M:%S')}"
+        )
+        if self.user_id:
+            header += f" · 用户 {self.user_id}"
+        if self.queue_delay is not None and self.queue_delay >= 1:
+            header += f" · 排队约 {self.queue_delay:.0f}s"
+        lines = [header]
+        for name, offset, duration, error in self.spans:
+            lines.append(f"  +{offset * 1000:7.1f}ms {duration * 1000:8.1f}ms  {name}{f' ❌ {error}' if error else ''}")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id, "bot": self.bot, "kind": self.kind, "path": self.path, "user_id": self.user_id,
+            "started_at": self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "duration_ms": round((self.duration or 0) * 1000, 2),
+            "queue_delay_s": self.queue_delay,
+            "spans": [
+                {"name": n, "offset_ms": round(o * 1000, 2), "duration_ms": round(d * 1000, 2), "error": e}
+                for n, o, d, e in self.spans
+            ],
+        }
+
+
+class FlightRecorder:
+    """最近完成的 Trace（固定大小环形缓冲）"""
+
+    def __init__(self, size: int = 500):
+        self.traces = deque(maxlen=size)
+
+    def add(self, trace: Trace):
+        self.traces.append(trace)
+
+    def slowest(self, n: int = 10, bot: str = None) -> List[Trace]:
+        traces = [t for t in list(self.traces) if bot is None or t.bot == bot]
+        return sorted(traces, key=lambda t: t.duration or 0, reverse=True)[:n]
+
+
+def record_span(name: str, duration: float, error: str = "", end: float = None):
+    """把一段已结束的耗时记录到当前 Trace（没有 Trace 时忽略）"""
+    trace = current_trace.get()
+    if trace is not None:
+        end = time.perf_counter() if end is None else end
+        trace.add_span(name, end - duration, duration, error)
+
+
+@contextmanager
+def span(name: str):
+    """记录代码块耗时到当前 Trace（同步、异步代码中都可用）"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    error = ""
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add_span(name, start, time.perf_counter() - start, error)
+
+
+# ================== 采样分析 ==================
+# 输出折叠栈格式（每行 "帧;帧;帧 次数"），可直接交给 flamegraph.pl / speedscope
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class StackSampler:
+    """采样分析器：后台线程按间隔抓取目标线程的调用栈并计数
+
+    每次采样都计量自身耗时，超过 max_overhead（占间隔的比例）时自动拉长间隔；
+    到达截止时间或调用 stop() 后线程退出。
+    采样线程只能在目标线程让出 GIL 时取栈，采样期间临时调小 GIL 切换间隔，
+    否则短于默认 5ms 的同步代码几乎采不到（都会落在 select 上）；
+    即便如此，亚毫秒级的同步片段仍会被低估，需要精确调用次数时用 cProfile。
+    """
+    SWITCH_INTERVAL = 0.0002
+
+    def __init__(self, thread_id: int, interval: float = 0.005, max_overhead: float = 0.02, max_depth: int = 64):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.max_depth = max_depth
+        self.stacks = TallyCounter()
+        self.samples = 0
+        self.busy = 0.0       # 采样本身消耗的时间（秒）
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, duration: float):
+        self._thread = threading.Thread(target=self._run, args=(duration,), name="stack_sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, duration: float):
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, self.SWITCH_INTERVAL))
+        try:
+            self._sample(duration)
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+    def _sample(self, duration: float):
+        started = time.monotonic()
+        deadline = started + duration
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            t0 = time.perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                labels = []
+                while frame is not None and len(labels) < self.max_depth:
+                    labels.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(labels))] += 1
+                self.samples += 1
+            cost = time.perf_counter() - t0
+            self.busy += cost
+            if cost > self.interval * self.max_overhead:
+                self.interval = min(cost / self.max_overhead, 0.5)
+        self.elapsed = time.monotonic() - started
+
+    @property
+    def overhead(self) -> float:
+        return self.busy / self.elapsed if self.elapsed else 0.0
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, n: int = 30) -> str:
+        """按自身（栈顶）和累计（出现在栈中）采样数排列的函数表"""
+        own, total = TallyCounter(), TallyCounter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for label in set(frames):
+                total[label] += count
+        samples = self.samples or 1
+        lines = [f"{'自身%':>7} {'累计%':>7}  函数"]
+        for label, count in own.most_common(n):
+            lines.append(f"{count * 100 / samples:7.2f} {total[label] * 100 / samples:7.2f}  {label}")
+        return "\n".join(lines) + "\n"
+
+
+def cprofile_collapsed(stats: pstats.Stats) -> str:
+    """cProfile 只记录调用边，折叠为两层 "调用方;函数 微秒"（按调用方拆分自身耗时）"""
+    lines = []
+    for (filename, lineno, name), (_, _, tt, _, callers) in stats.stats.items():
+        label = f"{name} ({os.path.basename(filename)}:{lineno})".replace(";", ":")
+        if not callers:
+            lines.append((label, tt))
+            continue
+        for (c_file, c_line, c_name), caller_stats in callers.items():
+            caller = f"{c_name} ({os.path.basename(c_file)}:{c_line})".replace(";", ":")
+            lines.append((f"{caller};{label}", caller_stats[2]))
+    return "".join(f"{stack} {int(t * 1e6)}\n" for stack, t in sorted(lines, key=lambda x: -x[1]) if t >= 1e-6)
+
+
+def cprofile_top(stats: pstats.Stats, n: int = 30) -> str:
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats("tottime").print_stats(n)
+    stats.sort_stats("cumulative").print_stats(n)
+    return out.getvalue()
+
+
+# ================== HTTP 端点 ==================
+# 路径 -> 回调，回调返回 (content_type, body)；其它模块可以注册自己的路径
+routes: Dict[str, Callable] = {
+    "/metrics": lambda query: ("text/plain; version=0.0.4; charset=utf-8", render_prometheus()),
+}
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # 读掉请求头
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode("latin-1").split()
+        target = parts[1] if len(parts) >= 2 else "/"
+        path, _, query = target.partition("?")
+        handler = routes.get(path)
+        if parts and parts[0] != "GET":
+            status, content_type, body = "405 Method Not Allowed", "text/plain", "method not allowed\n"
+        elif handler is None:
+            status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+        else:
+            try:
+                status = "200 OK"
+                content_type, body = handler(query)
+            except Exception as e:
+                logger.warning(f"⚠️ 指标端点 {path} 生成失败: {e}")
+                status, content_type, body = "500 Internal Server Error", "text/plain", "internal error\n"
+        payload = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"指标请求处理失败: {e}")
+    finally:
+        writer.close()
+
+
+async def start_http_server(host: str, port: int):
+    """启动指标 HTTP 服务（仅建议监听本机地址）"""
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info(f"📈 指标端点已启动: http://{host}:{port}/metrics")
+    return server
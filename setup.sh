@@ -6,6 +6,7 @@ SERVICE_NAME="tg_multi_bot"
 SCRIPT_NAME="host_bot.py"
 SCRIPT_URL="https://raw.githubusercontent.com/alexzhang1433/VPS-TGbot/refs/heads/main/host_bot.py"
 DATABASE_URL="https://raw.githubusercontent.com/alexzhang1433/VPS-TGbot/refs/heads/main/database.py"
+METRICS_URL="https://raw.githubusercontent.com/alexzhang1433/VPS-TGbot/refs/heads/main/metrics.py"
 
 function check_and_install() {
   PKG=$1
@@ -142,6 +143,13 @@ APP_DIR="/opt/tg_multi_bot"
 BACKUP_DIR="$APP_DIR/backup_temp"
 DATE=$(date +%Y-%m-%d_%H-%M-%S)
 
+# 同一时间只运行一个备份（宿主程序触发和定时任务可能重叠，共用 backup_temp）
+exec 9>"$APP_DIR/backup.lock"
+if ! flock -w 600 9; then
+  echo "❌ 等待上一次备份超时，放弃本次备份"
+  exit 1
+fi
+
 # 加载环境变量
 source "$APP_DIR/.env"
 
@@ -164,10 +172,28 @@ if [ ! -d ".git" ]; then
   git remote set-url origin "https://$GH_TOKEN@github.com/$GH_USERNAME/$GH_REPO.git"
 fi
 
-# 复制数据库文件
+# 备份数据库（一致性快照，不直接复制正在写入的库文件）
 echo "📦 备份数据文件..."
-if [ -f "$APP_DIR/bot_data.db" ]; then
-  cp -f "$APP_DIR/bot_data.db" . 2>/dev/null && echo "  ✅ bot_data.db（数据库）"
+if [ "$BACKUP_MODE" = "incremental" ]; then
+  # 增量模式：data/ 下保存一个全量和之后的增量（gzip NDJSON），仓库大小随改动量增长
+  rm -f bot_data.db "$SNAPSHOT_FILE"
+  if "$APP_DIR/venv/bin/python" "$APP_DIR/database.py" export "$BACKUP_DIR/data" --full-every "${BACKUP_FULL_EVERY:-7}" >/dev/null; then
+    echo "  ✅ data/（增量备份）"
+  else
+    echo "  ❌ 导出增量备份失败，放弃本次备份"
+    exit 1
+  fi
+elif [ -n "$SNAPSHOT_FILE" ] && [ -f "$SNAPSHOT_FILE" ]; then
+  # 宿主程序已在进程内生成快照
+  mv -f "$SNAPSHOT_FILE" bot_data.db && echo "  ✅ bot_data.db（数据库快照）"
+elif [ -f "$APP_DIR/bot_data.db" ]; then
+  # 定时任务等独立运行的场景：用 VACUUM INTO 在线导出，不影响正在运行的服务
+  if "$APP_DIR/venv/bin/python" "$APP_DIR/database.py" snapshot "$BACKUP_DIR/bot_data.db" >/dev/null; then
+    echo "  ✅ bot_data.db（数据库快照）"
+  else
+    echo "  ❌ 生成数据库快照失败，放弃本次备份"
+    exit 1
+  fi
 else
   echo "  ⚠️ 未找到数据库文件 bot_data.db"
 fi
@@ -180,6 +206,7 @@ cp -f "$APP_DIR/.env" . 2>/dev/null || echo "# Empty" > .env
 echo "📜 备份脚本文件..."
 cp -f "$APP_DIR/host_bot.py" . 2>/dev/null || touch host_bot.py
 cp -f "$APP_DIR/database.py" . 2>/dev/null && echo "  ✅ database.py"
+cp -f "$APP_DIR/metrics.py" . 2>/dev/null && echo "  ✅ metrics.py"
 
 # 创建备份信息文件
 cat <<EOF > backup_info.txt
@@ -187,9 +214,9 @@ cat <<EOF > backup_info.txt
 服务器: $(hostname)
 Python版本: $(python3 --version 2>&1)
 备份内容:
-  - 数据库文件: bot_data.db
+  - 数据库: $([ "$BACKUP_MODE" = "incremental" ] && echo "data/（全量 + 增量，见 data/manifest.json）" || echo "bot_data.db")
   - 配置文件: .env
-  - 脚本文件: host_bot.py, database.py
+  - 脚本文件: host_bot.py, database.py, metrics.py
 EOF
 
 # 提交到 GitHub
@@ -297,11 +324,21 @@ EOF
           mkdir -p "$BACKUP_OLD_DIR"
           echo "💾 备份当前数据到: $BACKUP_OLD_DIR"
           cp -f "$APP_DIR/bot_data.db" "$BACKUP_OLD_DIR/" 2>/dev/null || true
+          cp -f "$APP_DIR/bot_data.db-wal" "$BACKUP_OLD_DIR/" 2>/dev/null || true
           cp -f "$APP_DIR/.env" "$BACKUP_OLD_DIR/" 2>/dev/null || true
         fi
         
         # 恢复数据库文件
-        if [ -f "$TEMP_CHECK_DIR/bot_data.db" ]; then
+        if [ -f "$TEMP_CHECK_DIR/data/manifest.json" ]; then
+          # 增量备份：在空库上依次回放全量和增量
+          rm -f "$APP_DIR/bot_data.db" "$APP_DIR/bot_data.db-wal" "$APP_DIR/bot_data.db-shm"
+          if "$APP_DIR/venv/bin/python" "$APP_DIR/database.py" restore "$TEMP_CHECK_DIR/data" >/dev/null; then
+            echo "  ✅ 已由增量备份回放 bot_data.db"
+          else
+            echo "  ❌ 回放增量备份失败"
+          fi
+        elif [ -f "$TEMP_CHECK_DIR/bot_data.db" ]; then
+          rm -f "$APP_DIR/bot_data.db-wal" "$APP_DIR/bot_data.db-shm"  # 旧库的 WAL 不能套用到恢复的库上
           cp -f "$TEMP_CHECK_DIR/bot_data.db" "$APP_DIR/"
           echo "  ✅ 已恢复 bot_data.db"
         fi
@@ -511,9 +548,11 @@ mkdir -p "$BACKUP_OLD_DIR"
 
 echo "💾 备份当前数据到: $BACKUP_OLD_DIR"
 cp -f "$APP_DIR/bot_data.db" "$BACKUP_OLD_DIR/" 2>/dev/null || true
+cp -f "$APP_DIR/bot_data.db-wal" "$BACKUP_OLD_DIR/" 2>/dev/null || true
 cp -f "$APP_DIR/.env" "$BACKUP_OLD_DIR/" 2>/dev/null || true
 cp -f "$APP_DIR/host_bot.py" "$BACKUP_OLD_DIR/" 2>/dev/null || true
 cp -f "$APP_DIR/database.py" "$BACKUP_OLD_DIR/" 2>/dev/null || true
+cp -f "$APP_DIR/metrics.py" "$BACKUP_OLD_DIR/" 2>/dev/null || true
 
 # 恢复文件
 echo ""
@@ -524,7 +563,17 @@ RESTORED_COUNT=0
 if [ "$RESTORE_DATA" = true ]; then
   echo "📦 恢复数据库文件..."
   
-  if [ -f "$BACKUP_DIR/bot_data.db" ]; then
+  if [ -f "$BACKUP_DIR/data/manifest.json" ]; then
+    # 增量备份：在空库上依次回放全量和增量
+    rm -f "$APP_DIR/bot_data.db" "$APP_DIR/bot_data.db-wal" "$APP_DIR/bot_data.db-shm"
+    if "$APP_DIR/venv/bin/python" "$APP_DIR/database.py" restore "$BACKUP_DIR/data" >/dev/null; then
+      echo "  ✅ bot_data.db（由增量备份回放）"
+      RESTORED_COUNT=$((RESTORED_COUNT + 1))
+    else
+      echo "  ❌ 回放增量备份失败，原数据位于 $BACKUP_OLD_DIR"
+    fi
+  elif [ -f "$BACKUP_DIR/bot_data.db" ]; then
+    rm -f "$APP_DIR/bot_data.db-wal" "$APP_DIR/bot_data.db-shm"  # 旧库的 WAL 不能套用到恢复的库上
     cp -f "$BACKUP_DIR/bot_data.db" "$APP_DIR/"
     echo "  ✅ bot_data.db"
     RESTORED_COUNT=$((RESTORED_COUNT + 1))
@@ -563,6 +612,12 @@ if [ "$RESTORE_SCRIPT" = true ]; then
     echo "  ✅ database.py"
     RESTORED_COUNT=$((RESTORED_COUNT + 1))
   fi
+  
+  if [ -f "$BACKUP_DIR/metrics.py" ]; then
+    cp -f "$BACKUP_DIR/metrics.py" "$APP_DIR/"
+    echo "  ✅ metrics.py"
+    RESTORED_COUNT=$((RESTORED_COUNT + 1))
+  fi
 fi
 
 echo ""
@@ -647,6 +702,15 @@ function install_bot() {
     exit 1
   fi
 
+  # 下载 metrics.py
+  echo "  • 下载 metrics.py ..."
+  if curl -sL -o "metrics.py" "$METRICS_URL"; then
+    echo "    ✅ metrics.py"
+  else
+    echo "    ❌ metrics.py 下载失败，请手动上传到 $APP_DIR"
+    exit 1
+  fi
+
   echo "🐍 创建虚拟环境..."
   # 清理可能存在的失败虚拟环境
   if [ -d venv ] && [ ! -f venv/bin/activate ]; then